@@ -1,13 +1,16 @@
-import dataclasses
+import asyncio
 import io
-import json
 import logging
 import mimetypes
 import os
+import time
 from pathlib import Path
-from typing import AsyncGenerator, cast
+from typing import Any, AsyncGenerator, Optional, Union, cast
 
+from aiohttp import ClientSession, TCPConnector
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.cosmos.aio import CosmosClient
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.keyvault.secrets.aio import SecretClient
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -31,12 +34,30 @@ from quart import (
 )
 from quart_cors import cors
 
-from approaches.approach import Approach
+from approaches.approach import VERBOSITY_LEVELS, Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.chatreadretrievereadvision import ChatReadRetrieveReadVisionApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.retrievethenreadvision import RetrieveThenReadVisionApproach
 from core.authentication import AuthenticationHelper
+from core.completioncache import ChatCompletionCache
+from core.conversationlogger import (
+    ConversationLogger,
+    ConversationSink,
+    CosmosConversationSink,
+    FileConversationSink,
+)
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
+from core.jsonhelper import JSONProvider, JSONSerializer, create_serializer
+from core.modelhelper import MODELS_2_TOKEN_LIMITS, preload_encodings
+from core.rewriteskip import RewriteSkipClassifier
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticCache
+from core.shutdown import close_all
+from core.singleflight import SingleFlight
+from core.streamcoalescer import StreamCoalescer
+from core.streamhelper import StreamStats, track_stream
 
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
@@ -49,6 +70,25 @@ CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_GPT4V_DEPLOYED = "gpt4v_deployed"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_CHAT_COMPLETION_CACHE = "chat_completion_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_EMBEDDING_BATCHER = "embedding_batcher"
+CONFIG_SEMANTIC_CACHE = "semantic_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_SINGLE_FLIGHT = "single_flight"
+CONFIG_REWRITE_SKIP_CLASSIFIER = "rewrite_skip_classifier"
+CONFIG_CONVERSATION_LOGGER = "conversation_logger"
+CONFIG_COSMOS_CLIENT = "cosmos_client"
+CONFIG_JSON_SERIALIZER = "json_serializer"
+CONFIG_STREAM_COALESCER = "stream_coalescer"
+CONFIG_STREAM_STATS = "stream_stats"
+CONFIG_SEARCH_INDEX_CLIENT = "search_index_client"
+CONFIG_BLOB_SERVICE_CLIENT = "blob_service_client"
+CONFIG_SSE_HEARTBEAT_INTERVAL = "sse_heartbeat_interval"
+CONFIG_SSE_IDLE_TIMEOUT = "sse_idle_timeout"
+CONFIG_SSE_MAX_DURATION = "sse_max_duration"
+CONFIG_ASK_BATCH_MAX_QUESTIONS = "ask_batch_max_questions"
+CONFIG_ASK_BATCH_CONCURRENCY = "ask_batch_concurrency"
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -139,27 +179,170 @@ async def ask():
         else:
             approach = cast(Approach, current_app.config[CONFIG_ASK_APPROACH])
         r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
+            request_json["messages"],
+            stream=request_json.get("stream", False),
+            context=context,
+            session_state=request_json.get("session_state"),
         )
-        return jsonify(r)
+        if isinstance(r, dict):
+            return await json_response(r)
+        else:
+            return await ndjson_response(wrap_stream(r))
     except Exception as error:
         return error_response(error, "/ask")
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return super().default(o)
+@bp.route("/ask/batch", methods=["POST"])
+async def ask_batch():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    questions = request_json.get("questions")
+    if not questions or not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+        return jsonify({"error": "questions must be a non-empty list of strings"}), 400
+    max_questions = current_app.config[CONFIG_ASK_BATCH_MAX_QUESTIONS]
+    if len(questions) > max_questions:
+        return jsonify({"error": f"a batch can have at most {max_questions} questions"}), 400
+    context = request_json.get("context", {})
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    try:
+        context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+        approach = cast(RetrieveThenReadApproach, current_app.config[CONFIG_ASK_APPROACH])
+        answers = approach.run_batch(
+            questions, context, max_concurrency=current_app.config[CONFIG_ASK_BATCH_CONCURRENCY]
+        )
+        return await ndjson_response(wrap_stream(format_batch_answers(answers)))
+    except Exception as error:
+        return error_response(error, "/ask/batch")
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_batch_answers(
+    answers: AsyncGenerator[tuple[int, Union[dict[str, Any], Exception]], None],
+) -> AsyncGenerator[dict, None]:
+    # Each answer is tagged with the index of its question, since they are sent in completion order
+    try:
+        async for index, answer in answers:
+            if isinstance(answer, Exception):
+                logging.error("Exception in /ask/batch for question %d: %s", index, answer, exc_info=answer)
+                yield {"index": index, **error_dict(answer)}
+            else:
+                yield {"index": index, **answer}
+    finally:
+        await answers.aclose()
+
+
+async def json_response(r: dict):
+    # Answers include the sources and thoughts, which are large enough to be worth encoding off the event loop.
+    # Keys are sorted, as jsonify does.
+    serializer: JSONSerializer = current_app.config[CONFIG_JSON_SERIALIZER]
+    return current_app.response_class(await serializer.dumps_async(r, sort_keys=True), mimetype="application/json")
+
+
+async def format_as_ndjson(
+    r: AsyncGenerator[dict, None], serializer: Optional[JSONSerializer] = None
+) -> AsyncGenerator[bytes, None]:
+    serializer = serializer or create_serializer()
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False, cls=JSONEncoder) + "\n"
+            choices = event.get("choices")
+            if choices and choices[0].get("context"):
+                # Events with a context carry the sources and thoughts, which can be large
+                yield await serializer.dumps_async(event) + b"\n"
+            else:
+                yield serializer.dumps(event) + b"\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps(error_dict(error))
+        yield serializer.dumps(error_dict(error))
+
+
+async def format_as_sse(
+    r: AsyncGenerator[dict, None],
+    serializer: Optional[JSONSerializer] = None,
+    heartbeat_interval: float = 15,
+    idle_timeout: float = 60,
+    max_duration: float = 300,
+) -> AsyncGenerator[bytes, None]:
+    """
+    Formats the events as Server-Sent Events. A comment line is sent when no event was sent for `heartbeat_interval`
+    seconds, so that proxies keep the connection open and broken connections are noticed. The stream ends with an
+    error event when no event arrives for `idle_timeout` seconds, or when it runs for longer than `max_duration`.
+    """
+    serializer = serializer or create_serializer()
+    iterator = r.__aiter__()
+    started = last_event = time.monotonic()
+    next_event: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(iterator.__anext__())
+            deadline = min(last_event + idle_timeout, started + max_duration)
+            await asyncio.wait({next_event}, timeout=max(min(heartbeat_interval, deadline - time.monotonic()), 0))
+            if not next_event.done():
+                if time.monotonic() >= deadline:
+                    logging.warning("Response stream timed out after %.1f seconds", time.monotonic() - started)
+                    yield b"event: error\ndata: " + serializer.dumps(error_dict(asyncio.TimeoutError())) + b"\n\n"
+                    break
+                yield b": heartbeat\n\n"
+                continue
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                next_event = None
+            last_event = time.monotonic()
+            choices = event.get("choices")
+            if choices and choices[0].get("context"):
+                data = await serializer.dumps_async(event)
+            else:
+                data = serializer.dumps(event)
+            yield b"data: " + data + b"\n\n"
+    except Exception as error:
+        logging.exception("Exception while generating response stream: %s", error)
+        yield b"event: error\ndata: " + serializer.dumps(error_dict(error)) + b"\n\n"
+    finally:
+        # Stop generating the answer when the stream times out or the client goes away
+        if next_event is not None:
+            next_event.cancel()
+            await asyncio.wait({next_event})
+        await r.aclose()
+
+
+async def ndjson_response(result: AsyncGenerator[dict, None]):
+    response = await make_response(format_as_ndjson(result, current_app.config[CONFIG_JSON_SERIALIZER]))
+    response.timeout = None  # type: ignore
+    response.mimetype = "application/json-lines"
+    return response
+
+
+async def run_chat_approach(request_json: dict[str, Any], stream: bool):
+    context = request_json.get("context", {})
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
+    approach: Approach
+    if use_gpt4v and CONFIG_CHAT_VISION_APPROACH in current_app.config:
+        approach = cast(Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
+    else:
+        approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
+
+    result = await approach.run(
+        request_json["messages"],
+        stream=stream,
+        context=context,
+        session_state=request_json.get("session_state"),
+    )
+    if isinstance(result, dict):
+        return result
+    return wrap_stream(result)
+
+
+def wrap_stream(result: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    # Quart cancels the response when the client disconnects, which also stops the upstream calls for this request
+    result = track_stream(result, current_app.config[CONFIG_STREAM_STATS])
+    if stream_coalescer := current_app.config[CONFIG_STREAM_COALESCER]:
+        result = stream_coalescer.coalesce(result)
+    return result
 
 
 @bp.route("/chat", methods=["POST"])
@@ -167,34 +350,43 @@ async def chat():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
-    context = request_json.get("context", {})
-    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     try:
-        context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
-        use_gpt4v = context.get("overrides", {}).get("use_gpt4v", False)
-        approach: Approach
-        if use_gpt4v and CONFIG_CHAT_VISION_APPROACH in current_app.config:
-            approach = cast(Approach, current_app.config[CONFIG_CHAT_VISION_APPROACH])
-        else:
-            approach = cast(Approach, current_app.config[CONFIG_CHAT_APPROACH])
-
-        result = await approach.run(
-            request_json["messages"],
-            stream=request_json.get("stream", False),
-            context=context,
-            session_state=request_json.get("session_state"),
-        )
+        result = await run_chat_approach(request_json, stream=request_json.get("stream", False))
         if isinstance(result, dict):
-            return jsonify(result)
+            return await json_response(result)
         else:
-            response = await make_response(format_as_ndjson(result))
-            response.timeout = None  # type: ignore
-            response.mimetype = "application/json-lines"
-            return response
+            return await ndjson_response(result)
     except Exception as error:
         return error_response(error, "/chat")
 
 
+@bp.route("/chat/stream", methods=["POST"])
+async def chat_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    try:
+        result = await run_chat_approach(request_json, stream=True)
+        response = await make_response(
+            format_as_sse(
+                result,
+                current_app.config[CONFIG_JSON_SERIALIZER],
+                heartbeat_interval=current_app.config[CONFIG_SSE_HEARTBEAT_INTERVAL],
+                idle_timeout=current_app.config[CONFIG_SSE_IDLE_TIMEOUT],
+                max_duration=current_app.config[CONFIG_SSE_MAX_DURATION],
+            )
+        )
+        # The stream enforces its own idle and total timeouts
+        response.timeout = None  # type: ignore
+        response.mimetype = "text/event-stream"
+        response.headers["Cache-Control"] = "no-cache"
+        # Ask reverse proxies such as nginx not to buffer the stream
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
+    except Exception as error:
+        return error_response(error, "/chat/stream")
+
+
 # Send MSAL.js settings to the client UI
 @bp.route("/auth_setup", methods=["GET"])
 def auth_setup():
@@ -220,12 +412,15 @@ async def setup_clients():
     OPENAI_HOST = os.getenv("OPENAI_HOST", "azure")
     OPENAI_CHATGPT_MODEL = os.environ["AZURE_OPENAI_CHATGPT_MODEL"]
     OPENAI_EMB_MODEL = os.getenv("AZURE_OPENAI_EMB_MODEL_NAME", "text-embedding-ada-002")
+    # A smaller, faster model for the chat query rewrite and follow-up questions, the answer model is used when unset
+    OPENAI_UTILITY_MODEL = os.getenv("AZURE_OPENAI_UTILITY_MODEL")
     # Used with Azure OpenAI deployments
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_GPT4V_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT4V_DEPLOYMENT")
     AZURE_OPENAI_GPT4V_MODEL = os.environ.get("AZURE_OPENAI_GPT4V_MODEL")
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT") if OPENAI_HOST == "azure" else None
     AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST == "azure" else None
+    AZURE_OPENAI_UTILITY_DEPLOYMENT = os.getenv("AZURE_OPENAI_UTILITY_DEPLOYMENT") if OPENAI_HOST == "azure" else None
     AZURE_VISION_ENDPOINT = os.getenv("AZURE_VISION_ENDPOINT", "")
     # Used only with non-Azure OpenAI deployments
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -247,6 +442,84 @@ async def setup_clients():
 
     USE_GPT4V = os.getenv("USE_GPT4V", "").lower() == "true"
 
+    # Memoizes deterministic (temperature 0) chat completions, like the search query rewrite
+    USE_CHAT_COMPLETION_CACHE = os.getenv("USE_CHAT_COMPLETION_CACHE", "").lower() == "true"
+    CHAT_COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_COMPLETION_CACHE_MAX_ENTRIES", "1024"))
+    CHAT_COMPLETION_CACHE_MAX_BYTES = int(os.getenv("CHAT_COMPLETION_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    CHAT_COMPLETION_CACHE_TTL = float(os.getenv("CHAT_COMPLETION_CACHE_TTL", "3600"))
+    # Caches query embeddings from OpenAI and the Vision vectorizeText endpoint
+    USE_EMBEDDING_CACHE = os.getenv("USE_EMBEDDING_CACHE", "").lower() == "true"
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096"))
+    EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+    # Query embeddings of concurrent requests are sent in one call per window, 0 sends one call per query
+    EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "0"))
+    EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "16"))
+    # Answers first-turn /chat and /ask questions that are close paraphrases of an earlier question from the cache
+    USE_SEMANTIC_CACHE = os.getenv("USE_SEMANTIC_CACHE", "").lower() == "true"
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1024"))
+    SEMANTIC_CACHE_MAX_BYTES = int(os.getenv("SEMANTIC_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    # Caches search results, and clears them when the index statistics change (e.g. after re-ingestion)
+    USE_SEARCH_CACHE = os.getenv("USE_SEARCH_CACHE", "").lower() == "true"
+    SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1024"))
+    SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+    SEARCH_CACHE_INDEX_CHECK_INTERVAL = float(os.getenv("SEARCH_CACHE_INDEX_CHECK_INTERVAL", "60"))
+    # Identical first-turn chat questions asked at the same time share one search and answer
+    USE_SINGLE_FLIGHT = os.getenv("USE_SINGLE_FLIGHT", "").lower() == "true"
+    # First-turn chat questions are searched while the search query is rewritten
+    USE_SPECULATIVE_RETRIEVAL = os.getenv("USE_SPECULATIVE_RETRIEVAL", "").lower() == "true"
+    # Short standalone first-turn chat questions are searched as they are, without the query rewrite
+    USE_REWRITE_SKIP = os.getenv("USE_REWRITE_SKIP", "").lower() == "true"
+    REWRITE_SKIP_MAX_WORDS = int(os.getenv("REWRITE_SKIP_MAX_WORDS", "12"))
+    # Chat follow-up questions are generated by the utility model while the answer is generated
+    USE_UTILITY_FOLLOWUP_QUESTIONS = os.getenv("USE_UTILITY_FOLLOWUP_QUESTIONS", "").lower() == "true"
+    # Where chat turns are logged: "cosmos", "file" (JSON lines, for local development) or "none"
+    CONVERSATION_LOG_SINK = os.getenv("CONVERSATION_LOG_SINK", "cosmos").lower()
+    CONVERSATION_LOG_FILE = os.getenv("CONVERSATION_LOG_FILE", "conversations.jsonl")
+    CONVERSATION_LOG_MAX_QUEUE_SIZE = int(os.getenv("CONVERSATION_LOG_MAX_QUEUE_SIZE", "1000"))
+    CONVERSATION_LOG_BATCH_SIZE = int(os.getenv("CONVERSATION_LOG_BATCH_SIZE", "25"))
+    CONVERSATION_LOG_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_LOG_FLUSH_INTERVAL", "1"))
+    CONVERSATION_LOG_DRAIN_TIMEOUT = float(os.getenv("CONVERSATION_LOG_DRAIN_TIMEOUT", "10"))
+    AZURE_COSMOSDB_ACCOUNT = os.getenv("AZURE_COSMOSDB_ACCOUNT")
+    AZURE_COSMOSDB_DATABASE = os.getenv("AZURE_COSMOSDB_DATABASE", "db_conversation_history")
+    AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.getenv("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER", "conversations")
+    AZURE_COSMOSDB_ACCOUNT_KEY = os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY")
+    AZURE_COSMOSDB_MAX_CONNECTIONS = int(os.getenv("AZURE_COSMOSDB_MAX_CONNECTIONS", "10"))
+    AZURE_COSMOSDB_CONNECTION_TIMEOUT = int(os.getenv("AZURE_COSMOSDB_CONNECTION_TIMEOUT", "30"))
+    # Directory with the bundled tokenizer files, read by tiktoken itself
+    TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR")
+
+    # Streamed answer deltas are merged into one frame per window, 0 sends every delta as its own frame
+    STREAM_COALESCE_WINDOW_MS = float(os.getenv("STREAM_COALESCE_WINDOW_MS", "0"))
+    STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", "256"))
+
+    SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+    SSE_IDLE_TIMEOUT = float(os.getenv("SSE_IDLE_TIMEOUT", "60"))
+    SSE_MAX_DURATION = float(os.getenv("SSE_MAX_DURATION", "300"))
+    ASK_BATCH_MAX_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "500"))
+    # How many questions of a batch are searched and answered at once
+    ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))
+    # How much detail is returned with each answer by default: "none", "citations" or "full".
+    # Clients can pick another level with the "verbosity" override, up to the maximum
+    RESPONSE_VERBOSITY = os.getenv("RESPONSE_VERBOSITY", "full")
+    RESPONSE_MAX_VERBOSITY = os.getenv("RESPONSE_MAX_VERBOSITY", "full")
+    for verbosity in (RESPONSE_VERBOSITY, RESPONSE_MAX_VERBOSITY):
+        if verbosity not in VERBOSITY_LEVELS:
+            raise ValueError(f"Unknown response verbosity: {verbosity}, must be one of {VERBOSITY_LEVELS}")
+
+    # Load the tokenizers now rather than on the first request of each worker.
+    # When TIKTOKEN_CACHE_DIR is set the tokenizer files are bundled with the app, and the app won't start without them.
+    if TIKTOKEN_CACHE_DIR:
+        preload_encodings(MODELS_2_TOKEN_LIMITS, TIKTOKEN_CACHE_DIR)
+    else:
+        try:
+            preload_encodings(MODELS_2_TOKEN_LIMITS)
+        except Exception as error:
+            logging.warning("Unable to preload the tokenizers, they will be loaded on first use: %s", error)
+
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
     # keys for each service
@@ -268,6 +541,30 @@ async def setup_clients():
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
+    # Set up the Cosmos DB client, only when the conversation log is written to Cosmos DB
+    cosmos_client = None
+    conversations_container_client = None
+    if CONVERSATION_LOG_SINK == "cosmos" and AZURE_COSMOSDB_ACCOUNT_KEY:
+        if not AZURE_COSMOSDB_ACCOUNT:
+            raise ValueError("AZURE_COSMOSDB_ACCOUNT must be set to write the conversation log to Cosmos DB.")
+        cosmos_client = CosmosClient(
+            f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/",
+            credential=AZURE_COSMOSDB_ACCOUNT_KEY,
+            connection_timeout=AZURE_COSMOSDB_CONNECTION_TIMEOUT,
+            transport=AioHttpTransport(
+                session=ClientSession(connector=TCPConnector(limit=AZURE_COSMOSDB_MAX_CONNECTIONS)),
+                session_owner=True,
+            ),
+        )
+        conversations_container_client = cosmos_client.get_database_client(
+            AZURE_COSMOSDB_DATABASE
+        ).get_container_client(AZURE_COSMOSDB_CONVERSATIONS_CONTAINER)
+        try:
+            # Open a connection and fetch the account metadata now, rather than on the first logged turn
+            await conversations_container_client.read()
+        except Exception as error:
+            logging.warning("Unable to connect to the Cosmos DB conversations container: %s", error)
+
     # Set up authentication helper
     auth_helper = AuthenticationHelper(
         search_index=(await search_index_client.get_index(AZURE_SEARCH_INDEX)) if AZURE_USE_AUTHENTICATION else None,
@@ -305,13 +602,109 @@ async def setup_clients():
             organization=OPENAI_ORGANIZATION,
         )
 
+    current_app.config[CONFIG_CREDENTIAL] = azure_credential
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
+    current_app.config[CONFIG_SEARCH_INDEX_CLIENT] = search_index_client
+    current_app.config[CONFIG_BLOB_SERVICE_CLIENT] = blob_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
 
     current_app.config[CONFIG_GPT4V_DEPLOYED] = bool(USE_GPT4V)
 
+    chat_completion_cache = (
+        ChatCompletionCache(
+            max_entries=CHAT_COMPLETION_CACHE_MAX_ENTRIES,
+            max_bytes=CHAT_COMPLETION_CACHE_MAX_BYTES,
+            ttl=CHAT_COMPLETION_CACHE_TTL,
+        )
+        if USE_CHAT_COMPLETION_CACHE
+        else None
+    )
+    current_app.config[CONFIG_CHAT_COMPLETION_CACHE] = chat_completion_cache
+    embedding_cache = (
+        EmbeddingCache(
+            max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+            max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+            ttl=EMBEDDING_CACHE_TTL,
+        )
+        if USE_EMBEDDING_CACHE
+        else None
+    )
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    embedding_batcher = (
+        EmbeddingBatcher(
+            openai_client, max_batch_size=EMBEDDING_BATCH_MAX_SIZE, window=EMBEDDING_BATCH_WINDOW_MS / 1000
+        )
+        if EMBEDDING_BATCH_WINDOW_MS > 0
+        else None
+    )
+    current_app.config[CONFIG_EMBEDDING_BATCHER] = embedding_batcher
+    semantic_cache = (
+        SemanticCache(
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            max_bytes=SEMANTIC_CACHE_MAX_BYTES,
+            ttl=SEMANTIC_CACHE_TTL,
+        )
+        if USE_SEMANTIC_CACHE
+        else None
+    )
+    current_app.config[CONFIG_SEMANTIC_CACHE] = semantic_cache
+
+    async def get_search_index_version():
+        statistics = await search_index_client.get_index_statistics(AZURE_SEARCH_INDEX)
+        return (statistics.get("document_count"), statistics.get("storage_size"))
+
+    search_cache = (
+        SearchCache(
+            index_name=AZURE_SEARCH_INDEX,
+            max_entries=SEARCH_CACHE_MAX_ENTRIES,
+            max_bytes=SEARCH_CACHE_MAX_BYTES,
+            ttl=SEARCH_CACHE_TTL,
+            get_index_version=get_search_index_version,
+            check_interval=SEARCH_CACHE_INDEX_CHECK_INTERVAL,
+        )
+        if USE_SEARCH_CACHE
+        else None
+    )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+    single_flight = SingleFlight() if USE_SINGLE_FLIGHT else None
+    current_app.config[CONFIG_SINGLE_FLIGHT] = single_flight
+    rewrite_skip_classifier = RewriteSkipClassifier(max_words=REWRITE_SKIP_MAX_WORDS) if USE_REWRITE_SKIP else None
+    current_app.config[CONFIG_REWRITE_SKIP_CLASSIFIER] = rewrite_skip_classifier
+
+    current_app.config[CONFIG_COSMOS_CLIENT] = cosmos_client
+
+    conversation_sink: Optional[ConversationSink] = None
+    if conversations_container_client is not None:
+        conversation_sink = CosmosConversationSink(conversations_container_client)
+    elif CONVERSATION_LOG_SINK == "file":
+        conversation_sink = FileConversationSink(CONVERSATION_LOG_FILE)
+    conversation_logger = None
+    if conversation_sink is not None:
+        conversation_logger = ConversationLogger(
+            conversation_sink,
+            max_queue_size=CONVERSATION_LOG_MAX_QUEUE_SIZE,
+            batch_size=CONVERSATION_LOG_BATCH_SIZE,
+            flush_interval=CONVERSATION_LOG_FLUSH_INTERVAL,
+            drain_timeout=CONVERSATION_LOG_DRAIN_TIMEOUT,
+        )
+        conversation_logger.start()
+    current_app.config[CONFIG_CONVERSATION_LOGGER] = conversation_logger
+
+    current_app.config[CONFIG_STREAM_COALESCER] = (
+        StreamCoalescer(window=STREAM_COALESCE_WINDOW_MS / 1000, max_chars=STREAM_COALESCE_MAX_CHARS)
+        if STREAM_COALESCE_WINDOW_MS > 0
+        else None
+    )
+    current_app.config[CONFIG_STREAM_STATS] = StreamStats()
+    current_app.config[CONFIG_SSE_HEARTBEAT_INTERVAL] = SSE_HEARTBEAT_INTERVAL
+    current_app.config[CONFIG_SSE_IDLE_TIMEOUT] = SSE_IDLE_TIMEOUT
+    current_app.config[CONFIG_SSE_MAX_DURATION] = SSE_MAX_DURATION
+    current_app.config[CONFIG_ASK_BATCH_MAX_QUESTIONS] = ASK_BATCH_MAX_QUESTIONS
+    current_app.config[CONFIG_ASK_BATCH_CONCURRENCY] = ASK_BATCH_CONCURRENCY
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -326,6 +719,13 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        chat_completion_cache=chat_completion_cache,
+        embedding_cache=embedding_cache,
+        embedding_batcher=embedding_batcher,
+        semantic_cache=semantic_cache,
+        search_cache=search_cache,
+        default_verbosity=RESPONSE_VERBOSITY,
+        max_verbosity=RESPONSE_MAX_VERBOSITY,
     )
 
     if USE_GPT4V:
@@ -347,6 +747,12 @@ async def setup_clients():
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            chat_completion_cache=chat_completion_cache,
+            embedding_cache=embedding_cache,
+            embedding_batcher=embedding_batcher,
+            search_cache=search_cache,
+            default_verbosity=RESPONSE_VERBOSITY,
+            max_verbosity=RESPONSE_MAX_VERBOSITY,
         )
 
         current_app.config[CONFIG_CHAT_VISION_APPROACH] = ChatReadRetrieveReadVisionApproach(
@@ -358,12 +764,23 @@ async def setup_clients():
             vision_key=vision_key,
             gpt4v_deployment=AZURE_OPENAI_GPT4V_DEPLOYMENT,
             gpt4v_model=AZURE_OPENAI_GPT4V_MODEL,
+            utility_model=OPENAI_UTILITY_MODEL,
+            utility_deployment=AZURE_OPENAI_UTILITY_DEPLOYMENT,
+            utility_followup_questions=USE_UTILITY_FOLLOWUP_QUESTIONS,
             embedding_model=OPENAI_EMB_MODEL,
             embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
             sourcepage_field=KB_FIELDS_SOURCEPAGE,
             content_field=KB_FIELDS_CONTENT,
             query_language=AZURE_SEARCH_QUERY_LANGUAGE,
             query_speller=AZURE_SEARCH_QUERY_SPELLER,
+            chat_completion_cache=chat_completion_cache,
+            embedding_cache=embedding_cache,
+            embedding_batcher=embedding_batcher,
+            search_cache=search_cache,
+            conversation_logger=conversation_logger,
+            single_flight=single_flight,
+            default_verbosity=RESPONSE_VERBOSITY,
+            max_verbosity=RESPONSE_MAX_VERBOSITY,
         )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -372,25 +789,72 @@ async def setup_clients():
         auth_helper=auth_helper,
         chatgpt_model=OPENAI_CHATGPT_MODEL,
         chatgpt_deployment=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+        utility_model=OPENAI_UTILITY_MODEL,
+        utility_deployment=AZURE_OPENAI_UTILITY_DEPLOYMENT,
+        utility_followup_questions=USE_UTILITY_FOLLOWUP_QUESTIONS,
         embedding_model=OPENAI_EMB_MODEL,
         embedding_deployment=AZURE_OPENAI_EMB_DEPLOYMENT,
         sourcepage_field=KB_FIELDS_SOURCEPAGE,
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        chat_completion_cache=chat_completion_cache,
+        embedding_cache=embedding_cache,
+        embedding_batcher=embedding_batcher,
+        semantic_cache=semantic_cache,
+        search_cache=search_cache,
+        conversation_logger=conversation_logger,
+        single_flight=single_flight,
+        speculative_retrieval=USE_SPECULATIVE_RETRIEVAL,
+        rewrite_skip_classifier=rewrite_skip_classifier,
+        default_verbosity=RESPONSE_VERBOSITY,
+        max_verbosity=RESPONSE_MAX_VERBOSITY,
     )
 
 
 @bp.after_app_serving
 async def close_clients():
-    await current_app.config[CONFIG_SEARCH_CLIENT].close()
-    await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    # Gunicorn's worker lets the answers in flight finish, or cancels them, before this runs (see gunicorn.conf.py)
+    if chat_completion_cache := current_app.config.get(CONFIG_CHAT_COMPLETION_CACHE):
+        logging.info("Chat completion cache stats: %s", chat_completion_cache.stats.as_dict())
+    if embedding_cache := current_app.config.get(CONFIG_EMBEDDING_CACHE):
+        logging.info("Embedding cache stats: %s", embedding_cache.stats.as_dict())
+    if embedding_batcher := current_app.config.get(CONFIG_EMBEDDING_BATCHER):
+        logging.info("Embedding batcher stats: %s", embedding_batcher.stats.as_dict())
+    if (semantic_cache := current_app.config.get(CONFIG_SEMANTIC_CACHE)) is not None:
+        logging.info("Semantic cache stats: %s", semantic_cache.stats.as_dict())
+    if search_cache := current_app.config.get(CONFIG_SEARCH_CACHE):
+        logging.info("Search cache stats: %s", search_cache.stats.as_dict())
+    if single_flight := current_app.config.get(CONFIG_SINGLE_FLIGHT):
+        logging.info("Single-flight stats: %s", single_flight.stats.as_dict())
+    if rewrite_skip_classifier := current_app.config.get(CONFIG_REWRITE_SKIP_CLASSIFIER):
+        logging.info("Query rewrite skip stats: %s", rewrite_skip_classifier.stats.as_dict())
+    if stream_stats := current_app.config.get(CONFIG_STREAM_STATS):
+        logging.info("Chat stream stats: %s", stream_stats.as_dict())
+    if conversation_logger := current_app.config.get(CONFIG_CONVERSATION_LOGGER):
+        await conversation_logger.close()
+        logging.info("Conversation logger stats: %s", conversation_logger.stats.as_dict())
+    await close_all(
+        current_app.config[CONFIG_SEARCH_CLIENT],
+        current_app.config.get(CONFIG_SEARCH_INDEX_CLIENT),
+        current_app.config[CONFIG_BLOB_CONTAINER_CLIENT],
+        current_app.config.get(CONFIG_BLOB_SERVICE_CLIENT),
+        current_app.config.get(CONFIG_COSMOS_CLIENT),
+        current_app.config.get(CONFIG_OPENAI_CLIENT),
+        # Last, since the other clients get their tokens from it
+        current_app.config.get(CONFIG_CREDENTIAL),
+    )
 
 
 def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
 
+    # "orjson" or "json", by default orjson is used when it is installed
+    json_serializer = create_serializer(os.getenv("JSON_SERIALIZER"))
+    app.config[CONFIG_JSON_SERIALIZER] = json_serializer
+    app.json = JSONProvider(app, json_serializer)
+
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
         configure_azure_monitor()
         # This tracks HTTP requests made by aiohttp:
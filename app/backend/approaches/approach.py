@@ -1,8 +1,9 @@
 import os
 from dataclasses import dataclass
-from typing import Any, AsyncGenerator, List, Optional, Union, cast
+from typing import Any, AsyncGenerator, Callable, Coroutine, List, Optional, Union, cast
 
 import aiohttp
+import numpy as np
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import (
     CaptionResult,
@@ -13,6 +14,12 @@ from azure.search.documents.models import (
 from openai import AsyncOpenAI
 
 from core.authentication import AuthenticationHelper
+from core.completioncache import ChatCompletionCache
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
+from core.searchcache import SearchCache, SearchRecord
+from core.semanticcache import SemanticCache
+from core.streamhelper import close_stream
 from text import nonewlines
 
 
@@ -52,6 +59,46 @@ class Document:
             else [],
         }
 
+    def to_record(self) -> SearchRecord:
+        """Returns a compact tuple of the fields, with the embeddings stored as float32 arrays."""
+        return (
+            self.id,
+            self.content,
+            Document.compact_embedding(self.embedding),
+            Document.compact_embedding(self.image_embedding),
+            self.category,
+            self.sourcepage,
+            self.sourcefile,
+            self.oids,
+            self.groups,
+            self.captions,
+        )
+
+    @classmethod
+    def from_record(cls, record: SearchRecord) -> "Document":
+        id, content, embedding, image_embedding, category, sourcepage, sourcefile, oids, groups, captions = record
+        return cls(
+            id=id,
+            content=content,
+            embedding=embedding.tolist() if isinstance(embedding, np.ndarray) else embedding,
+            image_embedding=image_embedding.tolist() if isinstance(image_embedding, np.ndarray) else image_embedding,
+            category=category,
+            sourcepage=sourcepage,
+            sourcefile=sourcefile,
+            oids=oids,
+            groups=groups,
+            captions=list(captions) if captions else captions,
+        )
+
+    @classmethod
+    def compact_embedding(cls, embedding: Optional[List[float]]) -> Any:
+        if not embedding:
+            return embedding
+        try:
+            return np.asarray(embedding, dtype=np.float32)
+        except (TypeError, ValueError):
+            return embedding
+
     @classmethod
     def trim_embedding(cls, embedding: Optional[List[float]]) -> Optional[str]:
         """Returns a trimmed list of floats from the vector embedding."""
@@ -72,7 +119,23 @@ class ThoughtStep:
     props: Optional[dict[str, Any]] = None
 
 
+# How much detail is returned along with each answer, from least to most:
+# "none" returns neither the sources nor the thoughts, "citations" returns the sources,
+# and "full" also returns the thought process (search queries, results and prompts)
+VERBOSITY_LEVELS = ["none", "citations", "full"]
+
+
 class Approach:
+    chat_completion_cache: Optional[ChatCompletionCache] = None
+    embedding_cache: Optional[EmbeddingCache] = None
+    embedding_batcher: Optional[EmbeddingBatcher] = None
+    semantic_cache: Optional[SemanticCache] = None
+    search_cache: Optional[SearchCache] = None
+    default_verbosity = "full"
+    max_verbosity = "full"
+    # Some embedding deployments accept at most 16 inputs per call
+    embedding_batch_size = 16
+
     def __init__(
         self,
         search_client: SearchClient,
@@ -83,6 +146,13 @@ class Approach:
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         openai_host: str,
+        chat_completion_cache: Optional[ChatCompletionCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        default_verbosity: str = "full",
+        max_verbosity: str = "full",
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -92,6 +162,13 @@ class Approach:
         self.embedding_deployment = embedding_deployment
         self.embedding_model = embedding_model
         self.openai_host = openai_host
+        self.chat_completion_cache = chat_completion_cache
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.semantic_cache = semantic_cache
+        self.search_cache = search_cache
+        self.default_verbosity = default_verbosity
+        self.max_verbosity = max_verbosity
 
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
 
@@ -183,6 +260,22 @@ class Approach:
         use_semantic_ranker: bool,
         use_semantic_captions: bool,
     ) -> List[Document]:
+        cache_key = None
+        if self.search_cache is not None:
+            await self.search_cache.ensure_fresh()
+            cache_key = self.search_cache.make_key(
+                top,
+                query_text,
+                filter,
+                vectors,
+                use_semantic_ranker,
+                use_semantic_captions,
+                self.query_language,
+                self.query_speller,
+            )
+            if (records := self.search_cache.get(cache_key)) is not None:
+                return [Document.from_record(record) for record in records]
+
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
         if use_semantic_ranker and query_text:
             results = await self.search_client.search(
@@ -219,6 +312,8 @@ class Approach:
                         captions=cast(List[CaptionResult], document.get("@search.captions")),
                     )
                 )
+        if self.search_cache is not None and cache_key is not None:
+            self.search_cache.set(cache_key, [document.to_record() for document in documents])
         return documents
 
     def get_sources_content(
@@ -249,29 +344,240 @@ class Approach:
 
             return sourcepage
 
+    async def create_chat_completion(self, **params: Any) -> Any:
+        """
+        Calls `openai_client.chat.completions.create`, going through the chat completion cache when one is configured.
+        Calling this without awaiting returns a coroutine, just like the OpenAI client does.
+        """
+        if self.chat_completion_cache is not None:
+            return await self.chat_completion_cache.create(self.openai_client, **params)
+        return await self.openai_client.chat.completions.create(**params)
+
     async def compute_text_embedding(self, q: str):
-        embedding = await self.openai_client.embeddings.create(
-            # Azure Open AI takes the deployment name as the model name
-            model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-            input=q,
-        )
-        query_vector = embedding.data[0].embedding
+        # Azure Open AI takes the deployment name as the model name
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        query_vector = self.embedding_cache.get(model, q) if self.embedding_cache is not None else None
+        if query_vector is None:
+            if self.embedding_batcher is not None:
+                # Batched with the embeddings requested at the same time by other requests
+                query_vector = await self.embedding_batcher.embed(model, q)
+            else:
+                embedding = await self.openai_client.embeddings.create(model=model, input=q)
+                query_vector = embedding.data[0].embedding
+            if self.embedding_cache is not None:
+                self.embedding_cache.set(model, q, query_vector)
         return RawVectorQuery(vector=query_vector, k=50, fields="embedding")
 
+    async def compute_text_embeddings(self, qs: list[str]) -> list[RawVectorQuery]:
+        """
+        Computes the embeddings of several queries, with one embeddings call per `embedding_batch_size` distinct queries
+        that aren't in the embedding cache.
+        """
+        model = self.embedding_deployment if self.embedding_deployment else self.embedding_model
+        query_vectors: dict[str, Optional[list[float]]] = {
+            q: self.embedding_cache.get(model, q) if self.embedding_cache is not None else None for q in qs
+        }
+        missing = [q for q, query_vector in query_vectors.items() if query_vector is None]
+        for start in range(0, len(missing), self.embedding_batch_size):
+            batch = missing[start : start + self.embedding_batch_size]
+            embedding = await self.openai_client.embeddings.create(model=model, input=batch)
+            for data in embedding.data:
+                query_vectors[batch[data.index]] = data.embedding
+                if self.embedding_cache is not None:
+                    self.embedding_cache.set(model, batch[data.index], data.embedding)
+        return [RawVectorQuery(vector=query_vectors[q], k=50, fields="embedding") for q in qs]
+
     async def compute_image_embedding(self, q: str, vision_endpoint: str, vision_key: str):
         endpoint = f"{vision_endpoint}computervision/retrieval:vectorizeText"
-        params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
-        headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": vision_key}
-        data = {"text": q}
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
-            ) as response:
-                json = await response.json()
-                image_query_vector = json["vector"]
+        image_query_vector = self.embedding_cache.get(endpoint, q) if self.embedding_cache is not None else None
+        if image_query_vector is None:
+            params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
+            headers = {"Content-Type": "application/json", "Ocp-Apim-Subscription-Key": vision_key}
+            data = {"text": q}
+
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    url=endpoint, params=params, headers=headers, json=data, raise_for_status=True
+                ) as response:
+                    json = await response.json()
+                    image_query_vector = json["vector"]
+            if self.embedding_cache is not None:
+                self.embedding_cache.set(endpoint, q, image_query_vector)
         return RawVectorQuery(vector=image_query_vector, k=50, fields="imageEmbedding")
 
+    async def get_semantic_cache_key(
+        self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> tuple[int, list[float]]:
+        """
+        Returns the semantic cache partition and query vector for a question.
+        Answers are only shared between requests with the same search filter, security claims and overrides.
+        """
+        partition = SemanticCache.partition_id(
+            type(self).__name__,
+            self.build_filter(overrides, auth_claims),
+            auth_claims.get("oids"),
+            auth_claims.get("groups"),
+            overrides,
+        )
+        query_vector = (await self.compute_text_embedding(q)).vector
+        return partition, query_vector
+
+    def get_verbosity(self, overrides: dict[str, Any]) -> str:
+        """
+        Returns the verbosity requested with the "verbosity" override, or the default one, capped at `max_verbosity`.
+        """
+        verbosity = overrides.get("verbosity") or self.default_verbosity
+        if verbosity not in VERBOSITY_LEVELS:
+            verbosity = self.default_verbosity
+        return min(verbosity, self.max_verbosity, key=VERBOSITY_LEVELS.index)
+
+    def build_context(
+        self,
+        overrides: dict[str, Any],
+        data_points: dict[str, Any],
+        get_thoughts: Callable[[], list[ThoughtStep]],
+        **extra: Any,
+    ) -> dict[str, Any]:
+        """
+        Returns the context sent along with an answer, with as much detail as the verbosity allows.
+        The thoughts repeat the prompts and results, so they are only built when they are returned.
+        """
+        verbosity = self.get_verbosity(overrides)
+        context = {**extra, "data_points": data_points if verbosity != "none" else {"text": []}}
+        if verbosity == "full":
+            context["thoughts"] = get_thoughts()
+        return context
+
+    def lookup_semantic_cache(
+        self, partition: int, query_vector: list[float], session_state: Any, overrides: dict[str, Any] = {}
+    ) -> Optional[dict[str, Any]]:
+        if self.semantic_cache is None:
+            return None
+        cached = self.semantic_cache.lookup(partition, query_vector)
+        if cached is None:
+            return None
+        payload, similarity = cached
+        context = payload["context"]
+        if self.get_verbosity(overrides) == "full":
+            context["thoughts"] = [
+                ThoughtStep("Semantic cache hit", payload["question"], {"similarity": round(similarity, 4)})
+            ]
+        return {
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": payload["content"]},
+                    "finish_reason": "stop",
+                    "context": context,
+                    "session_state": session_state,
+                }
+            ],
+            "object": "chat.completion",
+        }
+
+    def store_semantic_cache(
+        self, partition: int, query_vector: list[float], q: str, content: str, context: dict[str, Any]
+    ) -> None:
+        if self.semantic_cache is None:
+            return
+        self.semantic_cache.store(
+            partition,
+            query_vector,
+            {
+                "question": q,
+                "content": content,
+                # Thoughts describe how the original answer was produced, so they aren't replayed
+                "context": {key: value for key, value in context.items() if key != "thoughts"},
+            },
+        )
+
+    def make_context_event(self, context: dict[str, Any], session_state: Any) -> dict[str, Any]:
+        """Returns the first event of a streamed answer, with the sources and thoughts."""
+        return {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": context,
+                    "session_state": session_state,
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    def make_progress_event(self, stage: str) -> dict[str, Any]:
+        """
+        Returns a stream event that reports a retrieval step ("rewriting", "searching") before the sources are ready.
+        The stage is sent outside of the context, which clients only start from the event with the sources.
+        """
+        return {
+            "choices": [{"delta": {"role": "assistant"}, "progress": stage, "finish_reason": None, "index": 0}],
+            "object": "chat.completion.chunk",
+        }
+
+    def make_delta_event(self, content: str, finish_reason: Optional[str] = None) -> dict[str, Any]:
+        """Returns a compact stream event with the answer content, in the format of a chat completion chunk."""
+        return {
+            "choices": [{"delta": {"content": content}, "finish_reason": finish_reason, "index": 0}],
+            "object": "chat.completion.chunk",
+        }
+
+    def make_followup_questions_event(self, followup_questions: list[str]) -> dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": {"followup_questions": followup_questions},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+    async def stream_answer(
+        self, context: dict[str, Any], session_state: Any, chat_coroutine: Coroutine[Any, Any, Any]
+    ) -> AsyncGenerator[dict, None]:
+        """
+        Streams a chat completion in the same events as /chat: the context first, then the answer deltas.
+        """
+        yield self.make_context_event(context, session_state)
+        chat_stream = await chat_coroutine
+        try:
+            async for event_chunk in chat_stream:
+                # "2023-07-01-preview" API version has a bug where first response has empty choices
+                if not event_chunk.choices:
+                    continue
+                choice = event_chunk.choices[0]
+                content = choice.delta.content or ""
+                if content or choice.finish_reason is not None:
+                    yield self.make_delta_event(content, choice.finish_reason)
+        finally:
+            await close_stream(chat_stream)
+
+    async def replay_semantic_cache_hit(self, chat_resp: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        choice = chat_resp["choices"][0]
+        context = choice["context"]
+        followup_questions = context.pop("followup_questions", None)
+        yield self.make_context_event(context, choice["session_state"])
+        yield self.make_delta_event(choice["message"]["content"])
+        if followup_questions:
+            yield self.make_followup_questions_event(followup_questions)
+
+    async def store_streamed_answer(
+        self, result: AsyncGenerator[dict, None], partition: int, query_vector: list[float], q: str
+    ) -> AsyncGenerator[dict, None]:
+        content = ""
+        context: dict[str, Any] = {}
+        async for event in result:
+            if event["choices"]:
+                context.update(event["choices"][0].get("context") or {})
+                content += event["choices"][0]["delta"].get("content") or ""
+            yield event
+        # Only reached when the whole stream was generated without errors
+        self.store_semantic_cache(partition, query_vector, q, content, context)
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
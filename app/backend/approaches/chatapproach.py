@@ -1,57 +1,36 @@
+import asyncio
 import json
 import logging
 import re
+import uuid
 from abc import ABC, abstractmethod
-from typing import Any, AsyncGenerator, Optional, Union
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterable,
+    Callable,
+    Coroutine,
+    Optional,
+    Union,
+)
 
 from openai.types.chat import (
     ChatCompletion,
+    ChatCompletionChunk,
     ChatCompletionContentPartParam,
     ChatCompletionMessageParam,
 )
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
 
 from approaches.approach import Approach
+from core.cache import hash_key
+from core.conversationlogger import ConversationLogger
+from core.followupparser import FollowupQuestionParser
 from core.messagebuilder import MessageBuilder
-from azure.cosmos.aio import CosmosClient
-from azure.cosmos import exceptions
-import uuid
-from datetime import datetime
-import os
-
-AZURE_COSMOSDB_ACCOUNT="db-temp-testingauth"
-AZURE_COSMOSDB_DATABASE="db_conversation_history"
-AZURE_COSMOSDB_CONVERSATIONS_CONTAINER="conversations"
-AZURE_COSMOSDB_ACCOUNT_KEY = os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY")
-
-try:
-    cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
-    credential = AZURE_COSMOSDB_ACCOUNT_KEY
-    database_name=AZURE_COSMOSDB_DATABASE
-    container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
-        
-except Exception as e:
-    raise ValueError("Exception in CosmosDB initialization", e)
-    cosmos_endpoint = None
-    raise e
-
-try:
-    cosmosdb_client = CosmosClient(cosmos_endpoint, credential=credential)
-except exceptions.CosmosHttpResponseError as e:
-    if e.status_code == 401:
-        raise ValueError("Invalid credentials") from e
-    else:
-        raise ValueError("Invalid CosmosDB endpoint") from e
-
-try:
-    database_client = cosmosdb_client.get_database_client(database_name)
-except exceptions.CosmosResourceNotFoundError:
-    raise ValueError("Invalid CosmosDB database name") 
- 
-
-try:
-    container_client = database_client.get_container_client(container_name)
-except exceptions.CosmosResourceNotFoundError:
-    raise ValueError("Invalid CosmosDB container name") 
+from core.singleflight import SingleFlight
+from core.streamhelper import close_stream
+
 
 class ChatApproach(Approach, ABC):
     # Chat roles
@@ -69,6 +48,14 @@ class ChatApproach(Approach, ABC):
     ]
     NO_RESPONSE = "0"
 
+    conversation_logger: Optional[ConversationLogger] = None
+    single_flight: Optional[SingleFlight] = None
+    # The smaller, faster model used for the query rewrite and, when enabled, the follow-up questions
+    utility_model: str
+    utility_deployment: Optional[str]
+    utility_token_limit: int
+    utility_followup_questions: bool = False
+
     follow_up_questions_prompt_content = """Generate 3 very brief follow-up questions that the user would likely ask next.
     Enclose the follow-up questions in double angle brackets. Example:
     <<Are there exclusions for prescriptions?>>
@@ -78,6 +65,10 @@ class ChatApproach(Approach, ABC):
     Make sure the last question ends with ">>".
     """
 
+    followup_questions_system_prompt = """You are an assistant who suggests the questions a user is likely to ask next.
+    The user will provide a question along with the sources found to answer it.
+    """
+
     query_prompt_template = "You are an assistant who generates terms based on a user question to be used as a search query in a very simple search engine. " +\
     "Below is a history of the conversation so far followed by a new question asked by the user. " +\
     "Your job is to generate terms for a search query based the user's question. " +\
@@ -92,7 +83,9 @@ class ChatApproach(Approach, ABC):
         pass
 
     @abstractmethod
-    async def run_until_final_call(self, history, overrides, auth_claims, should_stream) -> tuple:
+    async def run_until_final_call(
+        self, history, overrides, auth_claims, should_stream, on_progress: Optional[Callable[[str], None]] = None
+    ) -> tuple:
         pass
 
     def get_system_prompt(self, override_prompt: Optional[str], follow_up_questions_prompt: str) -> str:
@@ -131,26 +124,19 @@ class ChatApproach(Approach, ABC):
         user_content: Union[str, list[ChatCompletionContentPartParam]],
         max_tokens: int,
         few_shots=[],
+        max_history_messages: Optional[int] = None,
     ) -> list[ChatCompletionMessageParam]:
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
-
-        message_builder.insert_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))  # type: ignore
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
+        for shot in few_shots:
+            message_builder.append_message(shot.get("role"), shot.get("content"))
+
+        user_message = message_builder.create_message(self.USER, user_content)
+        total_token_count = message_builder.count_tokens_for_message(dict(user_message))  # type: ignore
+
+        message_builder.append_history(history[:-1], max_tokens - total_token_count, max_history_messages)
+        message_builder.messages.append(user_message)
         return message_builder.messages
 
     async def run_without_streaming(
@@ -171,19 +157,6 @@ class ChatApproach(Approach, ABC):
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
         chat_resp["choices"][0]["session_state"] = session_state
-
-        conversation = {
-            'id': str(uuid.uuid4()),
-            'createdAt': datetime.utcnow().isoformat(),  
-            'role': 'assistant',
-            'content': str(chat_resp["choices"][0]["message"]["content"])
-        }
-
-        try:
-            await container_client.upsert_item(conversation) 
-        except exceptions.CosmosHttpResponseError as e:
-            print(f"Error in create_convos upserting response: {e}")
-
         return chat_resp
 
     async def run_with_streaming(
@@ -193,55 +166,190 @@ class ChatApproach(Approach, ABC):
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, auth_claims, should_stream=True
+        # Each retrieval step is reported as it starts, so the client isn't left waiting for the sources
+        stages: asyncio.Queue[str] = asyncio.Queue()
+        final_call = asyncio.ensure_future(
+            self.run_until_final_call(
+                history, overrides, auth_claims, should_stream=True, on_progress=stages.put_nowait
+            )
         )
-        yield {
-            "choices": [
-                {
-                    "delta": {"role": self.ASSISTANT},
-                    "context": extra_info,
-                    "session_state": session_state,
-                    "finish_reason": None,
-                    "index": 0,
-                }
-            ],
-            "object": "chat.completion.chunk",
-        }
-
-        followup_questions_started = False
-        followup_content = ""
-        async for event_chunk in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
-            if event["choices"]:
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event["choices"][0]["delta"].get("content")
-                content = content or ""  # content may either not exist in delta, or explicitly be None
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event["choices"][0]["delta"]["content"] = earlier_content
-                        yield event
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
+        chat_task: Optional[asyncio.Future] = None
+        chat_stream: Any = None
+        try:
+            while not final_call.done():
+                next_stage = asyncio.ensure_future(stages.get())
+                await asyncio.wait({final_call, next_stage}, return_when=asyncio.FIRST_COMPLETED)
+                if next_stage.done():
+                    yield self.make_progress_event(next_stage.result())
                 else:
-                    yield event
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
-            yield {
-                "choices": [
-                    {
-                        "delta": {"role": self.ASSISTANT},
-                        "context": {"followup_questions": followup_questions},
-                        "finish_reason": None,
-                        "index": 0,
-                    }
-                ],
-                "object": "chat.completion.chunk",
-            }
+                    next_stage.cancel()
+            while not stages.empty():
+                yield self.make_progress_event(stages.get_nowait())
+            extra_info, chat_coroutine = final_call.result()
+            # The answer is requested as soon as the prompt is ready, while the sources are sent to the client
+            chat_task = asyncio.ensure_future(chat_coroutine)
+            yield self.make_context_event(extra_info, session_state)
+            chat_stream = await chat_task
+        finally:
+            for task in (final_call, chat_task):
+                if task is not None and not task.done():
+                    task.cancel()
+                    await asyncio.wait({task})
+            # When the client goes away before the answer is read, the prompt or the stream is released here
+            if chat_task is None:
+                if final_call.done() and not final_call.cancelled() and final_call.exception() is None:
+                    final_call.result()[1].close()
+            elif chat_stream is None and not chat_task.cancelled() and chat_task.exception() is None:
+                await close_stream(chat_task.result())
+
+        followup_parser = FollowupQuestionParser() if overrides.get("suggest_followup_questions") else None
+        try:
+            async for event_chunk in chat_stream:
+                # "2023-07-01-preview" API version has a bug where first response has empty choices
+                if not event_chunk.choices:
+                    continue
+                # Only the delta content and finish reason are forwarded, the rest of the chunk is never converted
+                choice = event_chunk.choices[0]
+                content = choice.delta.content or ""  # content may be explicitly None
+                followup_questions: list[str] = []
+                if followup_parser:
+                    content, followup_questions = followup_parser.feed(content)
+                    if choice.finish_reason is not None:
+                        content += followup_parser.close()
+                if content or choice.finish_reason is not None:
+                    yield self.make_delta_event(content, choice.finish_reason)
+                if followup_parser and followup_questions:
+                    # The frontend replaces context keys, so each event carries all the questions so far
+                    yield self.make_followup_questions_event(list(followup_parser.questions))
+        finally:
+            # Closes the OpenAI stream when the client goes away before the answer is complete
+            await close_stream(chat_stream)
+        if followup_parser:
+            content = followup_parser.close()
+            if content:
+                yield self.make_delta_event(content)
+
+    def make_turn(self, question: str) -> dict[str, Any]:
+        """Returns the conversation log document of a question, which is completed as the answer is computed."""
+        return {"id": str(uuid.uuid4()), "createdAt": datetime.utcnow().isoformat(), "question": question}
+
+    async def log_conversation_turn(
+        self, turn: dict[str, Any], chat_coroutine: Coroutine[Any, Any, Any]
+    ) -> Union[ChatCompletion, AsyncIterable[ChatCompletionChunk]]:
+        """
+        Awaits the final chat completion and queues the turn, with the answer added, on the conversation logger.
+        Streamed answers are logged once the stream has been fully consumed.
+        Turns whose answer failed or was abandoned by the client are logged too, with what was answered so far.
+        """
+        try:
+            result = await chat_coroutine
+        except BaseException as error:
+            self.log_turn(turn, "", error)
+            raise
+        if not isinstance(result, ChatCompletion):
+            return self.log_streamed_answer(turn, result)
+        self.log_turn(turn, result.choices[0].message.content or "")
+        return result
+
+    async def log_streamed_answer(
+        self, turn: dict[str, Any], stream: AsyncIterable[ChatCompletionChunk]
+    ) -> AsyncGenerator[ChatCompletionChunk, None]:
+        answer = ""
+        error: Optional[BaseException] = None
+        try:
+            async for chunk in stream:
+                if chunk.choices:
+                    answer += chunk.choices[0].delta.content or ""
+                yield chunk
+        except BaseException as stream_error:
+            # Includes GeneratorExit, when the client goes away before the answer is complete
+            error = stream_error
+            raise
+        finally:
+            await close_stream(stream)
+            self.log_turn(turn, answer, error)
+
+    def log_cached_turn(self, q: str, chat_resp: dict[str, Any]) -> None:
+        # Semantic cache hits never reach the final call, which logs the other turns
+        turn = self.make_turn(q)
+        turn["cached"] = True
+        self.log_turn(turn, chat_resp["choices"][0]["message"]["content"])
+
+    def log_turn(self, turn: dict[str, Any], answer: str, error: Optional[BaseException] = None) -> None:
+        turn["answer"] = answer
+        if error is None:
+            turn["status"] = "completed"
+        elif isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            turn["status"] = "abandoned"
+        else:
+            turn["status"] = "failed"
+            turn["error"] = str(error)
+        if self.conversation_logger is not None:
+            self.conversation_logger.log(turn)
+
+    async def add_followup_questions(
+        self, chat_coroutine: Coroutine[Any, Any, Any], question: str, sources: str
+    ) -> Union[ChatCompletion, AsyncIterable[ChatCompletionChunk]]:
+        """
+        Generates the follow-up questions with the utility model while the answer is generated, and appends them
+        to the answer in double angle brackets, as the answer model writes them when they're part of its prompt.
+        """
+        followups = asyncio.ensure_future(self.generate_followup_questions(question, sources))
+        try:
+            result = await chat_coroutine
+        except BaseException:
+            followups.cancel()
+            raise
+        if not isinstance(result, ChatCompletion):
+            return self.stream_followup_questions(result, followups)
+        message = result.choices[0].message
+        message.content = (message.content or "") + self.format_followup_questions(await followups)
+        return result
+
+    async def stream_followup_questions(
+        self, stream: AsyncIterable[ChatCompletionChunk], followups: asyncio.Future
+    ) -> AsyncGenerator[ChatCompletionChunk, None]:
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].finish_reason is not None:
+                    # The questions are sent just before the last chunk, which closes the follow-up parser
+                    if content := self.format_followup_questions(await followups):
+                        delta = chunk.choices[0].model_copy(
+                            update={"delta": ChoiceDelta(content=content), "finish_reason": None}
+                        )
+                        yield chunk.model_copy(update={"choices": [delta]})
+                yield chunk
+        finally:
+            followups.cancel()
+            await close_stream(stream)
+
+    async def generate_followup_questions(self, question: str, sources: str) -> list[str]:
+        response_token_limit = 200
+        messages = self.get_messages_from_history(
+            system_prompt=self.followup_questions_system_prompt + self.follow_up_questions_prompt_content,
+            model_id=self.utility_model,
+            history=[],
+            user_content=question + "\n\nSources:\n" + sources,
+            max_tokens=self.utility_token_limit - response_token_limit,
+        )
+        try:
+            chat_completion: ChatCompletion = await self.create_chat_completion(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.utility_deployment if self.utility_deployment else self.utility_model,
+                messages=messages,
+                temperature=0.0,
+                max_tokens=response_token_limit,
+                n=1,
+            )
+        except Exception:
+            # The answer is still useful without its follow-up questions
+            logging.exception("Exception generating follow-up questions")
+            return []
+        return self.extract_followup_questions(chat_completion.choices[0].message.content or "")[1]
+
+    @staticmethod
+    def format_followup_questions(questions: list[str]) -> str:
+        return "".join(f"<<{question}>>" for question in questions)
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
@@ -249,7 +357,123 @@ class ChatApproach(Approach, ABC):
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
 
+        # Answers depend on the conversation history, so only identical first-turn questions share a computation
+        if self.single_flight is None or len(messages) != 1:
+            if stream is False:
+                return await self.compute_response(messages, session_state, overrides, auth_claims)
+            return await self.compute_stream(messages, session_state, overrides, auth_claims)
+        key = self.get_single_flight_key(messages[-1]["content"], overrides, auth_claims, session_state)
         if stream is False:
+            return await self.share_response(self.single_flight, key, messages, session_state, overrides, auth_claims)
+        return self.share_stream(self.single_flight, key, messages, session_state, overrides, auth_claims)
+
+    async def share_response(
+        self,
+        single_flight: SingleFlight,
+        key: str,
+        messages: list[dict],
+        session_state: Any,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+    ) -> dict[str, Any]:
+        # The request that starts the computation has its turn logged by it, the requests that share it log their own
+        started = False
+
+        def compute() -> Coroutine[Any, Any, dict[str, Any]]:
+            nonlocal started
+            started = True
+            return self.compute_response(messages, session_state, overrides, auth_claims)
+
+        turn = self.make_turn(messages[-1]["content"])
+        try:
+            chat_resp = await single_flight.run(key, compute)
+        except BaseException as error:
+            if not started:
+                self.log_turn(turn, "", error)
+            raise
+        if not started:
+            self.log_turn(turn, chat_resp["choices"][0]["message"]["content"])
+        return chat_resp
+
+    async def share_stream(
+        self,
+        single_flight: SingleFlight,
+        key: str,
+        messages: list[dict],
+        session_state: Any,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        started = False
+
+        def compute() -> Coroutine[Any, Any, AsyncGenerator[dict[str, Any], None]]:
+            nonlocal started
+            started = True
+            return self.compute_stream(messages, session_state, overrides, auth_claims)
+
+        turn = self.make_turn(messages[-1]["content"])
+        events = single_flight.stream(key, compute)
+        answer = ""
+        error: Optional[BaseException] = None
+        try:
+            async for event in events:
+                answer += event["choices"][0]["delta"].get("content") or ""
+                yield event
+        except BaseException as stream_error:
+            error = stream_error
+            raise
+        finally:
+            await close_stream(events)
+            if not started:
+                self.log_turn(turn, answer, error)
+
+    def get_single_flight_key(
+        self, q: str, overrides: dict[str, Any], auth_claims: dict[str, Any], session_state: Any
+    ) -> str:
+        """
+        Returns the key of a question for the single-flight layer: the normalized question, the effective search
+        filter, the caller's security claims, and the overrides and session state, which also change the response.
+        """
+        return hash_key(
+            type(self).__name__,
+            " ".join(q.casefold().split()),
+            self.build_filter(overrides, auth_claims),
+            auth_claims.get("oids"),
+            auth_claims.get("groups"),
+            overrides,
+            session_state,
+        )
+
+    async def compute_response(
+        self, messages: list[dict], session_state: Any, overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> dict[str, Any]:
+        # Cached answers don't depend on conversation history, so only first-turn questions use the semantic cache
+        if self.semantic_cache is None or len(messages) != 1:
             return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
-        else:
+
+        q = messages[-1]["content"]
+        partition, query_vector = await self.get_semantic_cache_key(q, overrides, auth_claims)
+        if cached_resp := self.lookup_semantic_cache(partition, query_vector, session_state, overrides):
+            self.log_cached_turn(q, cached_resp)
+            return cached_resp
+
+        chat_resp = await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+        choice = chat_resp["choices"][0]
+        self.store_semantic_cache(partition, query_vector, q, choice["message"]["content"], choice["context"])
+        return chat_resp
+
+    async def compute_stream(
+        self, messages: list[dict], session_state: Any, overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        if self.semantic_cache is None or len(messages) != 1:
             return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+
+        q = messages[-1]["content"]
+        partition, query_vector = await self.get_semantic_cache_key(q, overrides, auth_claims)
+        if cached_resp := self.lookup_semantic_cache(partition, query_vector, session_state, overrides):
+            self.log_cached_turn(q, cached_resp)
+            return self.replay_semantic_cache_hit(cached_resp)
+
+        return self.store_streamed_answer(
+            self.run_with_streaming(messages, overrides, auth_claims, session_state), partition, query_vector, q
+        )
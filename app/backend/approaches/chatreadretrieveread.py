@@ -1,4 +1,6 @@
-from typing import Any, Coroutine, Literal, Optional, Union, overload
+import asyncio
+import re
+from typing import Any, Callable, Coroutine, Literal, Optional, Union, overload
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorQuery
@@ -8,52 +10,18 @@ from openai.types.chat import (
     ChatCompletionChunk,
 )
 
-from approaches.approach import ThoughtStep
+from approaches.approach import Document, ThoughtStep
 from approaches.chatapproach import ChatApproach
 from core.authentication import AuthenticationHelper
+from core.completioncache import ChatCompletionCache
+from core.conversationlogger import ConversationLogger
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
 from core.modelhelper import get_token_limit
-
-import re
-from azure.cosmos.aio import CosmosClient
-from azure.cosmos import exceptions
-import uuid
-from datetime import datetime
-import os
-
-AZURE_COSMOSDB_ACCOUNT="db-temp-testingauth"
-AZURE_COSMOSDB_DATABASE="db_conversation_history"
-AZURE_COSMOSDB_CONVERSATIONS_CONTAINER="conversations"
-AZURE_COSMOSDB_ACCOUNT_KEY = os.getenv("AZURE_COSMOSDB_ACCOUNT_KEY")
-
-try:
-    cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
-    credential = AZURE_COSMOSDB_ACCOUNT_KEY
-    database_name=AZURE_COSMOSDB_DATABASE
-    container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
-        
-except Exception as e:
-    raise ValueError("Exception in CosmosDB initialization", e)
-    cosmos_endpoint = None
-    raise e
-
-try:
-    cosmosdb_client = CosmosClient(cosmos_endpoint, credential=credential)
-except exceptions.CosmosHttpResponseError as e:
-    if e.status_code == 401:
-        raise ValueError("Invalid credentials") from e
-    else:
-        raise ValueError("Invalid CosmosDB endpoint") from e
-
-try:
-    database_client = cosmosdb_client.get_database_client(database_name)
-except exceptions.CosmosResourceNotFoundError:
-    raise ValueError("Invalid CosmosDB database name") 
- 
-
-try:
-    container_client = database_client.get_container_client(container_name)
-except exceptions.CosmosResourceNotFoundError:
-    raise ValueError("Invalid CosmosDB container name") 
+from core.rewriteskip import RewriteSkipClassifier
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticCache
+from core.singleflight import SingleFlight
 
 
 class ChatReadRetrieveReadApproach(ChatApproach):
@@ -72,12 +40,26 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         openai_client: AsyncOpenAI,
         chatgpt_model: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
+        utility_model: Optional[str] = None,  # Defaults to the chat model
+        utility_deployment: Optional[str] = None,
+        utility_followup_questions: bool = False,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         sourcepage_field: str,
         content_field: str,
         query_language: str,
         query_speller: str,
+        chat_completion_cache: Optional[ChatCompletionCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        conversation_logger: Optional[ConversationLogger] = None,
+        single_flight: Optional[SingleFlight] = None,
+        speculative_retrieval: bool = False,
+        rewrite_skip_classifier: Optional[RewriteSkipClassifier] = None,
+        default_verbosity: str = "full",
+        max_verbosity: str = "full",
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -91,6 +73,22 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         self.query_language = query_language
         self.query_speller = query_speller
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.utility_model = utility_model or chatgpt_model
+        # A utility deployment given without its model name is still used, with the token limit of the main model
+        self.utility_deployment = utility_deployment if utility_deployment or utility_model else chatgpt_deployment
+        self.utility_token_limit = get_token_limit(self.utility_model)
+        self.utility_followup_questions = utility_followup_questions
+        self.chat_completion_cache = chat_completion_cache
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.semantic_cache = semantic_cache
+        self.search_cache = search_cache
+        self.conversation_logger = conversation_logger
+        self.single_flight = single_flight
+        self.speculative_retrieval = speculative_retrieval
+        self.rewrite_skip_classifier = rewrite_skip_classifier
+        self.default_verbosity = default_verbosity
+        self.max_verbosity = max_verbosity
 
     @property
     def system_message_chat_conversation(self):
@@ -124,6 +122,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
+        on_progress: Optional[Callable[[str], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]:
         ...
 
@@ -134,6 +133,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
+        on_progress: Optional[Callable[[str], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]:
         ...
 
@@ -143,6 +143,7 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        on_progress: Optional[Callable[[str], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -153,22 +154,10 @@ class ChatReadRetrieveReadApproach(ChatApproach):
 
         original_user_query = history[-1]["content"]
         user_query_request = str(original_user_query)
-
-        conversation = {
-            'id': str(uuid.uuid4()),
-            'createdAt': datetime.utcnow().isoformat(),  
-            'role': 'user',
-            'content': user_query_request
-        }
-
-        try:
-            await container_client.upsert_item(conversation) 
-        except exceptions.CosmosHttpResponseError as e:
-            print(f"Error in create_convos upserting question: {e}")
-    
+        turn = self.make_turn(user_query_request)
 
         last_response = ""
-        all_hx = []
+        all_hx: list[dict[str, Any]] = []
         for line in history:
             if line['role']=='assistant':
                 last_response = str(line['content'])
@@ -204,79 +193,96 @@ class ChatReadRetrieveReadApproach(ChatApproach):
         ]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=self.query_prompt_template,
-            model_id=self.chatgpt_model,
-            history=query_hx,
-            user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
-            few_shots=self.query_prompt_few_shots,
-        )
-
-        search_query_msg = messages
-
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            functions=functions,
-            function_call="auto",
+        # The question is the only entry of the history on the first turn
+        is_first_turn = len(all_hx) == 1
+        # Short standalone first-turn questions are already good search queries, and are searched as they are
+        skip_rewrite = self.rewrite_skip_classifier is not None and self.rewrite_skip_classifier.can_skip(
+            original_user_query, has_history=not is_first_turn
         )
-
-        query_text = self.get_search_query(chat_completion, original_user_query)
-
-        # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(query_text))
+        search_query_msg: list = []
+        if not skip_rewrite:
+            if on_progress is not None:
+                on_progress("rewriting")
+            messages = self.get_messages_from_history(
+                system_prompt=self.query_prompt_template,
+                model_id=self.utility_model,
+                history=query_hx,
+                user_content=user_query_request,
+                max_tokens=self.utility_token_limit - len(user_query_request),
+                few_shots=self.query_prompt_few_shots,
+            )
+            search_query_msg = messages
+
+        # On first-turn questions the rewrite rarely changes the query, so the original question can be searched
+        # while the rewrite is generated
+        speculative_search: Optional[asyncio.Future] = None
+        use_speculative_search = False
+        if self.speculative_retrieval and not skip_rewrite and is_first_turn:
+            speculative_search = asyncio.ensure_future(
+                self.retrieve(
+                    original_user_query, has_text, has_vector, top, filter, use_semantic_ranker, use_semantic_captions
+                )
+            )
+            # Its errors only matter when its results are used
+            speculative_search.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            if skip_rewrite:
+                search_text = original_user_query
+            else:
+                chat_completion: ChatCompletion = await self.create_chat_completion(
+                    messages=messages,  # type: ignore
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.utility_deployment if self.utility_deployment else self.utility_model,
+                    temperature=0.0,
+                    max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+                    n=1,
+                    functions=functions,
+                    function_call="auto",
+                )
+                search_text = self.get_search_query(chat_completion, original_user_query)
+
+            # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+            if on_progress is not None:
+                on_progress("searching")
+
+            if speculative_search is not None and self.is_equivalent_query(search_text, original_user_query):
+                use_speculative_search = True
+                search_text = original_user_query
+                results = await speculative_search
+            else:
+                results = await self.retrieve(
+                    search_text, has_text, has_vector, top, filter, use_semantic_ranker, use_semantic_captions
+                )
+        finally:
+            if speculative_search is not None and not speculative_search.done():
+                speculative_search.cancel()
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
-        if not has_text:
-            query_text = None
+        query_text: Optional[str] = search_text if has_text else None
 
         all_hx.append({'role': 'assistant1', 'content': query_text})
-
-        conversation = {
-            'id': str(uuid.uuid4()),
-            'createdAt': datetime.utcnow().isoformat(),  
-            'role': 'query',
-            'content': query_text
-        }
-
-        try:
-            await container_client.upsert_item(conversation) 
-        except exceptions.CosmosHttpResponseError as e:
-            print(f"Error in create_convos upserting query: {e}")
-
-        results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
+        turn["query"] = query_text
 
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=False)
         content = ",\n".join(sources_content)
         all_hx.append({'role': 'user2', 'content': original_user_query + " \n\n Sources: \n" + content})
-
-        conversation = {
-            'id': str(uuid.uuid4()),
-            'createdAt': datetime.utcnow().isoformat(),  
-            'role': 'results',
-            'content': content
-        }
-
-        try:
-            await container_client.upsert_item(conversation) 
-        except exceptions.CosmosHttpResponseError as e:
-            print(f"Error in create_convos upserting results: {e}")
+        turn["results"] = content
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
+        # Follow-up questions are either written by the answer model after the answer, or generated separately
+        # by the utility model while the answer is generated
+        suggest_followup_questions = bool(overrides.get("suggest_followup_questions"))
+        use_utility_followup_questions = suggest_followup_questions and self.utility_followup_questions
+
         # Allow client to replace the entire prompt, or to inject into the exiting prompt using >>>
         system_message = self.get_system_prompt(
             overrides.get("prompt_template"),
-            self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
+            (
+                self.follow_up_questions_prompt_content
+                if suggest_followup_questions and not use_utility_followup_questions
+                else ""
+            ),
         )
 
         response_token_limit = 4000
@@ -296,14 +302,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
             user_content=original_user_query + "\n Sources: \n" + content,
             max_tokens=messages_token_limit,
+            # Only the latest question and answer from the history are sent along with the sources
+            max_history_messages=2,
         )
 
-        if len(chat_messages) > 4:
-            chat_messages = [chat_messages[0]] + chat_messages[-3:]
-
         data_points = {"text": sources_content}
 
-        chat_coroutine = self.openai_client.chat.completions.create(
+        chat_coroutine = self.create_chat_completion(
             # Azure Open AI takes the deployment name as the model name
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             messages=chat_messages,
@@ -312,11 +317,15 @@ class ChatReadRetrieveReadApproach(ChatApproach):
             n=1,
             stream=should_stream,
         )
-
-        extra_info = {
-            "history": all_hx,
-            "data_points": data_points,
-            "thoughts": [
+        if use_utility_followup_questions:
+            chat_coroutine = self.add_followup_questions(chat_coroutine, original_user_query, content)
+        if self.conversation_logger is not None:
+            chat_coroutine = self.log_conversation_turn(turn, chat_coroutine)
+
+        extra_info = self.build_context(
+            overrides,
+            data_points,
+            lambda: [
                 ThoughtStep(
                     "[CRR]: search prompt",
                     [str(s) for s in search_query_msg],
@@ -324,7 +333,13 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep(
                     "Generated search query",
                     query_text,
-                    {"use_semantic_captions": use_semantic_captions, "has_vector": has_vector, "include_category": filter},
+                    {
+                        "use_semantic_captions": use_semantic_captions,
+                        "has_vector": has_vector,
+                        "include_category": filter,
+                        "speculative": use_speculative_search,
+                        "rewrite_skipped": skip_rewrite,
+                    },
                 ),
                 ThoughtStep(
                     "history:",
@@ -337,6 +352,37 @@ class ChatReadRetrieveReadApproach(ChatApproach):
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in chat_messages]),
             ],
-        }
+            # The frontend sends the history back with the next question, so it's returned at every verbosity
+            history=all_hx,
+        )
+
+        return (extra_info, chat_coroutine)
 
-        return (extra_info, chat_coroutine)
\ No newline at end of file
+    async def retrieve(
+        self,
+        query_text: str,
+        has_text: bool,
+        has_vector: bool,
+        top: int,
+        filter: Optional[str],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+    ) -> list[Document]:
+        # If retrieval mode includes vectors, compute an embedding for the query
+        vectors: list[VectorQuery] = []
+        if has_vector:
+            vectors.append(await self.compute_text_embedding(query_text))
+        # Only search the text query if the retrieval mode uses text
+        return await self.search(
+            top, query_text if has_text else None, filter, vectors, use_semantic_ranker, use_semantic_captions
+        )
+
+    @staticmethod
+    def is_equivalent_query(query_text: str, original_user_query: str) -> bool:
+        """
+        Returns True when the rewritten query only keeps terms of the original question, so that searching the
+        original question finds the same sources. A rewrite that adds terms (from the history, a translation or
+        a synonym) isn't equivalent.
+        """
+        query_terms = set(re.findall(r"\w+", query_text.casefold()))
+        return query_terms <= set(re.findall(r"\w+", original_user_query.casefold()))
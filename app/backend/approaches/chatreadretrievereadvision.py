@@ -1,4 +1,4 @@
-from typing import Any, Coroutine, Optional, Union
+from typing import Any, Callable, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import ContainerClient
@@ -13,8 +13,14 @@ from openai.types.chat import (
 from approaches.approach import ThoughtStep
 from approaches.chatapproach import ChatApproach
 from core.authentication import AuthenticationHelper
+from core.completioncache import ChatCompletionCache
+from core.conversationlogger import ConversationLogger
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
 from core.imageshelper import fetch_image
 from core.modelhelper import get_token_limit
+from core.searchcache import SearchCache
+from core.singleflight import SingleFlight
 
 
 class ChatReadRetrieveReadVisionApproach(ChatApproach):
@@ -34,6 +40,9 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         auth_helper: AuthenticationHelper,
         gpt4v_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         gpt4v_model: str,
+        utility_model: Optional[str] = None,  # Defaults to the GPT-4V model
+        utility_deployment: Optional[str] = None,
+        utility_followup_questions: bool = False,
         embedding_deployment: Optional[str],  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embedding_model: str,
         sourcepage_field: str,
@@ -42,6 +51,14 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        chat_completion_cache: Optional[ChatCompletionCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+        search_cache: Optional[SearchCache] = None,
+        conversation_logger: Optional[ConversationLogger] = None,
+        single_flight: Optional[SingleFlight] = None,
+        default_verbosity: str = "full",
+        max_verbosity: str = "full",
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -58,6 +75,19 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
         self.chatgpt_token_limit = get_token_limit(gpt4v_model)
+        self.utility_model = utility_model or gpt4v_model
+        # A utility deployment given without its model name is still used, with the token limit of the main model
+        self.utility_deployment = utility_deployment if utility_deployment or utility_model else gpt4v_deployment
+        self.utility_token_limit = get_token_limit(self.utility_model)
+        self.utility_followup_questions = utility_followup_questions
+        self.chat_completion_cache = chat_completion_cache
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.search_cache = search_cache
+        self.conversation_logger = conversation_logger
+        self.single_flight = single_flight
+        self.default_verbosity = default_verbosity
+        self.max_verbosity = max_verbosity
 
     @property
     def system_message_chat_conversation(self):
@@ -82,6 +112,7 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
+        on_progress: Optional[Callable[[str], None]] = None,
     ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -95,21 +126,24 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         include_gtpV_images = overrides.get("gpt4v_input") in ["textAndImages", "images", None]
 
         original_user_query = history[-1]["content"]
+        turn = self.make_turn(original_user_query)
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        if on_progress is not None:
+            on_progress("rewriting")
         user_query_request = "Generate search query for: " + original_user_query
 
         messages = self.get_messages_from_history(
             system_prompt=self.query_prompt_template,
-            model_id=self.gpt4v_model,
+            model_id=self.utility_model,
             history=history,
             user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(" ".join(user_query_request)),
+            max_tokens=self.utility_token_limit - len(" ".join(user_query_request)),
             few_shots=self.query_prompt_few_shots,
         )
 
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+        chat_completion: ChatCompletion = await self.create_chat_completion(
+            model=self.utility_deployment if self.utility_deployment else self.utility_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.0,
             max_tokens=100,
@@ -119,6 +153,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
+        if on_progress is not None:
+            on_progress("searching")
 
         # If retrieval mode includes vectors, compute an embedding for the query
         vectors = []
@@ -138,13 +174,24 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
         results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
         sources_content = self.get_sources_content(results, use_semantic_captions, use_image_citation=True)
         content = "\n".join(sources_content)
+        turn["query"] = query_text
+        turn["results"] = content
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
 
+        # Follow-up questions are either written by the answer model after the answer, or generated separately
+        # by the utility model while the answer is generated
+        suggest_followup_questions = bool(overrides.get("suggest_followup_questions"))
+        use_utility_followup_questions = suggest_followup_questions and self.utility_followup_questions
+
         # Allow client to replace the entire prompt, or to inject into the existing prompt using >>>
         system_message = self.get_system_prompt(
             overrides.get("prompt_template"),
-            self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else "",
+            (
+                self.follow_up_questions_prompt_content
+                if suggest_followup_questions and not use_utility_followup_questions
+                else ""
+            ),
         )
 
         response_token_limit = 1024
@@ -175,9 +222,10 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             "images": [d["image_url"] for d in image_list],
         }
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
+        extra_info = self.build_context(
+            overrides,
+            data_points,
+            lambda: [
                 ThoughtStep(
                     "Original user query",
                     original_user_query,
@@ -190,9 +238,9 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in messages]),
             ],
-        }
+        )
 
-        chat_coroutine = self.openai_client.chat.completions.create(
+        chat_coroutine = self.create_chat_completion(
             model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.7,
@@ -200,4 +248,8 @@ class ChatReadRetrieveReadVisionApproach(ChatApproach):
             n=1,
             stream=should_stream,
         )
+        if use_utility_followup_questions:
+            chat_coroutine = self.add_followup_questions(chat_coroutine, original_user_query, content)
+        if self.conversation_logger is not None:
+            chat_coroutine = self.log_conversation_turn(turn, chat_coroutine)
         return (extra_info, chat_coroutine)
@@ -1,13 +1,19 @@
+import asyncio
 import os
-from typing import Any, AsyncGenerator, Optional, Union
+from typing import Any, AsyncGenerator, Coroutine, Optional, Union
 
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorQuery
+from azure.search.documents.models import RawVectorQuery, VectorQuery
 from openai import AsyncOpenAI
 
 from approaches.approach import Approach, ThoughtStep
 from core.authentication import AuthenticationHelper
+from core.completioncache import ChatCompletionCache
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
+from core.searchcache import SearchCache
+from core.semanticcache import SemanticCache
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -56,6 +62,13 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        chat_completion_cache: Optional[ChatCompletionCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        search_cache: Optional[SearchCache] = None,
+        default_verbosity: str = "full",
+        max_verbosity: str = "full",
     ):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
@@ -69,36 +82,85 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.chat_completion_cache = chat_completion_cache
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.semantic_cache = semantic_cache
+        self.search_cache = search_cache
+        self.default_verbosity = default_verbosity
+        self.max_verbosity = max_verbosity
 
     async def run(
         self,
         messages: list[dict],
-        stream: bool = False,  # Stream is not used in this approach
+        stream: bool = False,
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         q = messages[-1]["content"]
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
+        partition: Optional[int] = None
+        query_vector: Optional[list[float]] = None
+        if self.semantic_cache is not None:
+            partition, query_vector = await self.get_semantic_cache_key(q, overrides, auth_claims)
+            if cached_resp := self.lookup_semantic_cache(partition, query_vector, session_state, overrides):
+                return cached_resp if stream is False else self.replay_semantic_cache_hit(cached_resp)
+
+        # On a cache miss, the question's embedding is reused for the search
+        extra_info, chat_coroutine = await self.run_until_final_call(
+            q, overrides, auth_claims, stream, query_vector=query_vector
+        )
+        if stream:
+            result = self.stream_answer(extra_info, session_state, chat_coroutine)
+            if partition is not None and query_vector is not None:
+                return self.store_streamed_answer(result, partition, query_vector, q)
+            return result
+
+        chat_completion = (await chat_coroutine).model_dump()
+        chat_completion["choices"][0]["context"] = extra_info
+        chat_completion["choices"][0]["session_state"] = session_state
+        if partition is not None and query_vector is not None:
+            self.store_semantic_cache(
+                partition, query_vector, q, chat_completion["choices"][0]["message"]["content"], extra_info
+            )
+        return chat_completion
+
+    async def run_until_final_call(
+        self,
+        q: str,
+        overrides: dict[str, Any],
+        auth_claims: dict[str, Any],
+        should_stream: bool = False,
+        vectors: Optional[list[VectorQuery]] = None,
+        query_vector: Optional[list[float]] = None,
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Any]]:
+        """
+        Searches for the question and builds the prompt, and returns the context along with the (not yet awaited)
+        final chat completion. The query embedding is computed unless the `vectors`, or the embedding of the
+        question (`query_vector`), are given.
+        """
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_ranker = overrides.get("semantic_ranker") and has_text
+        use_semantic_ranker = bool(overrides.get("semantic_ranker") and has_text)
 
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
         # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            vectors.append(await self.compute_text_embedding(q))
+        if vectors is None:
+            if not has_vector:
+                vectors = []
+            elif query_vector is not None:
+                vectors = [RawVectorQuery(vector=query_vector, k=50, fields="embedding")]
+            else:
+                vectors = [await self.compute_text_embedding(q)]
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else None
 
         results = await self.search(top, query_text, filter, vectors, use_semantic_ranker, use_semantic_captions)
 
-        user_content = [q]
-
         template = overrides.get("prompt_template") or self.system_chat_template
         model = self.chatgpt_model
         message_builder = MessageBuilder(template, model)
@@ -113,21 +175,11 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         message_builder.insert_message("assistant", self.answer)
         message_builder.insert_message("user", self.question)
 
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-                messages=message_builder.messages,
-                temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
-
         data_points = {"text": sources_content}
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
+        extra_info = self.build_context(
+            overrides,
+            data_points,
+            lambda: [
                 ThoughtStep(
                     "Search Query",
                     query_text,
@@ -138,8 +190,55 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
-        }
-
-        chat_completion["choices"][0]["context"] = extra_info
-        chat_completion["choices"][0]["session_state"] = session_state
-        return chat_completion
+        )
+
+        chat_coroutine = self.create_chat_completion(
+            # Azure Open AI takes the deployment name as the model name
+            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+            messages=message_builder.messages,
+            temperature=overrides.get("temperature") or 0.3,
+            max_tokens=1024,
+            n=1,
+            stream=should_stream,
+        )
+        return extra_info, chat_coroutine
+
+    async def run_batch(
+        self, questions: list[str], context: dict[str, Any] = {}, max_concurrency: int = 8
+    ) -> AsyncGenerator[tuple[int, Union[dict[str, Any], Exception]], None]:
+        """
+        Answers several questions with the same overrides, and yields (index, answer) pairs as the answers complete.
+        The query embeddings are computed with batched calls, then at most `max_concurrency` questions are searched
+        and answered at once. A question that fails yields its exception instead of stopping the batch.
+        The semantic cache isn't used, so that evaluation runs always get fresh answers.
+        """
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        query_vectors = await self.compute_text_embeddings(questions) if has_vector else None
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(index: int) -> tuple[int, Union[dict[str, Any], Exception]]:
+            async with semaphore:
+                try:
+                    extra_info, chat_coroutine = await self.run_until_final_call(
+                        questions[index],
+                        overrides,
+                        auth_claims,
+                        vectors=[query_vectors[index]] if query_vectors is not None else [],
+                    )
+                    chat_completion = (await chat_coroutine).model_dump()
+                    chat_completion["choices"][0]["context"] = extra_info
+                    return index, chat_completion
+                except Exception as error:
+                    return index, error
+
+        tasks = [asyncio.ensure_future(answer(index)) for index in range(len(questions))]
+        try:
+            for next_answer in asyncio.as_completed(tasks):
+                yield await next_answer
+        finally:
+            # Stops the remaining questions when the client goes away
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -11,8 +11,12 @@ from openai.types.chat import (
 
 from approaches.approach import Approach, ThoughtStep
 from core.authentication import AuthenticationHelper
+from core.completioncache import ChatCompletionCache
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
 from core.imageshelper import fetch_image
 from core.messagebuilder import MessageBuilder
+from core.searchcache import SearchCache
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
@@ -54,6 +58,12 @@ class RetrieveThenReadVisionApproach(Approach):
         query_speller: str,
         vision_endpoint: str,
         vision_key: str,
+        chat_completion_cache: Optional[ChatCompletionCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        embedding_batcher: Optional[EmbeddingBatcher] = None,
+        search_cache: Optional[SearchCache] = None,
+        default_verbosity: str = "full",
+        max_verbosity: str = "full",
     ):
         self.search_client = search_client
         self.blob_container_client = blob_container_client
@@ -69,11 +79,17 @@ class RetrieveThenReadVisionApproach(Approach):
         self.query_speller = query_speller
         self.vision_endpoint = vision_endpoint
         self.vision_key = vision_key
+        self.chat_completion_cache = chat_completion_cache
+        self.embedding_cache = embedding_cache
+        self.embedding_batcher = embedding_batcher
+        self.search_cache = search_cache
+        self.default_verbosity = default_verbosity
+        self.max_verbosity = max_verbosity
 
     async def run(
         self,
         messages: list[dict],
-        stream: bool = False,  # Stream is not used in this approach
+        stream: bool = False,
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -133,24 +149,15 @@ class RetrieveThenReadVisionApproach(Approach):
         # Append user message
         message_builder.insert_message("user", user_content)
 
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
-                messages=message_builder.messages,
-                temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
-
         data_points = {
             "text": sources_content,
             "images": [d["image_url"] for d in image_list],
         }
 
-        extra_info = {
-            "data_points": data_points,
-            "thoughts": [
+        extra_info = self.build_context(
+            overrides,
+            data_points,
+            lambda: [
                 ThoughtStep(
                     "Search Query",
                     query_text,
@@ -159,7 +166,20 @@ class RetrieveThenReadVisionApproach(Approach):
                 ThoughtStep("Results", [result.serialize_for_results() for result in results]),
                 ThoughtStep("Prompt", [str(message) for message in message_builder.messages]),
             ],
-        }
+        )
+
+        chat_coroutine = self.create_chat_completion(
+            model=self.gpt4v_deployment if self.gpt4v_deployment else self.gpt4v_model,
+            messages=message_builder.messages,
+            temperature=overrides.get("temperature") or 0.3,
+            max_tokens=1024,
+            n=1,
+            stream=stream,
+        )
+        if stream:
+            return self.stream_answer(extra_info, session_state, chat_coroutine)
+
+        chat_completion = (await chat_coroutine).model_dump()
         chat_completion["choices"][0]["context"] = extra_info
         chat_completion["choices"][0]["session_state"] = session_state
         return chat_completion
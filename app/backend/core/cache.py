@@ -0,0 +1,119 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+def hash_key(*parts: Any) -> str:
+    """
+    Returns a stable SHA-256 hex digest for the given parts.
+    Parts are serialized as canonical JSON (sorted keys, no whitespace) so that
+    dicts with the same contents always hash the same regardless of insertion order.
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "hit_ratio": self.hit_ratio}
+
+
+class LRUCache(Generic[V]):
+    """
+    An in-memory LRU cache with an optional time-to-live and an optional cap on the total size of the stored values.
+    Attributes:
+        max_entries (int): The maximum number of entries to keep.
+        max_bytes (int | None): The maximum total size of the stored values, as reported by `sizeof`.
+        ttl (float | None): The number of seconds an entry stays valid after it is stored.
+        stats (CacheStats): Hit, miss, eviction and expiration counters.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sizeof: Callable[[V], int] = lambda value: 0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than 0")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self.stats = CacheStats()
+        self.total_bytes = 0
+        # key -> (value, size, expires_at)
+        self._entries: OrderedDict[str, tuple[V, int, Optional[float]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not self._is_expired(entry)
+
+    def _is_expired(self, entry: tuple[V, int, Optional[float]]) -> bool:
+        expires_at = entry[2]
+        return expires_at is not None and self.clock() >= expires_at
+
+    def get(self, key: str) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return None
+        if self._is_expired(entry):
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: V) -> None:
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # The value can never fit, so don't evict everything else trying to make room for it
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires_at = self.clock() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, size, expires_at)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.stats.evictions += 1
+
+    def delete(self, key: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
@@ -0,0 +1,66 @@
+import logging
+from typing import Any, Optional
+
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+
+from .cache import CacheStats, LRUCache, hash_key
+
+# Request parameters that change the completion and therefore must be part of the cache key
+KEYED_PARAMS = (
+    "temperature",
+    "top_p",
+    "max_tokens",
+    "n",
+    "stop",
+    "presence_penalty",
+    "frequency_penalty",
+    "logit_bias",
+    "seed",
+    "functions",
+    "function_call",
+    "tools",
+    "tool_choice",
+    "response_format",
+)
+
+
+class ChatCompletionCache:
+    """
+    Memoizes deterministic calls to `openai_client.chat.completions.create`.
+    Only non-streaming, single-choice calls with temperature 0 are cached, since any other call
+    is expected to return a different completion each time. Completions are stored as their JSON
+    representation, which keeps the entries compact and gives every caller its own copy on a hit.
+    """
+
+    def __init__(
+        self, max_entries: int = 1024, max_bytes: Optional[int] = 32 * 1024 * 1024, ttl: Optional[float] = 3600
+    ):
+        self.cache: LRUCache[bytes] = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, sizeof=len)
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.cache.stats
+
+    @staticmethod
+    def is_cacheable(params: dict[str, Any]) -> bool:
+        return not params.get("stream") and params.get("n", 1) == 1 and params.get("temperature") == 0
+
+    @staticmethod
+    def make_key(params: dict[str, Any]) -> str:
+        messages = [
+            {key: value for key, value in message.items() if value is not None} for message in params["messages"]
+        ]
+        return hash_key(params["model"], messages, {name: params.get(name) for name in KEYED_PARAMS})
+
+    async def create(self, openai_client: AsyncOpenAI, **params: Any) -> Any:
+        if not self.is_cacheable(params):
+            return await openai_client.chat.completions.create(**params)
+        key = self.make_key(params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logging.debug("Chat completion cache hit for model %s", params["model"])
+            return ChatCompletion.model_validate_json(cached)
+        chat_completion = await openai_client.chat.completions.create(**params)
+        self.cache.set(key, chat_completion.model_dump_json().encode("utf-8"))
+        return chat_completion
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
+
+from azure.cosmos import exceptions
+from azure.cosmos.aio import ContainerProxy
+
+
+class ConversationSink(ABC):
+    """
+    Abstract destination for conversation log documents. Sinks receive documents in batches from the ConversationLogger.
+    """
+
+    @abstractmethod
+    async def write(self, documents: list[dict[str, Any]]) -> int:
+        """Writes the documents and returns the number of documents that could not be written."""
+
+    async def close(self) -> None:
+        pass
+
+
+class CosmosConversationSink(ConversationSink):
+    """
+    Upserts conversation log documents into a Cosmos DB container.
+    Throttled writes (HTTP 429) are retried after the delay suggested by Cosmos DB, with exponential backoff,
+    and are given up on after `max_retries` attempts.
+    """
+
+    def __init__(self, container_client: ContainerProxy, max_retries: int = 5, initial_backoff: float = 0.5):
+        self.container_client = container_client
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+
+    async def write(self, documents: list[dict[str, Any]]) -> int:
+        results = await asyncio.gather(*(self.upsert(document) for document in documents), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logging.warning("Unable to upsert conversation log document: %s", error)
+        return len(errors)
+
+    async def upsert(self, document: dict[str, Any]) -> None:
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.container_client.upsert_item(document)
+                return
+            except exceptions.CosmosHttpResponseError as error:
+                if error.status_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after_ms = (error.headers or {}).get("x-ms-retry-after-ms")
+                await asyncio.sleep(max(float(retry_after_ms) / 1000, backoff) if retry_after_ms else backoff)
+                backoff *= 2
+
+
+class FileConversationSink(ConversationSink):
+    """
+    Appends conversation log documents to a local JSON lines file, for local development and tests.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def write(self, documents: list[dict[str, Any]]) -> int:
+        await asyncio.to_thread(self.append, documents)
+        return 0
+
+    def append(self, documents: list[dict[str, Any]]) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            for document in documents:
+                file.write(json.dumps(document, ensure_ascii=False) + "\n")
+
+
+@dataclass
+class ConversationLoggerStats:
+    written: int = 0
+    dropped: int = 0
+    failed: int = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class ConversationLogger:
+    """
+    Writes conversation log documents in the background, so that requests never wait on the log store.
+    Documents are put on a bounded queue and written by a background task in batches of up to `batch_size`
+    documents, or whatever has accumulated after `flush_interval` seconds. When the queue is full, new documents
+    are dropped. Documents that the sink fails to write are dropped as well.
+    On shutdown, `close` keeps writing the queued documents for up to `drain_timeout` seconds.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        sink: ConversationSink,
+        max_queue_size: int = 1000,
+        batch_size: int = 25,
+        flush_interval: float = 1.0,
+        drain_timeout: float = 10.0,
+    ):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drain_timeout = drain_timeout
+        self.queue: Optional[asyncio.Queue] = None
+        self.max_queue_size = max_queue_size
+        self.task: Optional[asyncio.Task] = None
+        self.stats = ConversationLoggerStats()
+
+    def start(self) -> None:
+        """Starts the background writer. Must be called from within the running event loop."""
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.task = asyncio.create_task(self.run())
+
+    def log(self, document: dict[str, Any]) -> bool:
+        """Queues a document to be written, and returns False if it was dropped."""
+        if self.queue is None or self.task is None or self.task.done():
+            self.stats.dropped += 1
+            return False
+        try:
+            self.queue.put_nowait(document)
+            return True
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            logging.warning("Conversation log queue is full, dropping document %s", document.get("id"))
+            return False
+
+    async def close(self) -> None:
+        """Writes the queued documents, waiting at most `drain_timeout` seconds, and closes the sink."""
+        if self.queue is not None and self.task is not None and not self.task.done():
+            try:
+                # Waiting for room in a full queue counts against the timeout too
+                await asyncio.wait_for(self.stop(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                self.stats.dropped += self.queue.qsize()
+                logging.warning("Timed out writing the conversation log, %d documents dropped", self.queue.qsize())
+        await self.sink.close()
+
+    async def stop(self) -> None:
+        assert self.queue is not None and self.task is not None
+        await self.queue.put(self._STOP)
+        await self.task
+
+    async def run(self) -> None:
+        assert self.queue is not None
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.write(batch)
+
+    async def write(self, batch: list[dict[str, Any]]) -> None:
+        try:
+            failed = await self.sink.write(batch)
+        except Exception as error:
+            failed = len(batch)
+            logging.warning("Unable to write %d conversation log documents: %s", len(batch), error)
+        self.stats.written += len(batch) - failed
+        self.stats.failed += failed
@@ -0,0 +1,83 @@
+import asyncio
+from dataclasses import asdict, dataclass
+from typing import Any
+
+from openai import AsyncOpenAI
+
+
+@dataclass
+class EmbeddingBatcherStats:
+    # Texts requested by callers, embeddings calls sent, distinct texts sent in those calls, and failed calls
+    requests: int = 0
+    batches: int = 0
+    inputs: int = 0
+    errors: int = 0
+
+    @property
+    def average_batch_size(self) -> float:
+        return self.requests / self.batches if self.batches else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "average_batch_size": self.average_batch_size}
+
+
+class EmbeddingBatcher:
+    """
+    Collects the query embeddings requested by concurrent requests and computes them with one embeddings call.
+    A batch is sent `window` seconds after its first text arrives, or as soon as it holds `max_batch_size` texts,
+    and each caller gets the vector of its own text. Identical texts in a batch are only sent once.
+    Texts for different models (deployments) are batched separately.
+    """
+
+    def __init__(self, openai_client: AsyncOpenAI, max_batch_size: int = 16, window: float = 0.005):
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size must be greater than 0")
+        self.openai_client = openai_client
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.stats = EmbeddingBatcherStats()
+        self.pending: dict[str, list[tuple[str, asyncio.Future]]] = {}
+        self.timers: dict[str, asyncio.TimerHandle] = {}
+        # Keeps a reference to the calls in flight, so that they aren't garbage collected
+        self.tasks: set[asyncio.Future] = set()
+
+    async def embed(self, model: str, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(model, [])
+        batch.append((text, future))
+        self.stats.requests += 1
+        if len(batch) >= self.max_batch_size:
+            self.flush(model)
+        elif len(batch) == 1:
+            self.timers[model] = loop.call_later(self.window, self.flush, model)
+        return await future
+
+    def flush(self, model: str) -> None:
+        """Sends the texts waiting for the model right away."""
+        if (timer := self.timers.pop(model, None)) is not None:
+            timer.cancel()
+        batch = self.pending.pop(model, None)
+        if not batch:
+            return
+        task = asyncio.ensure_future(self.send(model, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, model: str, batch: list[tuple[str, asyncio.Future]]) -> None:
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.stats.batches += 1
+        self.stats.inputs += len(texts)
+        try:
+            embedding = await self.openai_client.embeddings.create(model=model, input=texts)
+        except Exception as error:
+            self.stats.errors += 1
+            for _, future in batch:
+                # Callers that went away have cancelled their future
+                if not future.done():
+                    future.set_exception(error)
+            return
+        vectors = {texts[data.index]: data.embedding for data in embedding.data}
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
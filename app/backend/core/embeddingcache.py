@@ -0,0 +1,30 @@
+from typing import Optional
+
+import numpy as np
+
+from .cache import CacheStats, LRUCache, hash_key
+
+
+class EmbeddingCache:
+    """
+    Caches query embeddings by embedding model (or vision endpoint) and exact query text.
+    Vectors are stored as float32 NumPy arrays, which take a fraction of the memory of a list of Python floats.
+    """
+
+    def __init__(
+        self, max_entries: int = 4096, max_bytes: Optional[int] = 64 * 1024 * 1024, ttl: Optional[float] = 3600
+    ):
+        self.cache: LRUCache[np.ndarray] = LRUCache(
+            max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, sizeof=lambda vector: vector.nbytes
+        )
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.cache.stats
+
+    def get(self, model: str, text: str) -> Optional[list[float]]:
+        vector = self.cache.get(hash_key(model, text))
+        return vector.tolist() if vector is not None else None
+
+    def set(self, model: str, text: str, vector: list[float]) -> None:
+        self.cache.set(hash_key(model, text), np.asarray(vector, dtype=np.float32))
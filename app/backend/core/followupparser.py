@@ -0,0 +1,78 @@
+class FollowupQuestionParser:
+    """
+    Incrementally separates the answer from the follow-up questions in a streamed chat completion.
+    Follow-up questions are written by the model as <<question>> after the answer, and may be split across
+    deltas at any point, including in the middle of a << or >> marker.
+    Answer text is returned as soon as it can't be the start of a marker, and each question as soon as it's closed.
+    Text between questions is discarded, and questions longer than `max_question_length` are dropped,
+    so the parser only ever holds one (bounded) question in memory.
+    """
+
+    def __init__(self, max_question_length: int = 1000):
+        self.max_question_length = max_question_length
+        self.questions: list[str] = []
+        self.in_followups = False
+        self.in_question = False
+        # A trailing "<" or ">" that may be the first half of a marker
+        self.pending = ""
+        self.question_parts: list[str] = []
+        self.question_length = 0
+
+    def feed(self, text: str) -> tuple[str, list[str]]:
+        """Consumes a delta, and returns the answer text that can be emitted and the questions closed by it."""
+        text = self.pending + text
+        self.pending = ""
+        answer_parts: list[str] = []
+        new_questions: list[str] = []
+        position = 0
+        while position < len(text):
+            if self.in_question:
+                end = text.find(">>", position)
+                if end == -1:
+                    end = len(text) - 1 if text.endswith(">") else len(text)
+                    self.add_question_text(text[position:end])
+                    self.pending = text[end:]
+                    break
+                self.add_question_text(text[position:end])
+                question = self.close_question()
+                if question:
+                    new_questions.append(question)
+                position = end + 2
+                continue
+            start = text.find("<<", position)
+            if start == -1:
+                end = len(text) - 1 if text.endswith("<") else len(text)
+                if not self.in_followups:
+                    answer_parts.append(text[position:end])
+                self.pending = text[end:]
+                break
+            if not self.in_followups:
+                answer_parts.append(text[position:start])
+                self.in_followups = True
+            self.in_question = True
+            position = start + 2
+        return "".join(answer_parts), new_questions
+
+    def close(self) -> str:
+        """Returns the answer text held back at the end of the stream. An unclosed question is discarded."""
+        pending, self.pending = self.pending, ""
+        self.question_parts = []
+        self.question_length = 0
+        self.in_question = False
+        return "" if self.in_followups else pending
+
+    def add_question_text(self, text: str) -> None:
+        self.question_length += len(text)
+        if self.question_length <= self.max_question_length:
+            self.question_parts.append(text)
+        else:
+            self.question_parts = []
+
+    def close_question(self) -> str:
+        question = "".join(self.question_parts) if self.question_length <= self.max_question_length else ""
+        self.question_parts = []
+        self.question_length = 0
+        self.in_question = False
+        if question:
+            self.questions.append(question)
+        return question
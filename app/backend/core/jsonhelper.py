@@ -0,0 +1,94 @@
+import asyncio
+import dataclasses
+import json
+from typing import Any, Optional, Union
+
+import numpy as np
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+
+def default(o: Any) -> Any:
+    """Converts the objects that the JSON libraries don't handle natively."""
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        # Shallow copy of the fields, nested values are converted as the encoder reaches them
+        return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class JSONSerializer:
+    """
+    Serializes response payloads to UTF-8 encoded JSON with the standard library.
+    """
+
+    name = "json"
+
+    def dumps(self, obj: Any, sort_keys: bool = False) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=default).encode(
+            "utf-8"
+        )
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    async def dumps_async(self, obj: Any, sort_keys: bool = False) -> bytes:
+        """Serializes the object in a worker thread, for large payloads that would otherwise block the event loop."""
+        return await asyncio.to_thread(self.dumps, obj, sort_keys)
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    Serializes response payloads with orjson, which handles dataclasses and numpy arrays natively.
+    """
+
+    name = "orjson"
+
+    def dumps(self, obj: Any, sort_keys: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+
+def create_serializer(name: Optional[str] = None) -> JSONSerializer:
+    """
+    Returns the serializer with the given name, "orjson" or "json".
+    By default orjson is used when it is installed, and the standard library otherwise.
+    """
+    if name is None or name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("The orjson JSON serializer was requested but orjson is not installed")
+        return OrjsonSerializer()
+    if name == "json":
+        return JSONSerializer()
+    raise ValueError(f"Unknown JSON serializer: {name}")
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Quart JSON provider that uses a JSONSerializer, so that `jsonify` and `request.get_json` use the same library
+    as the streamed responses.
+    """
+
+    def __init__(self, app, serializer: JSONSerializer):
+        super().__init__(app)
+        self.serializer = serializer
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return self.serializer.dumps(obj, sort_keys=kwargs.get("sort_keys", self.sort_keys)).decode("utf-8")
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return self.serializer.loads(s)
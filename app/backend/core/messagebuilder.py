@@ -1,5 +1,6 @@
+import logging
 import unicodedata
-from typing import List, Union
+from typing import List, Optional, Sequence, Union
 
 from openai.types.chat import (
     ChatCompletionAssistantMessageParam,
@@ -9,7 +10,14 @@ from openai.types.chat import (
     ChatCompletionUserMessageParam,
 )
 
-from .modelhelper import num_tokens_from_messages
+from .modelhelper import num_tokens_from_messages, num_tokens_from_messages_batch
+
+
+def normalize_text(text: str) -> str:
+    """Returns the NFC normalization of the text. Text that is already normalized, the usual case, is not copied."""
+    if unicodedata.is_normalized("NFC", text):
+        return text
+    return unicodedata.normalize("NFC", text)
 
 
 class MessageBuilder:
@@ -22,11 +30,17 @@ class MessageBuilder:
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        append_message(self, role: str, content: str): Appends a new message to the conversation.
+        append_history(self, history: Sequence[dict], max_tokens: int, max_messages: int | None): Appends the most
+            recent history messages that fit in the token and message limits.
     """
 
+    # Number of history messages tokenized together when the history is trimmed
+    history_batch_size = 8
+
     def __init__(self, system_content: str, chatgpt_model: str):
         self.messages: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", system_content))
+            ChatCompletionSystemMessageParam(role="system", content=normalize_text(system_content))
         ]
         self.model = chatgpt_model
 
@@ -39,26 +53,76 @@ class MessageBuilder:
             content (str | List[ChatCompletionContentPartParam]): The content of the message.
             index (int): The index at which to insert the message.
         """
-        message: ChatCompletionMessageParam
+        self.messages.insert(index, self.create_message(role, content))
+
+    def append_message(self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]):
+        """
+        Appends a message to the end of the conversation.
+        Args:
+            role (str): The role of the message sender (either "user", "system", or "assistant").
+            content (str | List[ChatCompletionContentPartParam]): The content of the message.
+        """
+        self.messages.append(self.create_message(role, content))
+
+    def append_history(
+        self, history: Sequence[dict[str, str]], max_tokens: int, max_messages: Optional[int] = None
+    ) -> int:
+        """
+        Appends the most recent history messages, in chronological order.
+        Messages are taken from newest to oldest until the next message would exceed `max_tokens` tokens or
+        `max_messages` messages. They are counted `history_batch_size` at a time, with one batch tokenization
+        per group, so messages older than the group where the limit is reached are never normalized or tokenized.
+        Args:
+            history (Sequence[dict]): The conversation history, from oldest to newest.
+            max_tokens (int): The maximum number of tokens for the appended messages.
+            max_messages (int | None): The maximum number of messages to append.
+        Returns:
+            int: The number of tokens of the appended messages.
+        """
+        candidates = list(reversed(history))
+        if max_messages is not None:
+            candidates = candidates[:max_messages]
+        selected: list[ChatCompletionMessageParam] = []
+        total_token_count = 0
+        for start in range(0, len(candidates), self.history_batch_size):
+            group = [
+                self.create_message(message["role"], message["content"])
+                for message in candidates[start : start + self.history_batch_size]
+            ]
+            token_counts = self.count_tokens_for_messages(group)  # type: ignore[arg-type]
+            for history_message, message_token_count in zip(group, token_counts):
+                if total_token_count + message_token_count > max_tokens:
+                    logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+                    self.messages.extend(reversed(selected))
+                    return total_token_count
+                selected.append(history_message)
+                total_token_count += message_token_count
+        self.messages.extend(reversed(selected))
+        return total_token_count
+
+    def create_message(
+        self, role: str, content: Union[str, List[ChatCompletionContentPartParam]]
+    ) -> ChatCompletionMessageParam:
         if role == "user":
-            message = ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
+            return ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
         elif role == "system" and isinstance(content, str):
-            message = ChatCompletionSystemMessageParam(role="system", content=unicodedata.normalize("NFC", content))
+            return ChatCompletionSystemMessageParam(role="system", content=normalize_text(content))
         elif role == "assistant" and isinstance(content, str):
-            message = ChatCompletionAssistantMessageParam(
-                role="assistant", content=unicodedata.normalize("NFC", content))
+            return ChatCompletionAssistantMessageParam(role="assistant", content=normalize_text(content))
         else:
             raise ValueError(f"Invalid role: {role}")
-        self.messages.insert(index, message)
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
+    def count_tokens_for_messages(self, messages: list[dict[str, str]]) -> list[int]:
+        return num_tokens_from_messages_batch(messages, self.model)
+
     def normalize_content(self, content: Union[str, List[ChatCompletionContentPartParam]]):
         if isinstance(content, str):
-            return unicodedata.normalize("NFC", content)
+            return normalize_text(content)
         elif isinstance(content, list):
             for part in content:
                 if "image_url" not in part:
-                    part["text"] = unicodedata.normalize("NFC", part["text"])
+                    part["text"] = normalize_text(part["text"])
             return content
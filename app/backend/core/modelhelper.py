@@ -1,6 +1,13 @@
 from __future__ import annotations
 
+import hashlib
+import os
+from typing import Iterable
+
 import tiktoken
+from tiktoken.model import encoding_name_for_model
+
+from .cache import LRUCache
 
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
@@ -10,12 +17,27 @@ MODELS_2_TOKEN_LIMITS = {
     "gpt-4": 8100,
     "gpt-4-32k": 32000,
     "gpt-4v": 128000,
+    "gpt-4o": 128000,
     "gpt-4o-mini": 128000,
 }
 
 
-#AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
-AOAI_2_OAI = {"gpt-4o-mini": "gpt-4o-mini", "gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
+# AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k", "gpt-4v": "gpt-4-turbo-vision"}
+AOAI_2_OAI = {
+    "gpt-4o": "gpt-4o",
+    "gpt-4o-mini": "gpt-4o-mini",
+    "gpt-35-turbo": "gpt-3.5-turbo",
+    "gpt-35-turbo-16k": "gpt-3.5-turbo-16k",
+    "gpt-4v": "gpt-4-turbo-vision",
+}
+
+# Encodings are expensive to load, so each one is only created once per process
+ENCODINGS: dict[str, tiktoken.Encoding] = {}
+
+# Token counts of recently seen strings, keyed by encoding name and a digest of the string.
+# Chat clients resend the whole history on every turn, so most history messages are counted from here.
+TOKEN_COUNTS: LRUCache[int] = LRUCache(max_entries=16384)
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -38,17 +60,81 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         output: 11
     """
 
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
-    for key, value in message.items():
-        if isinstance(value, list):
-            for v in value:
-                # TODO: Update token count for images https://github.com/openai/openai-cookbook/pull/881/files
-                if isinstance(v, str):
-                    num_tokens += len(encoding.encode(v))
-        else:
-            num_tokens += len(encoding.encode(value))
-    return num_tokens
+    return num_tokens_from_messages_batch([message], model)[0]
+
+
+def num_tokens_from_messages_batch(messages: list[dict[str, str]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of the messages, as `num_tokens_from_messages` does.
+    Strings that aren't in the token count cache are encoded together with tiktoken's batch encoding.
+    Args:
+        messages (list[dict]): The messages to encode.
+        model (str): The name of the model to use for encoding.
+    Returns:
+        list[int]: The number of tokens required to encode each message, in the same order.
+    """
+    encoding = get_encoding(model)
+    counts = [2] * len(messages)  # For "role" and "content" keys
+    missing: dict[str, list[int]] = {}
+    for index, message in enumerate(messages):
+        for value in message.values():
+            # TODO: Update token count for images https://github.com/openai/openai-cookbook/pull/881/files
+            texts = [v for v in value if isinstance(v, str)] if isinstance(value, list) else [value]
+            for text in texts:
+                cached = TOKEN_COUNTS.get(token_count_key(encoding, text))
+                if cached is None:
+                    missing.setdefault(text, []).append(index)
+                else:
+                    counts[index] += cached
+    if missing:
+        texts = list(missing)
+        # Batch encoding starts a thread pool, which isn't worth it for a single string
+        encoded = encoding.encode_batch(texts) if len(texts) > 1 else [encoding.encode(texts[0])]
+        for text, tokens in zip(texts, encoded):
+            TOKEN_COUNTS.set(token_count_key(encoding, text), len(tokens))
+            for index in missing[text]:
+                counts[index] += len(tokens)
+    return counts
+
+
+def token_count_key(encoding: tiktoken.Encoding, text: str) -> str:
+    return encoding.name + ":" + hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def encoding_file_path(cache_dir: str, encoding_name: str) -> str:
+    """Returns the path of the BPE file of an OpenAI encoding in a tiktoken cache directory (TIKTOKEN_CACHE_DIR)."""
+    blobpath = f"https://openaipublic.blob.core.windows.net/encodings/{encoding_name}.tiktoken"
+    return os.path.join(cache_dir, hashlib.sha1(blobpath.encode()).hexdigest())
+
+
+def preload_encodings(models: Iterable[str], cache_dir: str | None = None) -> None:
+    """
+    Loads the encodings of the models, so that the first request doesn't wait for the BPE files.
+    Args:
+        models (Iterable[str]): The names of the models.
+        cache_dir (str | None): The tiktoken cache directory, when the BPE files are bundled with the app.
+            tiktoken only reads it from the TIKTOKEN_CACHE_DIR environment variable.
+    Raises:
+        FileNotFoundError: If `cache_dir` is set and doesn't contain the files of all the encodings,
+            rather than letting tiktoken try to download them.
+    """
+    models = list(models)
+    if cache_dir is not None:
+        encoding_names = {encoding_name_for_model(get_oai_chatmodel_tiktok(model)) for model in models}
+        missing = sorted(name for name in encoding_names if not os.path.exists(encoding_file_path(cache_dir, name)))
+        if missing:
+            raise FileNotFoundError(f"Tokenizer files for {', '.join(missing)} are missing from {cache_dir}")
+    for model in models:
+        get_encoding(model)
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the tiktoken encoding for the model, loading it on first use."""
+    oai_model = get_oai_chatmodel_tiktok(model)
+    encoding = ENCODINGS.get(oai_model)
+    if encoding is None:
+        encoding = ENCODINGS[oai_model] = tiktoken.encoding_for_model(oai_model)
+    return encoding
 
 
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
@@ -0,0 +1,78 @@
+import re
+from dataclasses import asdict, dataclass
+from typing import Any, Optional
+
+# Words that refer to something said earlier, which only the query rewrite can resolve
+ANAPHORA = frozenset(
+    {
+        "it",
+        "its",
+        "itself",
+        "this",
+        "that",
+        "these",
+        "those",
+        "they",
+        "them",
+        "their",
+        "theirs",
+        "he",
+        "him",
+        "his",
+        "she",
+        "her",
+        "hers",
+        "there",
+        "such",
+        "same",
+        "above",
+        "previous",
+        "former",
+        "latter",
+        "again",
+        "also",
+        "else",
+    }
+)
+
+
+@dataclass
+class RewriteSkipStats:
+    skipped: int = 0
+    rewritten: int = 0
+
+    @property
+    def skip_ratio(self) -> float:
+        total = self.skipped + self.rewritten
+        return self.skipped / total if total else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "skip_ratio": self.skip_ratio}
+
+
+class RewriteSkipClassifier:
+    """
+    Decides locally whether a chat question can be searched as is, without the LLM call that rewrites it into a
+    search query. Only a first-turn question that has at most `max_words` words, no pronoun or other word that
+    refers to earlier context, and only ASCII characters (a cheap stand-in for "already in English") is searched
+    as is. Everything else is still rewritten, since the rewrite adds the context or translation it needs.
+    """
+
+    def __init__(self, max_words: int = 12, anaphora: Optional[frozenset[str]] = None):
+        self.max_words = max_words
+        self.anaphora = ANAPHORA if anaphora is None else anaphora
+        self.stats = RewriteSkipStats()
+
+    def can_skip(self, question: str, has_history: bool) -> bool:
+        words = re.findall(r"\w+", question.casefold())
+        skip = (
+            not has_history
+            and 0 < len(words) <= self.max_words
+            and question.isascii()
+            and not any(word in self.anaphora for word in words)
+        )
+        if skip:
+            self.stats.skipped += 1
+        else:
+            self.stats.rewritten += 1
+        return skip
@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+from azure.search.documents.models import VectorQuery
+
+from .cache import CacheStats, LRUCache, hash_key
+
+# A compact search result: a tuple of field values, see Document.to_record
+SearchRecord = tuple
+
+
+def vector_query_key(vector_query: VectorQuery) -> tuple:
+    """Returns a short, hashable description of a vector query, with the vector itself replaced by a digest."""
+    vector = getattr(vector_query, "vector", None)
+    digest = hashlib.sha256(np.asarray(vector, dtype=np.float32).tobytes()).hexdigest() if vector else None
+    return (
+        vector_query.kind,
+        vector_query.fields,
+        vector_query.k,
+        vector_query.exhaustive,
+        getattr(vector_query, "text", None),
+        digest,
+    )
+
+
+def record_size(record: SearchRecord) -> int:
+    size = 64 * len(record)
+    for value in record:
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif isinstance(value, (list, tuple)):
+            size += sum(len(item) if isinstance(item, str) else 64 for item in value)
+    return size
+
+
+class SearchCache:
+    """
+    Caches search results keyed by the query text, filter, vector queries and retrieval options.
+    Results are stored as compact records (embeddings as float32 arrays) rather than `Document` objects.
+    When `get_index_version` is provided, it is called at most every `check_interval` seconds and the
+    cache is cleared whenever the returned value changes, for example after the index is re-ingested.
+    """
+
+    def __init__(
+        self,
+        index_name: str,
+        max_entries: int = 1024,
+        max_bytes: Optional[int] = 64 * 1024 * 1024,
+        ttl: Optional[float] = 300,
+        get_index_version: Optional[Callable[[], Awaitable[Any]]] = None,
+        check_interval: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.index_name = index_name
+        self.get_index_version = get_index_version
+        self.check_interval = check_interval
+        self.clock = clock
+        self.index_version: Any = None
+        self.next_check = 0.0
+        self.cache: LRUCache[list[SearchRecord]] = LRUCache(
+            max_entries=max_entries,
+            max_bytes=max_bytes,
+            ttl=ttl,
+            sizeof=lambda records: sum(record_size(record) for record in records),
+            clock=clock,
+        )
+
+    @property
+    def stats(self) -> CacheStats:
+        return self.cache.stats
+
+    def make_key(
+        self,
+        top: int,
+        query_text: Optional[str],
+        filter: Optional[str],
+        vectors: list[VectorQuery],
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+        *extra: Any,
+    ) -> str:
+        return hash_key(
+            self.index_name,
+            query_text,
+            filter,
+            [vector_query_key(vector) for vector in vectors],
+            top,
+            bool(use_semantic_ranker),
+            bool(use_semantic_captions),
+            *extra,
+        )
+
+    async def ensure_fresh(self) -> None:
+        if self.get_index_version is None or self.clock() < self.next_check:
+            return
+        # Set before awaiting so that concurrent requests don't all check at once
+        self.next_check = self.clock() + self.check_interval
+        try:
+            index_version = await self.get_index_version()
+        except Exception as error:
+            logging.warning("Unable to check the search index version: %s", error)
+            return
+        if self.index_version is not None and index_version != self.index_version:
+            logging.info("Search index %s changed, clearing the search cache", self.index_name)
+            self.invalidate()
+        self.index_version = index_version
+
+    def invalidate(self) -> None:
+        self.cache.clear()
+
+    def get(self, key: str) -> Optional[list[SearchRecord]]:
+        return self.cache.get(key)
+
+    def set(self, key: str, records: list[SearchRecord]) -> None:
+        self.cache.set(key, records)
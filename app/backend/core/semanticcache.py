@@ -0,0 +1,138 @@
+import json
+import time
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from .cache import CacheStats, hash_key
+
+
+class SemanticCache:
+    """
+    Caches answers by the embedding of the question that produced them, so that paraphrased questions
+    can be answered without calling search or the LLM again.
+    Entries are grouped into partitions (for example by search filter and security claims), and a lookup
+    only ever matches an entry from the same partition whose cosine similarity reaches `threshold`.
+    All entries are kept in one preallocated float32 matrix so that a lookup is a single matrix-vector product.
+    Attributes:
+        threshold (float): The minimum cosine similarity for a lookup to be a hit.
+        max_entries (int): The maximum number of entries to keep.
+        max_bytes (int | None): The maximum total size of the vectors and payloads.
+        ttl (float | None): The number of seconds an entry stays valid after it is stored.
+        stats (CacheStats): Hit, miss, eviction and expiration counters.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.97,
+        max_entries: int = 1024,
+        max_bytes: Optional[int] = 64 * 1024 * 1024,
+        ttl: Optional[float] = 3600,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than 0")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self.total_bytes = 0
+        self.count = 0
+        # The matrix is allocated on the first store, once the embedding dimension is known
+        self._vectors: Optional[np.ndarray] = None
+        self._partitions = np.zeros(max_entries, dtype=np.int64)
+        self._created_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._sizes = np.zeros(max_entries, dtype=np.int64)
+        self._payloads: list[Optional[bytes]] = [None] * max_entries
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def partition_id(*parts: Any) -> int:
+        """Returns a signed 64-bit id for the partition described by `parts`."""
+        return int(hash_key(*parts)[:16], 16) - (1 << 63)
+
+    @staticmethod
+    def _normalize(vector: list[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def lookup(self, partition: int, vector: list[float]) -> Optional[tuple[dict[str, Any], float]]:
+        """Returns the payload and similarity of the closest entry in the partition, if it is close enough."""
+        if self._vectors is None or self.count == 0 or len(vector) != self._vectors.shape[1]:
+            self.stats.misses += 1
+            return None
+        self.remove_expired()
+        candidates = np.flatnonzero(self._partitions[: self.count] == partition)
+        if candidates.size == 0:
+            self.stats.misses += 1
+            return None
+        similarities = self._vectors[candidates] @ self._normalize(vector)
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < self.threshold:
+            self.stats.misses += 1
+            return None
+        index = int(candidates[best])
+        self._last_used[index] = self.clock()
+        self.stats.hits += 1
+        return json.loads(self._payloads[index]), similarity  # type: ignore[arg-type]
+
+    def store(self, partition: int, vector: list[float], payload: dict[str, Any]) -> None:
+        normalized = self._normalize(vector)
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        size = len(data) + normalized.nbytes
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if self._vectors is None or self._vectors.shape[1] != normalized.shape[0]:
+            self._vectors = np.zeros((self.max_entries, normalized.shape[0]), dtype=np.float32)
+            self.clear()
+        self.remove_expired()
+        while self.count >= self.max_entries or (
+            self.max_bytes is not None and self.count and self.total_bytes + size > self.max_bytes
+        ):
+            self._remove(int(np.argmin(self._last_used[: self.count])))
+            self.stats.evictions += 1
+        index = self.count
+        now = self.clock()
+        self._vectors[index] = normalized
+        self._partitions[index] = partition
+        self._created_at[index] = now
+        self._last_used[index] = now
+        self._sizes[index] = size
+        self._payloads[index] = data
+        self.count += 1
+        self.total_bytes += size
+
+    def remove_expired(self) -> None:
+        if self.ttl is None or self.count == 0:
+            return
+        expired = np.flatnonzero(self.clock() - self._created_at[: self.count] >= self.ttl)
+        # Remove from the end so that the swapped-in entries have already been checked
+        for index in expired[::-1]:
+            self._remove(int(index))
+            self.stats.expirations += 1
+
+    def clear(self) -> None:
+        self.count = 0
+        self.total_bytes = 0
+        self._payloads = [None] * self.max_entries
+
+    def _remove(self, index: int) -> None:
+        """Removes the entry at `index` by moving the last entry into its slot."""
+        last = self.count - 1
+        self.total_bytes -= int(self._sizes[index])
+        if index != last and self._vectors is not None:
+            self._vectors[index] = self._vectors[last]
+            self._partitions[index] = self._partitions[last]
+            self._created_at[index] = self._created_at[last]
+            self._last_used[index] = self._last_used[last]
+            self._sizes[index] = self._sizes[last]
+            self._payloads[index] = self._payloads[last]
+        self._payloads[last] = None
+        self.count = last
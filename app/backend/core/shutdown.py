@@ -0,0 +1,13 @@
+import logging
+from typing import Any
+
+
+async def close_all(*clients: Any) -> None:
+    """Closes the clients in order, logging rather than raising errors so that every client gets closed."""
+    for client in clients:
+        if client is None:
+            continue
+        try:
+            await client.close()
+        except Exception as error:
+            logging.warning("Unable to close %s: %s", type(client).__name__, error)
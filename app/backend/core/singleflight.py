@@ -0,0 +1,122 @@
+import asyncio
+import copy
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncGenerator, AsyncIterable, Awaitable, Callable, Optional
+
+from .streamhelper import close_stream
+
+
+@dataclass
+class SingleFlightStats:
+    # Computations that were started, and requests that shared one started by another request
+    started: int = 0
+    shared: int = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class Flight:
+    task: asyncio.Future
+    waiters: int = 0
+
+
+@dataclass
+class StreamFlight:
+    events: list[Any] = field(default_factory=list)
+    done: bool = False
+    error: Optional[BaseException] = None
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+    subscribers: int = 0
+    task: Optional[asyncio.Future] = None
+
+    def notify(self) -> None:
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    """
+    Shares one in-flight computation among concurrent requests with the same key, so that a burst of identical
+    questions only runs the search and the LLM calls once. Nothing is kept once the computation is done,
+    so requests that arrive after it start a new one.
+    Every waiter gets its own deep copy of the result. A stream is read once from upstream and its events are
+    fanned out to every subscriber, including the ones that subscribe after the first events (which are replayed).
+    The upstream computation is cancelled once all of its waiters or subscribers have gone away.
+    """
+
+    def __init__(self):
+        self.flights: dict[str, Flight] = {}
+        self.stream_flights: dict[str, StreamFlight] = {}
+        self.stats = SingleFlightStats()
+
+    async def run(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(asyncio.ensure_future(compute()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self.remove(self.flights, key, flight))
+            self.stats.started += 1
+        else:
+            self.stats.shared += 1
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+        return copy.deepcopy(result)
+
+    async def stream(self, key: str, compute: Callable[[], Awaitable[AsyncIterable[Any]]]) -> AsyncGenerator[Any, None]:
+        flight = self.stream_flights.get(key)
+        if flight is None:
+            flight = StreamFlight()
+            self.stream_flights[key] = flight
+            flight.task = asyncio.ensure_future(self.produce(key, flight, compute))
+            self.stats.started += 1
+        else:
+            self.stats.shared += 1
+        flight.subscribers += 1
+        try:
+            position = 0
+            while True:
+                if position < len(flight.events):
+                    yield copy.deepcopy(flight.events[position])
+                    position += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    break
+                else:
+                    await flight.changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and flight.task is not None and not flight.task.done():
+                flight.task.cancel()
+                await asyncio.wait({flight.task})
+
+    async def produce(
+        self, key: str, flight: StreamFlight, compute: Callable[[], Awaitable[AsyncIterable[Any]]]
+    ) -> None:
+        events: Optional[AsyncIterable[Any]] = None
+        try:
+            events = await compute()
+            async for event in events:
+                flight.events.append(event)
+                flight.notify()
+        except Exception as error:
+            flight.error = error
+        finally:
+            # Later requests start a new stream rather than joining one that has ended
+            self.remove(self.stream_flights, key, flight)
+            flight.done = True
+            flight.notify()
+            if events is not None:
+                await close_stream(events)
+
+    @staticmethod
+    def remove(flights: dict[str, Any], key: str, flight: Any) -> None:
+        if flights.get(key) is flight:
+            del flights[key]
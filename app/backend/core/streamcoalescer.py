@@ -0,0 +1,89 @@
+import asyncio
+import time
+from typing import Any, AsyncGenerator, AsyncIterable, Callable, Optional
+
+
+def is_content_delta(event: dict[str, Any]) -> bool:
+    """Returns True for stream events that only carry answer content, which can be merged with their neighbours."""
+    choices = event.get("choices")
+    if not choices or len(choices) != 1:
+        return False
+    choice = choices[0]
+    return (
+        choice.get("context") is None
+        and choice.get("finish_reason") is None
+        and set(choice.get("delta") or {}) == {"content"}
+    )
+
+
+class StreamCoalescer:
+    """
+    Merges consecutive answer deltas of a chat stream, so that a stream is written as one frame per `window`
+    seconds rather than one frame per token. A frame is also flushed as soon as it holds `max_chars` characters,
+    and before any other event (context, follow-up questions, finish reason), so those are never delayed.
+    The first delta of a stream is always sent right away, to keep the time to first token unchanged.
+    """
+
+    def __init__(self, window: float = 0.02, max_chars: int = 256, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.max_chars = max_chars
+        self.clock = clock
+
+    async def coalesce(self, events: AsyncIterable[dict[str, Any]]) -> AsyncGenerator[dict[str, Any], None]:
+        iterator = events.__aiter__()
+        buffer: list[str] = []
+        buffer_length = 0
+        flush_at = 0.0
+        first_delta_sent = False
+        next_event: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(iterator.__anext__())
+                if buffer:
+                    # Wait for the next event without cancelling it, so that the frame is flushed on time
+                    # even when the model pauses
+                    await asyncio.wait({next_event}, timeout=max(flush_at - self.clock(), 0))
+                    if not next_event.done():
+                        yield self.make_frame(buffer)
+                        buffer, buffer_length = [], 0
+                        continue
+                try:
+                    event = await next_event
+                except StopAsyncIteration:
+                    next_event = None
+                    break
+                next_event = None
+                if not is_content_delta(event):
+                    if buffer:
+                        yield self.make_frame(buffer)
+                        buffer, buffer_length = [], 0
+                    yield event
+                    continue
+                content = event["choices"][0]["delta"]["content"]
+                if not first_delta_sent:
+                    first_delta_sent = True
+                    yield event
+                    continue
+                if not buffer:
+                    flush_at = self.clock() + self.window
+                buffer.append(content)
+                buffer_length += len(content)
+                if buffer_length >= self.max_chars:
+                    yield self.make_frame(buffer)
+                    buffer, buffer_length = [], 0
+            if buffer:
+                yield self.make_frame(buffer)
+        finally:
+            # When the client goes away mid-stream, stop waiting for the rest of the answer
+            if next_event is not None and not next_event.done():
+                next_event.cancel()
+                await asyncio.wait({next_event})
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def make_frame(self, contents: list[str]) -> dict[str, Any]:
+        return {
+            "choices": [{"delta": {"content": "".join(contents)}, "finish_reason": None, "index": 0}],
+            "object": "chat.completion.chunk",
+        }
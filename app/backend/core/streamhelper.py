@@ -0,0 +1,46 @@
+import asyncio
+from dataclasses import asdict, dataclass
+from typing import Any, AsyncGenerator, AsyncIterable
+
+
+@dataclass
+class StreamStats:
+    completed: int = 0
+    cancelled: int = 0
+    failed: int = 0
+
+    def as_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+async def close_stream(stream: Any) -> None:
+    """
+    Closes an async generator or an OpenAI stream before it's exhausted, which releases the HTTP connection
+    and stops waiting on the rest of the answer.
+    """
+    if hasattr(stream, "aclose"):
+        await stream.aclose()
+    elif hasattr(stream, "close"):
+        await stream.close()
+    elif (response := getattr(stream, "response", None)) is not None:
+        await response.aclose()
+
+
+async def track_stream(events: AsyncIterable[dict], stats: StreamStats) -> AsyncGenerator[dict, None]:
+    """
+    Counts streams that were fully sent, that failed, and that were cancelled because the client went away.
+    Cancellation propagates to the wrapped stream, which closes the upstream OpenAI stream and any pending call.
+    """
+    try:
+        async for event in events:
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        stats.cancelled += 1
+        raise
+    except Exception:
+        stats.failed += 1
+        raise
+    else:
+        stats.completed += 1
+    finally:
+        await close_stream(events)
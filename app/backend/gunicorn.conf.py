@@ -1,7 +1,11 @@
 import multiprocessing
 
+from uvicorn.workers import UvicornWorker
+
 max_requests = 1000
 max_requests_jitter = 50
+# Recycled workers are killed if they are still running after this long
+graceful_timeout = 30
 log_file = "-"
 bind = "0.0.0.0"
 
@@ -10,4 +14,12 @@ timeout = 230
 
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
-worker_class = "uvicorn.workers.UvicornWorker"
+
+
+class GracefulUvicornWorker(UvicornWorker):
+    # Uvicorn waits for the answers in flight before running the app's shutdown, which closes the clients.
+    # The wait is bounded so that the clients are closed before the worker is killed.
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "timeout_graceful_shutdown": graceful_timeout - 5}
+
+
+worker_class = GracefulUvicornWorker
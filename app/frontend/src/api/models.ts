@@ -34,6 +34,7 @@ export type ChatAppRequestOverrides = {
     use_gpt4v?: boolean;
     gpt4v_input?: GPT4VInput;
     vector_fields: VectorFieldOptions[];
+    verbosity?: "none" | "citations" | "full";
 };
 
 export type ResponseMessage = {
@@ -0,0 +1,13 @@
+## Set the preference to stop on the first error
+$ErrorActionPreference = "Stop"
+
+& $PSScriptRoot\loadenv.ps1
+
+$venvPythonPath = "./scripts/.venv/scripts/python.exe"
+if (Test-Path -Path "/usr") {
+  # fallback to Linux venv path
+  $venvPythonPath = "./scripts/.venv/bin/python"
+}
+
+Write-Host "Running askbatch.py. Arguments to script: $args"
+Start-Process -FilePath $venvPythonPath -ArgumentList "./scripts/askbatch.py --backend-url $env:BACKEND_URI $args" -Wait -NoNewWindow
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from typing import Any, Optional, TextIO
+
+import aiohttp
+
+logger = logging.getLogger("askbatch")
+
+
+def read_questions(file: TextIO) -> list[str]:
+    """Reads one question per line, skipping blank lines."""
+    return [line.strip() for line in file if line.strip()]
+
+
+async def ask_batch(
+    session: aiohttp.ClientSession,
+    backend_url: str,
+    questions: list[str],
+    overrides: dict[str, Any],
+    output: TextIO,
+    token: Optional[str] = None,
+) -> int:
+    """
+    Posts the questions to the /ask/batch endpoint and writes each answer to the output as a JSON line, with the
+    question added, as the answers arrive. Returns the number of questions that failed.
+    """
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    failed = 0
+    async with session.post(
+        f"{backend_url.rstrip('/')}/ask/batch",
+        json={"questions": questions, "context": {"overrides": overrides}},
+        headers=headers,
+        raise_for_status=True,
+    ) as response:
+        # Answers with their sources can be larger than aiohttp's line limit, so lines are split here
+        buffer = b""
+        async for data in response.content.iter_any():
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                failed += write_answer(line, questions, output)
+        failed += write_answer(buffer, questions, output)
+    return failed
+
+
+def write_answer(line: bytes, questions: list[str], output: TextIO) -> int:
+    """Writes an answer line with its question, and returns 1 if the question failed."""
+    if not line.strip():
+        return 0
+    answer = json.loads(line)
+    if "index" in answer:
+        answer["question"] = questions[answer["index"]]
+    output.write(json.dumps(answer) + "\n")
+    if "error" in answer:
+        logger.warning("Question %s failed: %s", answer.get("index"), answer["error"])
+        return 1
+    return 0
+
+
+async def main(args: Any) -> int:
+    if args.questions == "-":
+        questions = read_questions(sys.stdin)
+    else:
+        with open(args.questions, encoding="utf-8") as file:
+            questions = read_questions(file)
+    overrides = json.loads(args.overrides) if args.overrides else {}
+    failed = 0
+    output = open(args.output, "w", encoding="utf-8") if args.output != "-" else sys.stdout
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+            for start in range(0, len(questions), args.batch_size):
+                batch = questions[start : start + args.batch_size]
+                logger.info("Asking questions %d to %d of %d", start + 1, start + len(batch), len(questions))
+                failed += await ask_batch(session, args.backend_url, batch, overrides, output, args.token)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logger.info("Answered %d questions, %d failed", len(questions) - failed, failed)
+    return failed
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Ask many questions with the /ask/batch endpoint and write the answers as JSON lines",
+        epilog="Example: askbatch.py questions.txt --output answers.jsonl --backend-url http://localhost:50505",
+    )
+    parser.add_argument("questions", help="File with one question per line, or - to read the questions from stdin")
+    parser.add_argument("--output", default="-", help="Optional. File the answers are written to, stdout by default")
+    parser.add_argument(
+        "--backend-url", default="http://localhost:50505", help="Optional. URL of the backend (default: local app)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=100,
+        help="Optional. Number of questions sent per request, must not exceed the backend's ASK_BATCH_MAX_QUESTIONS",
+    )
+    parser.add_argument(
+        "--overrides",
+        required=False,
+        help='Optional. JSON object with the overrides of every question, for example \'{"retrieval_mode": "text"}\'',
+    )
+    parser.add_argument(
+        "--token", required=False, help="Optional. Access token for the backend when authentication is enabled"
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.verbose:
+        logging.basicConfig()
+        logging.getLogger().setLevel(logging.INFO)
+
+    exit(1 if asyncio.run(main(args)) else 0)
@@ -0,0 +1,6 @@
+ #!/bin/sh
+
+. ./scripts/loadenv.sh
+
+echo "Running askbatch.py. Arguments to script: $@"
+  ./scripts/.venv/bin/python ./scripts/askbatch.py --backend-url "$BACKEND_URI" $@
@@ -97,6 +97,8 @@ async def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> Fi
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
         )
+    if embeddings and not args.disablebatchvectors:
+        embeddings.load_encoding()
 
     image_embeddings: Optional[ImageEmbeddings] = None
 
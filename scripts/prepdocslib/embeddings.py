@@ -38,6 +38,7 @@ class OpenAIEmbeddings(ABC):
         self.open_ai_model_name = open_ai_model_name
         self.disable_batch = disable_batch
         self.verbose = verbose
+        self.encoding: Optional[tiktoken.Encoding] = None
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
@@ -46,9 +47,17 @@ class OpenAIEmbeddings(ABC):
         if self.verbose:
             print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
+    def load_encoding(self) -> tiktoken.Encoding:
+        """
+        Loads the tokenizer of the embedding model once. Call it before processing files so that missing tokenizer
+        files (see TIKTOKEN_CACHE_DIR) are reported right away.
+        """
+        if self.encoding is None:
+            self.encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
+        return self.encoding
+
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return len(self.load_encoding().encode(text))
 
     def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
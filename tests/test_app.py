@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -7,8 +8,11 @@ import pytest
 import quart.testing.app
 from httpx import Request, Response
 from openai import BadRequestError
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
 
 import app
+from core.singleflight import SingleFlight
 
 
 def fake_response(http_code):
@@ -54,6 +58,16 @@ async def test_missing_env_vars():
                 test_app.test_client()
 
 
+@pytest.mark.asyncio
+async def test_missing_tokenizer_files(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+    quart_app = app.create_app()
+
+    with pytest.raises(quart.testing.app.LifespanError, match="cl100k_base, o200k_base are missing"):
+        async with quart_app.test_app() as test_app:
+            test_app.test_client()
+
+
 @pytest.mark.asyncio
 async def test_index(client):
     response = await client.get("/")
@@ -295,6 +309,91 @@ async def test_chat_text(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream", [False, True])
+async def test_chat_single_flight(client, monkeypatch, stream):
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    monkeypatch.setattr(chat_approach, "single_flight", SingleFlight())
+    completions = client.app.config[app.CONFIG_OPENAI_CLIENT].chat.completions
+    create = completions.create
+    calls = []
+
+    async def counting_create(*args, **kwargs):
+        calls.append(kwargs.get("stream", False))
+        # Lets the other requests arrive while this one is in flight
+        await asyncio.sleep(0.01)
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(completions, "create", counting_create)
+
+    async def post(question):
+        response = await client.post(
+            "/chat",
+            json={
+                "stream": stream,
+                "messages": [{"content": question, "role": "user"}],
+                "context": {"overrides": {"retrieval_mode": "text"}},
+            },
+        )
+        assert response.status_code == 200
+        return await response.get_data()
+
+    results = await asyncio.gather(
+        post("What is the capital of France?"),
+        post("what is the capital  of France?"),
+        post("What is the capital of France? "),
+    )
+    assert results[1] == results[0] and results[2] == results[0]
+    # One query rewrite and one answer for the three requests
+    assert calls == [False, stream]
+    assert chat_approach.single_flight.stats.as_dict() == {"started": 1, "shared": 2}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("route", ["/ask", "/chat"])
+async def test_verbosity(client, route):
+    async def post(verbosity):
+        response = await client.post(
+            route,
+            json={
+                "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                "context": {"overrides": {"retrieval_mode": "text", "verbosity": verbosity}},
+            },
+        )
+        assert response.status_code == 200
+        return (await response.get_json())["choices"][0]["context"]
+
+    context = await post("none")
+    assert context["data_points"] == {"text": []}
+    assert "thoughts" not in context
+    context = await post("citations")
+    assert "Benefit_Options-2.pdf" in context["data_points"]["text"][0]
+    assert "thoughts" not in context
+    context = await post("full")
+    assert context["thoughts"]
+    if route == "/chat":
+        assert context["history"]
+
+
+@pytest.mark.asyncio
+async def test_verbosity_capped(client):
+    approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    approach.default_verbosity = "none"
+    approach.max_verbosity = "citations"
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "verbosity": "full"}},
+        },
+    )
+    context = (await response.get_json())["choices"][0]["context"]
+    assert "thoughts" not in context
+    assert context["data_points"]["text"]
+    assert approach.get_verbosity({}) == "none"
+    assert approach.get_verbosity({"verbosity": "unknown"}) == "none"
+
+
 @pytest.mark.asyncio
 async def test_chat_text_filter(auth_client, snapshot):
     response = await auth_client.post(
@@ -434,6 +533,31 @@ async def test_chat_stream_text(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_chat_stream_sse(client):
+    response = await client.post(
+        "/chat/stream",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.headers["X-Accel-Buffering"] == "no"
+    frames = (await response.get_data()).decode().split("\n\n")
+    assert frames[-1] == ""
+    events = [json.loads(frame[len("data: ") :]) for frame in frames[:-1]]
+    assert [event["choices"][0]["progress"] for event in events[:2]] == ["rewriting", "searching"]
+    assert events[2]["choices"][0]["context"]["data_points"]
+    assert "".join(event["choices"][0]["delta"].get("content") or "" for event in events[3:]) == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+
+
 @pytest.mark.asyncio
 async def test_chat_stream_text_filter(auth_client, snapshot):
     response = await auth_client.post(
@@ -645,6 +769,93 @@ async def test_ask_vision(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"retrieval_mode": "text"},
+        {"use_gpt4v": True, "gpt4v_input": "textAndImages", "vector_fields": ["embedding", "imageEmbedding"]},
+    ],
+)
+async def test_ask_stream(client, overrides):
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "Are interest rates high?", "role": "user"}],
+            "context": {"overrides": overrides},
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data()).splitlines()]
+    assert events[0]["choices"][0]["context"]["data_points"]["text"]
+    assert events[0]["choices"][0]["delta"] == {"role": "assistant"}
+    answer = "".join(event["choices"][0]["delta"].get("content") or "" for event in events[1:])
+    assert answer
+    assert events[-1]["choices"][0]["finish_reason"] in (None, "stop")
+
+
+@pytest.mark.asyncio
+async def test_ask_batch(client, monkeypatch):
+    openai_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    embedding_inputs = []
+
+    async def mock_create(*args, **kwargs):
+        embedding_inputs.append(kwargs["input"])
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[
+                Embedding(embedding=[0.1, 0.2, float(index)], index=index, object="embedding")
+                for index in range(len(kwargs["input"]))
+            ],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+    monkeypatch.setattr(openai_client.embeddings, "create", mock_create)
+    questions = ["What is the capital of France?", "What is the deductible?", "What is the capital of France?"]
+    response = await client.post("/ask/batch", json={"questions": questions})
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    answers = [json.loads(line) for line in (await response.get_data()).splitlines()]
+    assert sorted(answer["index"] for answer in answers) == [0, 1, 2]
+    for answer in answers:
+        assert answer["choices"][0]["message"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+        assert answer["choices"][0]["context"]["data_points"]["text"]
+    # The distinct questions are embedded with a single call
+    assert embedding_inputs == [["What is the capital of France?", "What is the deductible?"]]
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_failed_question(client, monkeypatch):
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.Mock(side_effect=filtered_response))
+    response = await client.post(
+        "/ask/batch",
+        json={"questions": ["How do I do something bad?"], "context": {"overrides": {"retrieval_mode": "text"}}},
+    )
+    assert response.status_code == 200
+    answers = [json.loads(line) for line in (await response.get_data()).splitlines()]
+    assert answers == [{"index": 0, "error": app.ERROR_MESSAGE_FILTER}]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("questions", [None, [], "What is the capital of France?", [1, 2]])
+async def test_ask_batch_invalid_questions(client, questions):
+    response = await client.post("/ask/batch", json={"questions": questions})
+    assert response.status_code == 400
+    assert (await response.get_json())["error"] == "questions must be a non-empty list of strings"
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_too_many_questions(client):
+    client.app.config[app.CONFIG_ASK_BATCH_MAX_QUESTIONS] = 2
+    response = await client.post("/ask/batch", json={"questions": ["a", "b", "c"]})
+    assert response.status_code == 400
+    assert (await response.get_json())["error"] == "a batch can have at most 2 questions"
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def gen():
@@ -652,4 +863,52 @@ async def test_format_as_ndjson():
         yield {"b": "Newlines inside \n strings are fine"}
 
     result = [line async for line in app.format_as_ndjson(gen())]
-    assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+    assert all(line.endswith(b"\n") and line.count(b"\n") == 1 for line in result)
+    assert [json.loads(line) for line in result] == [{"a": "I ❤️ 🐍"}, {"b": "Newlines inside \n strings are fine"}]
+    assert "I ❤️ 🐍".encode() in result[0]
+
+
+@pytest.mark.asyncio
+async def test_format_as_sse():
+    async def gen():
+        yield {"a": "I ❤️ 🐍"}
+        yield {"b": "Newlines inside \n strings are fine"}
+
+    result = [frame async for frame in app.format_as_sse(gen())]
+    assert result == ['data: {"a":"I ❤️ 🐍"}\n\n'.encode(), b'data: {"b":"Newlines inside \\n strings are fine"}\n\n']
+
+
+@pytest.mark.asyncio
+async def test_format_as_sse_heartbeat_and_idle_timeout(caplog):
+    closed = []
+
+    async def gen():
+        try:
+            yield {"a": 1}
+            await asyncio.sleep(0.15)
+            yield {"b": 2}
+            await asyncio.sleep(10)
+            yield {"c": 3}
+        finally:
+            closed.append(True)
+
+    result = [frame async for frame in app.format_as_sse(gen(), heartbeat_interval=0.05, idle_timeout=0.3)]
+    assert result[0] == b'data: {"a":1}\n\n'
+    assert b": heartbeat\n\n" in result[1:3]
+    assert b'data: {"b":2}\n\n' in result
+    assert result[-1].startswith(b"event: error\ndata: ")
+    assert b"TimeoutError" in result[-1]
+    assert closed == [True]
+    assert "Response stream timed out" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_format_as_sse_max_duration():
+    async def gen():
+        while True:
+            await asyncio.sleep(0.01)
+            yield {"a": 1}
+
+    result = [frame async for frame in app.format_as_sse(gen(), heartbeat_interval=1, max_duration=0.1)]
+    assert 1 < len(result) < 20
+    assert result[-1].startswith(b"event: error\n")
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from scripts.askbatch import main, parse_args
+
+
+def test_parse_args():
+    args = parse_args(["questions.txt"])
+    assert args.questions == "questions.txt"
+    assert args.output == "-"
+    assert args.backend_url == "http://localhost:50505"
+    assert args.batch_size == 100
+    assert args.overrides is None
+
+    args = parse_args(
+        [
+            "-",
+            "--output",
+            "answers.jsonl",
+            "--backend-url",
+            "https://app.example.com",
+            "--batch-size",
+            "2",
+            "--overrides",
+            '{"retrieval_mode": "text"}',
+            "--token",
+            "secret",
+        ]
+    )
+    assert (args.questions, args.output, args.backend_url) == ("-", "answers.jsonl", "https://app.example.com")
+    assert args.batch_size == 2
+    assert json.loads(args.overrides) == {"retrieval_mode": "text"}
+    assert args.token == "secret"
+
+
+@pytest_asyncio.fixture
+async def batch_server():
+    requests = []
+
+    async def ask_batch(request):
+        body = await request.json()
+        requests.append((body, request.headers.get("Authorization")))
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        # Answers are sent in completion order, tagged with the index of their question
+        for index, question in reversed(list(enumerate(body["questions"]))):
+            if question == "fail":
+                answer = {"index": index, "error": "The app encountered an error processing your request."}
+            else:
+                answer = {"index": index, "choices": [{"message": {"content": f"Answer to {question}"}}]}
+            await response.write(json.dumps(answer).encode() + b"\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/ask/batch", ask_batch)
+    server = TestServer(app)
+    await server.start_server()
+    yield server, requests
+    await server.close()
+
+
+@pytest.mark.asyncio
+async def test_main(batch_server, tmp_path):
+    server, requests = batch_server
+    questions = tmp_path / "questions.txt"
+    questions.write_text("What is the capital of France?\n\nfail\nWhat is the capital of Spain?\n", encoding="utf-8")
+    output = tmp_path / "answers.jsonl"
+    args = parse_args(
+        [
+            str(questions),
+            "--output",
+            str(output),
+            "--backend-url",
+            str(server.make_url("/")),
+            "--batch-size",
+            "2",
+            "--overrides",
+            '{"retrieval_mode": "text"}',
+            "--token",
+            "secret",
+        ]
+    )
+
+    # The number of failed questions is returned
+    assert await main(args) == 1
+
+    assert requests == [
+        (
+            {
+                "questions": ["What is the capital of France?", "fail"],
+                "context": {"overrides": {"retrieval_mode": "text"}},
+            },
+            "Bearer secret",
+        ),
+        (
+            {"questions": ["What is the capital of Spain?"], "context": {"overrides": {"retrieval_mode": "text"}}},
+            "Bearer secret",
+        ),
+    ]
+    answers = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    # Each answer is written with its question, and indexes are relative to the request
+    assert [(answer["index"], answer["question"]) for answer in answers] == [
+        (1, "fail"),
+        (0, "What is the capital of France?"),
+        (0, "What is the capital of Spain?"),
+    ]
+    assert answers[0]["error"] == "The app encountered an error processing your request."
+    assert answers[1]["choices"][0]["message"]["content"] == "Answer to What is the capital of France?"
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.chat import ChatCompletion
+from openai.types.chat.chat_completion import ChatCompletionMessage, Choice
+from openai.types.create_embedding_response import Usage
+
+from approaches.approach import Approach
+from core.cache import LRUCache, hash_key
+from core.completioncache import ChatCompletionCache
+from core.embeddingcache import EmbeddingCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hash_key_ignores_dict_order():
+    assert hash_key({"a": 1, "b": 2}) == hash_key({"b": 2, "a": 1})
+    assert hash_key({"a": 1}) != hash_key({"a": 2})
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache: LRUCache[str] = LRUCache(max_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+    assert "b" not in cache
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert cache.stats.evictions == 1
+
+
+def test_lru_cache_max_bytes():
+    cache: LRUCache[bytes] = LRUCache(max_entries=10, max_bytes=10, sizeof=len)
+    cache.set("a", b"12345")
+    cache.set("b", b"12345")
+    cache.set("c", b"1")
+    assert "a" not in cache
+    assert cache.total_bytes == 6
+    # Values larger than the cap are never stored
+    cache.set("d", b"12345678901")
+    assert "d" not in cache
+    assert "b" in cache
+
+
+def test_lru_cache_ttl():
+    clock = FakeClock()
+    cache: LRUCache[str] = LRUCache(ttl=10, clock=clock)
+    cache.set("a", "1")
+    clock.now = 9
+    assert cache.get("a") == "1"
+    clock.now = 10
+    assert cache.get("a") is None
+    assert cache.stats.as_dict() == {"hits": 1, "misses": 1, "evictions": 0, "expirations": 1, "hit_ratio": 0.5}
+
+
+class MockCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs):
+        self.calls += 1
+        return ChatCompletion(
+            object="chat.completion",
+            choices=[
+                Choice(
+                    message=ChatCompletionMessage(role="assistant", content=f"answer {self.calls}"),
+                    finish_reason="stop",
+                    index=0,
+                )
+            ],
+            id="test-123",
+            created=0,
+            model="test-model",
+        )
+
+
+class MockOpenAIClient:
+    def __init__(self):
+        self.chat = self
+        self.completions = MockCompletions()
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_cache_hit():
+    openai_client = MockOpenAIClient()
+    cache = ChatCompletionCache()
+    params = {"model": "chat", "messages": [{"role": "user", "content": "hi"}], "temperature": 0.0, "n": 1}
+
+    first = await cache.create(openai_client, **params)
+    second = await cache.create(openai_client, **params)
+    assert openai_client.completions.calls == 1
+    assert second.choices[0].message.content == first.choices[0].message.content == "answer 1"
+    assert second is not first
+    assert cache.stats.hits == 1 and cache.stats.misses == 1
+
+    await cache.create(openai_client, **{**params, "max_tokens": 100})
+    assert openai_client.completions.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_cache_skips_nondeterministic_calls():
+    openai_client = MockOpenAIClient()
+    cache = ChatCompletionCache()
+    params = {"model": "chat", "messages": [{"role": "user", "content": "hi"}], "temperature": 0.7}
+
+    await cache.create(openai_client, **params)
+    await cache.create(openai_client, **params)
+    assert openai_client.completions.calls == 2
+    assert len(cache.cache) == 0
+
+
+def test_embedding_cache_stores_float32():
+    cache = EmbeddingCache()
+    cache.set("text-embedding-ada-002", "hello", [0.5, -0.25, 0.125])
+    stored = cache.cache.get(hash_key("text-embedding-ada-002", "hello"))
+    assert stored.dtype == np.float32
+    assert cache.get("text-embedding-ada-002", "hello") == [0.5, -0.25, 0.125]
+    assert cache.get("other-model", "hello") is None
+    assert cache.get("text-embedding-ada-002", "hello ") is None
+
+
+class MockEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, *args, **kwargs):
+        self.calls += 1
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[Embedding(embedding=[0.5, -0.25, 0.125], index=0, object="embedding")],
+            model="text-embedding-ada-002",
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_uses_cache():
+    openai_client = MockOpenAIClient()
+    openai_client.embeddings = MockEmbeddings()
+    approach = Approach(
+        search_client=None,
+        openai_client=openai_client,
+        auth_helper=None,
+        query_language="en-us",
+        query_speller="lexicon",
+        embedding_deployment="embeddings",
+        embedding_model="text-embedding-ada-002",
+        openai_host="azure",
+        embedding_cache=EmbeddingCache(),
+    )
+
+    first = await approach.compute_text_embedding("hello")
+    second = await approach.compute_text_embedding("hello")
+    assert openai_client.embeddings.calls == 1
+    assert first.vector == second.vector == [0.5, -0.25, 0.125]
+    assert approach.embedding_cache.stats.hits == 1
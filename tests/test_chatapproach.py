@@ -1,9 +1,12 @@
+import asyncio
+import inspect
 import json
 
 import pytest
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.rewriteskip import RewriteSkipClassifier
 
 
 @pytest.fixture
@@ -67,6 +70,32 @@ def test_get_messages_from_history(chat_approach):
     ]
 
 
+def test_get_messages_from_history_max_history_messages(chat_approach):
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id="gpt-35-turbo",
+        history=[
+            {"role": "user", "content": "What happens in a performance review?"},
+            {"role": "assistant", "content": "The supervisor discusses your performance [employee_handbook-3.pdf]."},
+            {"role": "user", "content": "Is there a dress code?"},
+            {"role": "assistant", "content": "Yes, business casual [employee_handbook-7.pdf]."},
+            {"role": "user", "content": "What does a Product Manager do?"},
+        ],
+        user_content="What does a Product Manager do?",
+        max_tokens=3000,
+        few_shots=[{"role": "user", "content": "Example question"}, {"role": "assistant", "content": "Example"}],
+        max_history_messages=2,
+    )
+    assert messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "Example question"},
+        {"role": "assistant", "content": "Example"},
+        {"role": "user", "content": "Is there a dress code?"},
+        {"role": "assistant", "content": "Yes, business casual [employee_handbook-7.pdf]."},
+        {"role": "user", "content": "What does a Product Manager do?"},
+    ]
+
+
 def test_get_messages_from_history_truncated(chat_approach):
     messages = chat_approach.get_messages_from_history(
         system_prompt="You are a bot.",
@@ -209,3 +238,355 @@ def test_get_messages_from_history_few_shots(chat_approach):
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+def make_chunk(delta, finish_reason=None):
+    choices = [{"delta": delta, "index": 0, "finish_reason": finish_reason}] if delta is not None else []
+    return ChatCompletionChunk.model_validate(
+        {"object": "chat.completion.chunk", "choices": choices, "id": "test-id", "model": "gpt-35-turbo", "created": 1}
+    )
+
+
+def mock_final_call(chat_approach, chunks, closed=None, stages=(), started=None):
+    async def chat_completion():
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            if closed is not None:
+                closed.append(True)
+
+    async def run_until_final_call(*args, on_progress=None, **kwargs):
+        for stage in stages:
+            on_progress(stage)
+            await asyncio.sleep(0)
+
+        async def chat_coroutine():
+            if started is not None:
+                started.append(True)
+            return chat_completion()
+
+        return {"data_points": []}, chat_coroutine()
+
+    chat_approach.run_until_final_call = run_until_final_call
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_compact_events(chat_approach):
+    mock_final_call(
+        chat_approach,
+        [
+            make_chunk(None),
+            make_chunk({"role": "assistant"}),
+            make_chunk({"content": "The capital of France is Paris."}),
+            make_chunk({"content": None}, "stop"),
+        ],
+    )
+    events = [event async for event in chat_approach.run_with_streaming([], {}, {})]
+    assert events[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert events[1:] == [
+        {
+            "choices": [{"delta": {"content": "The capital of France is Paris."}, "finish_reason": None, "index": 0}],
+            "object": "chat.completion.chunk",
+        },
+        {
+            "choices": [{"delta": {"content": ""}, "finish_reason": "stop", "index": 0}],
+            "object": "chat.completion.chunk",
+        },
+    ]
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_followup_questions_split_across_chunks(chat_approach):
+    mock_final_call(
+        chat_approach,
+        [
+            make_chunk({"content": "Paris.<"}),
+            make_chunk({"content": "<Is Lyon big?>"}),
+            make_chunk({"content": "> <<What is"}),
+            make_chunk({"content": " the Seine?>>"}),
+            make_chunk({"content": None}, "stop"),
+        ],
+    )
+    events = [event async for event in chat_approach.run_with_streaming([], {"suggest_followup_questions": True}, {})]
+    contents = [event["choices"][0]["delta"].get("content") for event in events[1:]]
+    assert contents == ["Paris.", None, None, ""]
+    assert events[2]["choices"][0]["context"] == {"followup_questions": ["Is Lyon big?"]}
+    assert events[3]["choices"][0]["context"] == {"followup_questions": ["Is Lyon big?", "What is the Seine?"]}
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_upstream_when_closed_early(chat_approach):
+    closed = []
+    mock_final_call(
+        chat_approach,
+        [make_chunk({"content": "The capital"}), make_chunk({"content": " of France"})],
+        closed,
+    )
+    events = chat_approach.run_with_streaming([], {}, {})
+    await events.__anext__()
+    assert (await events.__anext__())["choices"][0]["delta"]["content"] == "The capital"
+    await events.aclose()
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_answer_when_closed_at_context(chat_approach):
+    async def chat_completion():
+        yield make_chunk({"content": "Paris."})
+
+    chat_stream = chat_completion()
+
+    async def answer():
+        return chat_stream
+
+    async def run_until_final_call(*args, **kwargs):
+        return {"data_points": []}, answer()
+
+    chat_approach.run_until_final_call = run_until_final_call
+    events = chat_approach.run_with_streaming([], {}, {})
+    assert (await events.__anext__())["choices"][0]["context"] == {"data_points": []}
+    # The answer has arrived, but the client goes away before reading it
+    await asyncio.sleep(0)
+    await events.aclose()
+    assert chat_stream.ag_frame is None
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_closes_prompt_when_closed_during_progress(chat_approach):
+    async def answer():
+        return None
+
+    chat_coroutine = answer()
+
+    async def run_until_final_call(*args, on_progress=None, **kwargs):
+        on_progress("rewriting")
+        on_progress("searching")
+        return {"data_points": []}, chat_coroutine
+
+    chat_approach.run_until_final_call = run_until_final_call
+    events = chat_approach.run_with_streaming([], {}, {})
+    assert (await events.__anext__())["choices"][0]["progress"] == "rewriting"
+    await events.aclose()
+    assert inspect.getcoroutinestate(chat_coroutine) == inspect.CORO_CLOSED
+
+
+@pytest.mark.asyncio
+async def test_run_with_streaming_progress_events(chat_approach):
+    started = []
+    mock_final_call(
+        chat_approach,
+        [make_chunk({"content": "Paris."}), make_chunk({"content": None}, "stop")],
+        stages=["rewriting", "searching"],
+        started=started,
+    )
+    events = chat_approach.run_with_streaming([], {}, {})
+    assert (await events.__anext__())["choices"][0]["progress"] == "rewriting"
+    assert (await events.__anext__())["choices"][0]["progress"] == "searching"
+    context_event = await events.__anext__()
+    assert context_event["choices"][0]["context"] == {"data_points": []}
+    assert "progress" not in context_event["choices"][0]
+    # The final call was sent before the client asked for the first answer delta
+    await asyncio.sleep(0)
+    assert started == [True]
+    assert [event["choices"][0]["delta"]["content"] async for event in events] == ["Paris.", ""]
+
+
+def make_completion(content):
+    return ChatCompletion.model_validate(
+        {
+            "id": "test-id",
+            "object": "chat.completion",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        }
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "rewritten_query, expected_searches, speculative",
+    [
+        ("capital France", ["What is the capital of France?"], True),
+        ("capital of France Paris", ["What is the capital of France?", "capital of France Paris"], False),
+    ],
+)
+async def test_speculative_retrieval(chat_approach, rewritten_query, expected_searches, speculative):
+    chat_approach.speculative_retrieval = True
+    events = []
+
+    async def create_chat_completion(**params):
+        if "functions" in params:
+            await asyncio.sleep(0.01)
+            events.append("rewritten")
+            return make_completion(rewritten_query)
+        return make_completion("Paris.")
+
+    async def search(top, query_text, *args):
+        events.append(query_text)
+        return []
+
+    chat_approach.create_chat_completion = create_chat_completion
+    chat_approach.search = search
+    chat_approach.build_filter = lambda overrides, auth_claims: None
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(
+        [{"role": "user", "content": "What is the capital of France?"}], {"retrieval_mode": "text"}, {}
+    )
+    await chat_coroutine
+    # The original question is searched while the query is rewritten
+    assert events[:2] == ["What is the capital of France?", "rewritten"]
+    assert [event for event in events if event != "rewritten"] == expected_searches
+    assert extra_info["thoughts"][1].props["speculative"] is speculative
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "history, expected_calls",
+    [
+        ([{"role": "user", "content": "How do I order tube feeding?"}], ["answer"]),
+        (
+            [
+                {"role": "user", "content": "How do I order tube feeding?"},
+                {"role": "assistant", "content": "Use the order entry activity [orders-3.pdf]."},
+                {"role": "user", "content": "How do I cancel orders?"},
+            ],
+            ["rewrite", "answer"],
+        ),
+    ],
+)
+async def test_rewrite_skip(chat_approach, history, expected_calls):
+    chat_approach.rewrite_skip_classifier = RewriteSkipClassifier()
+    calls = []
+    searches = []
+
+    async def create_chat_completion(**params):
+        calls.append("rewrite" if "functions" in params else "answer")
+        return make_completion("order tube feeding")
+
+    async def search(top, query_text, *args):
+        searches.append(query_text)
+        return []
+
+    chat_approach.create_chat_completion = create_chat_completion
+    chat_approach.search = search
+    chat_approach.build_filter = lambda overrides, auth_claims: None
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {"retrieval_mode": "text"}, {})
+    await chat_coroutine
+    assert calls == expected_calls
+    skipped = expected_calls == ["answer"]
+    assert searches == [history[-1]["content"] if skipped else "order tube feeding"]
+    assert extra_info["thoughts"][1].props["rewrite_skipped"] is skipped
+    assert chat_approach.rewrite_skip_classifier.stats.skipped == int(skipped)
+
+
+def test_is_equivalent_query(chat_approach):
+    assert chat_approach.is_equivalent_query("capital France", "What is the capital of France?")
+    assert chat_approach.is_equivalent_query("What is the CAPITAL of France", "What is the capital of France?")
+    assert not chat_approach.is_equivalent_query("capital France Paris", "What is the capital of France?")
+
+
+def make_utility_chat_approach(**kwargs):
+    return ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        **kwargs,
+    )
+
+
+def mock_utility_calls(chat_approach, calls, followups="<<Is Lyon big?>><<What is the Seine?>>"):
+    async def create_chat_completion(**params):
+        if "functions" in params:
+            calls.append(("rewrite", params["model"]))
+            return make_completion("capital France")
+        if params["messages"][0]["content"].startswith(chat_approach.followup_questions_system_prompt):
+            calls.append(("followups", params["model"]))
+            if isinstance(followups, Exception):
+                raise followups
+            return make_completion(followups)
+        calls.append(("answer", params["model"]))
+        if not params.get("stream"):
+            return make_completion("Paris.")
+
+        async def chunks():
+            yield make_chunk({"content": "Paris."})
+            yield make_chunk({"content": None}, "stop")
+
+        return chunks()
+
+    async def search(*args):
+        return []
+
+    chat_approach.create_chat_completion = create_chat_completion
+    chat_approach.search = search
+    chat_approach.build_filter = lambda overrides, auth_claims: None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "kwargs, rewrite_model",
+    [
+        ({}, "chat"),
+        ({"utility_model": "gpt-4o-mini", "utility_deployment": "utility"}, "utility"),
+        # Without a deployment name, as with non-Azure OpenAI, the model name is sent
+        ({"utility_model": "gpt-4o-mini"}, "gpt-4o-mini"),
+        # Without a model name, the deployment is still used, with the chat model's token limit
+        ({"utility_deployment": "utility"}, "utility"),
+    ],
+)
+async def test_utility_model_rewrites_query(kwargs, rewrite_model):
+    chat_approach = make_utility_chat_approach(**kwargs)
+    calls = []
+    mock_utility_calls(chat_approach, calls)
+    chat_resp = await chat_approach.run_without_streaming(
+        [{"role": "user", "content": "What is the capital of France?"}], {"retrieval_mode": "text"}, {}
+    )
+    assert calls == [("rewrite", rewrite_model), ("answer", "chat")]
+    assert chat_resp["choices"][0]["message"]["content"] == "Paris."
+    assert chat_approach.utility_token_limit == (128000 if "utility_model" in kwargs else 4000)
+
+
+@pytest.mark.asyncio
+async def test_utility_followup_questions():
+    chat_approach = make_utility_chat_approach(
+        utility_model="gpt-4o-mini", utility_deployment="utility", utility_followup_questions=True
+    )
+    calls = []
+    mock_utility_calls(chat_approach, calls)
+    overrides = {"retrieval_mode": "text", "suggest_followup_questions": True}
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    chat_resp = await chat_approach.run_without_streaming(history, overrides, {})
+    assert sorted(calls) == [("answer", "chat"), ("followups", "utility"), ("rewrite", "utility")]
+    choice = chat_resp["choices"][0]
+    assert choice["message"]["content"] == "Paris."
+    assert choice["context"]["followup_questions"] == ["Is Lyon big?", "What is the Seine?"]
+    # The answer model isn't asked for follow-up questions
+    assert "<<" not in choice["context"]["thoughts"][-1].description[0]
+
+    events = [event async for event in chat_approach.run_with_streaming(history, overrides, {})]
+    assert [event["choices"][0]["delta"].get("content") for event in events[-3:]] == ["Paris.", None, ""]
+    assert events[-2]["choices"][0]["context"] == {"followup_questions": ["Is Lyon big?", "What is the Seine?"]}
+
+
+@pytest.mark.asyncio
+async def test_utility_followup_questions_error():
+    chat_approach = make_utility_chat_approach(utility_model="gpt-4o-mini", utility_followup_questions=True)
+    calls = []
+    mock_utility_calls(chat_approach, calls, followups=ZeroDivisionError("something bad happened"))
+    chat_resp = await chat_approach.run_without_streaming(
+        [{"role": "user", "content": "What is the capital of France?"}],
+        {"retrieval_mode": "text", "suggest_followup_questions": True},
+        {},
+    )
+    # The answer is returned without follow-up questions
+    assert chat_resp["choices"][0]["message"]["content"] == "Paris."
+    assert chat_resp["choices"][0]["context"]["followup_questions"] == []
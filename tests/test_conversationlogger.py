@@ -0,0 +1,360 @@
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+import quart.testing.app
+from azure.cosmos import exceptions
+from azure.cosmos.aio import ContainerProxy, CosmosClient
+from openai.types.chat import ChatCompletionChunk
+
+import app
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.conversationlogger import (
+    ConversationLogger,
+    ConversationSink,
+    CosmosConversationSink,
+    FileConversationSink,
+)
+from core.semanticcache import SemanticCache
+from core.singleflight import SingleFlight
+
+
+class RecordingSink(ConversationSink):
+    def __init__(self, delay: float = 0):
+        self.batches = []
+        self.delay = delay
+        self.closed = False
+
+    async def write(self, documents):
+        await asyncio.sleep(self.delay)
+        self.batches.append(documents)
+        return 0
+
+    async def close(self):
+        self.closed = True
+
+
+class ThrottledContainer:
+    def __init__(self, throttled_attempts: int):
+        self.throttled_attempts = throttled_attempts
+        self.attempts = 0
+        self.items = []
+
+    async def upsert_item(self, item):
+        self.attempts += 1
+        if self.attempts <= self.throttled_attempts:
+            raise exceptions.CosmosHttpResponseError(status_code=429, message="Too many requests")
+        self.items.append(item)
+
+
+@pytest.mark.asyncio
+async def test_conversationlogger_batches():
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, batch_size=2, flush_interval=0.05)
+    logger.start()
+    for i in range(3):
+        assert logger.log({"id": str(i)})
+    await asyncio.sleep(0.2)
+    assert [[document["id"] for document in batch] for batch in sink.batches] == [["0", "1"], ["2"]]
+
+    await logger.close()
+    assert sink.closed
+    assert logger.stats.as_dict() == {"written": 3, "dropped": 0, "failed": 0}
+
+
+@pytest.mark.asyncio
+async def test_conversationlogger_drops_when_full():
+    sink = RecordingSink(delay=0.05)
+    logger = ConversationLogger(sink, max_queue_size=2, batch_size=1, flush_interval=0)
+    logger.start()
+    results = [logger.log({"id": str(i)}) for i in range(3)]
+    assert results == [True, True, False]
+    await logger.close()
+    assert logger.stats.written == 2
+    assert logger.stats.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_conversationlogger_drains_on_close():
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, batch_size=10, flush_interval=60)
+    logger.start()
+    logger.log({"id": "1"})
+    logger.log({"id": "2"})
+    await logger.close()
+    assert sink.batches == [[{"id": "1"}, {"id": "2"}]]
+    assert not logger.log({"id": "3"})
+
+
+@pytest.mark.asyncio
+async def test_conversationlogger_close_with_full_queue():
+    sink = RecordingSink(delay=10)
+    logger = ConversationLogger(sink, max_queue_size=1, batch_size=1, flush_interval=0, drain_timeout=0.05)
+    logger.start()
+    logger.log({"id": "1"})
+    await asyncio.sleep(0)
+    logger.log({"id": "2"})
+    # Waiting for room in the queue for the stop sentinel doesn't outlast the drain timeout
+    await asyncio.wait_for(logger.close(), 1)
+    assert sink.closed
+    assert logger.stats.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_cosmos_sink_retries_throttled_writes():
+    container = ThrottledContainer(throttled_attempts=2)
+    sink = CosmosConversationSink(container, initial_backoff=0.001)
+    assert await sink.write([{"id": "1"}]) == 0
+    assert container.attempts == 3
+    assert container.items == [{"id": "1"}]
+
+    container = ThrottledContainer(throttled_attempts=10)
+    sink = CosmosConversationSink(container, max_retries=2, initial_backoff=0.001)
+    assert await sink.write([{"id": "1"}]) == 1
+    assert container.attempts == 3
+
+
+@pytest.mark.asyncio
+async def test_file_sink(tmp_path):
+    path = tmp_path / "conversations.jsonl"
+    sink = FileConversationSink(str(path))
+    await sink.write([{"id": "1", "question": "What is included in my plan?"}])
+    await sink.write([{"id": "2"}])
+    lines = path.read_text().splitlines()
+    assert [json.loads(line)["id"] for line in lines] == ["1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_chat_logs_one_document_per_turn(client):
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, flush_interval=0)
+    logger.start()
+    client.app.config[app.CONFIG_CHAT_APPROACH].conversation_logger = logger
+
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    await logger.close()
+
+    assert len(sink.batches) == 1 and len(sink.batches[0]) == 1
+    turn = sink.batches[0][0]
+    assert turn["question"] == "What is the capital of France?"
+    assert turn["query"]
+    assert "Benefit_Options-2.pdf" in turn["results"]
+    assert turn["answer"] == result["choices"][0]["message"]["content"]
+
+
+@pytest.mark.asyncio
+async def test_chat_logs_semantic_cache_hits(client):
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, flush_interval=0)
+    logger.start()
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    chat_approach.conversation_logger = logger
+    chat_approach.semantic_cache = SemanticCache()
+
+    request = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "text"}},
+    }
+    first = await client.post("/chat", json=request)
+    assert first.status_code == 200
+    second = await client.post("/chat", json=request)
+    assert second.status_code == 200
+    result = await second.get_json()
+    await logger.close()
+
+    first_turn, second_turn = [turn for batch in sink.batches for turn in batch]
+    assert "cached" not in first_turn
+    assert second_turn["cached"] is True
+    assert second_turn["question"] == "What is the capital of France?"
+    assert second_turn["answer"] == result["choices"][0]["message"]["content"]
+    assert second_turn["status"] == "completed"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream", [False, True])
+async def test_chat_single_flight_logs_every_turn(client, monkeypatch, stream):
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, flush_interval=0)
+    logger.start()
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    chat_approach.conversation_logger = logger
+    monkeypatch.setattr(chat_approach, "single_flight", SingleFlight())
+    completions = client.app.config[app.CONFIG_OPENAI_CLIENT].chat.completions
+    create = completions.create
+
+    async def slow_create(*args, **kwargs):
+        # Lets the other requests arrive while this one is in flight
+        await asyncio.sleep(0.01)
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(completions, "create", slow_create)
+
+    async def post(question):
+        response = await client.post(
+            "/chat",
+            json={
+                "stream": stream,
+                "messages": [{"content": question, "role": "user"}],
+                "context": {"overrides": {"retrieval_mode": "text"}},
+            },
+        )
+        assert response.status_code == 200
+        await response.get_data()
+
+    questions = ["What is the capital of France?", "what is the capital  of France?"]
+    await asyncio.gather(*(post(question) for question in questions))
+    await logger.close()
+
+    assert chat_approach.single_flight.stats.as_dict() == {"started": 1, "shared": 1}
+    turns = [turn for batch in sink.batches for turn in batch]
+    assert sorted(turn["question"] for turn in turns) == sorted(questions)
+    assert turns[0]["answer"] and turns[1]["answer"] == turns[0]["answer"]
+    assert [turn["status"] for turn in turns] == ["completed", "completed"]
+
+
+@pytest.mark.asyncio
+async def test_chat_vision_logs_turns(client):
+    vision_approach = client.app.config.get(app.CONFIG_CHAT_VISION_APPROACH)
+    if vision_approach is None:
+        pytest.skip("The vision approach is only set up with Azure OpenAI")
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, flush_interval=0)
+    logger.start()
+    vision_approach.conversation_logger = logger
+
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "Are interest rates high?", "role": "user"}],
+            "context": {"overrides": {"use_gpt4v": True, "gpt4v_input": "textAndImages"}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    await logger.close()
+
+    turn = sink.batches[0][0]
+    assert turn["question"] == "Are interest rates high?"
+    assert turn["answer"] == result["choices"][0]["message"]["content"]
+    assert turn["status"] == "completed"
+
+
+def make_logged_chat_approach(logger):
+    chat_approach = ChatReadRetrieveReadApproach(
+        search_client=None,
+        auth_helper=None,
+        openai_client=None,
+        chatgpt_model="gpt-35-turbo",
+        chatgpt_deployment="chat",
+        embedding_deployment="embeddings",
+        embedding_model="text-",
+        sourcepage_field="",
+        content_field="",
+        query_language="en-us",
+        query_speller="lexicon",
+        conversation_logger=logger,
+    )
+    return chat_approach
+
+
+def make_chunk(content):
+    return ChatCompletionChunk.model_validate(
+        {
+            "object": "chat.completion.chunk",
+            "choices": [{"delta": {"content": content}, "index": 0, "finish_reason": None}],
+            "id": "test-id",
+            "model": "gpt-35-turbo",
+            "created": 1,
+        }
+    )
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_is_logged():
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, flush_interval=0)
+    logger.start()
+    chat_approach = make_logged_chat_approach(logger)
+
+    async def chat_completion():
+        yield make_chunk("The capital")
+        yield make_chunk(" of France")
+
+    async def chat_coroutine():
+        return chat_completion()
+
+    stream = await chat_approach.log_conversation_turn({"id": "1", "question": "Capital?"}, chat_coroutine())
+    await stream.__anext__()
+    # The client goes away before the answer is complete
+    await stream.aclose()
+    await logger.close()
+    assert sink.batches == [[{"id": "1", "question": "Capital?", "answer": "The capital", "status": "abandoned"}]]
+
+
+@pytest.mark.asyncio
+async def test_failed_answer_is_logged():
+    sink = RecordingSink()
+    logger = ConversationLogger(sink, flush_interval=0)
+    logger.start()
+    chat_approach = make_logged_chat_approach(logger)
+
+    async def chat_coroutine():
+        raise ZeroDivisionError("something bad happened")
+
+    with pytest.raises(ZeroDivisionError):
+        await chat_approach.log_conversation_turn({"id": "1", "question": "Capital?"}, chat_coroutine())
+    await logger.close()
+    assert sink.batches == [
+        [{"id": "1", "question": "Capital?", "answer": "", "status": "failed", "error": "something bad happened"}]
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cosmos_client_lifecycle(monkeypatch, mock_env):
+    monkeypatch.setenv("AZURE_COSMOSDB_ACCOUNT", "test-cosmos-account")
+    monkeypatch.setenv("AZURE_COSMOSDB_ACCOUNT_KEY", "ZmFrZQ==")
+    read = mock.AsyncMock()
+    monkeypatch.setattr(ContainerProxy, "read", read)
+    closed = []
+    original_close = CosmosClient.close
+
+    async def close(self):
+        closed.append(self)
+        await original_close(self)
+
+    monkeypatch.setattr(CosmosClient, "close", close)
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        cosmos_client = test_app.app.config[app.CONFIG_COSMOS_CLIENT]
+        assert isinstance(cosmos_client, CosmosClient)
+        # The connection is warmed up at startup
+        assert read.await_count == 1
+        sink = test_app.app.config[app.CONFIG_CONVERSATION_LOGGER].sink
+        assert sink.container_client.id == "conversations"
+    assert closed == [cosmos_client]
+
+
+@pytest.mark.asyncio
+async def test_cosmos_account_required(monkeypatch, mock_env):
+    monkeypatch.setenv("AZURE_COSMOSDB_ACCOUNT_KEY", "ZmFrZQ==")
+    quart_app = app.create_app()
+
+    with pytest.raises(quart.testing.app.LifespanError, match="AZURE_COSMOSDB_ACCOUNT must be set"):
+        async with quart_app.test_app() as test_app:
+            test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_no_cosmos_client_without_key(client):
+    assert client.app.config[app.CONFIG_COSMOS_CLIENT] is None
+    assert client.app.config[app.CONFIG_CONVERSATION_LOGGER] is None
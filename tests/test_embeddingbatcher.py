@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
+
+from core.embeddingbatcher import EmbeddingBatcher
+
+
+class MockEmbeddings:
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    async def create(self, *args, **kwargs):
+        self.calls.append((kwargs["model"], kwargs["input"]))
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+        return CreateEmbeddingResponse(
+            object="list",
+            data=[
+                Embedding(embedding=[float(len(text))], index=index, object="embedding")
+                for index, text in enumerate(kwargs["input"])
+            ],
+            model=kwargs["model"],
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+class MockOpenAIClient:
+    def __init__(self, error=None):
+        self.embeddings = MockEmbeddings(error)
+
+
+@pytest.mark.asyncio
+async def test_embed_batches_concurrent_requests():
+    openai_client = MockOpenAIClient()
+    batcher = EmbeddingBatcher(openai_client, max_batch_size=16, window=0.01)
+    vectors = await asyncio.gather(
+        batcher.embed("ada", "a"), batcher.embed("ada", "bb"), batcher.embed("ada", "a"), batcher.embed("other", "ccc")
+    )
+    assert vectors == [[1.0], [2.0], [1.0], [3.0]]
+    # One call per model, and identical texts are only sent once
+    assert sorted(openai_client.embeddings.calls) == [("ada", ["a", "bb"]), ("other", ["ccc"])]
+    assert batcher.stats.as_dict() == {
+        "requests": 4,
+        "batches": 2,
+        "inputs": 3,
+        "errors": 0,
+        "average_batch_size": 2.0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_embed_flushes_full_batch():
+    openai_client = MockOpenAIClient()
+    batcher = EmbeddingBatcher(openai_client, max_batch_size=2, window=10)
+    # The batch is sent as soon as it's full, without waiting for the window
+    vectors = await asyncio.wait_for(asyncio.gather(batcher.embed("ada", "a"), batcher.embed("ada", "bb")), 1)
+    assert vectors == [[1.0], [2.0]]
+    assert openai_client.embeddings.calls == [("ada", ["a", "bb"])]
+    assert batcher.timers == {}
+
+
+@pytest.mark.asyncio
+async def test_embed_error_reaches_every_caller():
+    openai_client = MockOpenAIClient(error=ZeroDivisionError("something bad happened"))
+    batcher = EmbeddingBatcher(openai_client, window=0.001)
+    results = await asyncio.gather(batcher.embed("ada", "a"), batcher.embed("ada", "bb"), return_exceptions=True)
+    assert [type(result) for result in results] == [ZeroDivisionError, ZeroDivisionError]
+    assert batcher.stats.errors == 1
+
+
+@pytest.mark.asyncio
+async def test_embed_cancelled_caller():
+    openai_client = MockOpenAIClient()
+    batcher = EmbeddingBatcher(openai_client, window=0.001)
+    cancelled = asyncio.ensure_future(batcher.embed("ada", "a"))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    assert await batcher.embed("ada", "bb") == [2.0]
+    assert openai_client.embeddings.calls == [("ada", ["a", "bb"])]
+
+
+def test_invalid_max_batch_size():
+    with pytest.raises(ValueError):
+        EmbeddingBatcher(MockOpenAIClient(), max_batch_size=0)
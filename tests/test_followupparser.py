@@ -0,0 +1,60 @@
+import pytest
+
+from core.followupparser import FollowupQuestionParser
+
+
+def feed_all(parser, deltas):
+    answer = ""
+    questions = []
+    for delta in deltas:
+        content, new_questions = parser.feed(delta)
+        answer += content
+        questions.extend(new_questions)
+    return answer + parser.close(), questions
+
+
+def test_followupparser_no_followups():
+    parser = FollowupQuestionParser()
+    assert parser.feed("The capital of France is Paris.") == ("The capital of France is Paris.", [])
+    assert parser.close() == ""
+
+
+@pytest.mark.parametrize("split", range(1, 60))
+def test_followupparser_split_anywhere(split):
+    text = "Paris [a.pdf] 1 < 2.<<Is Lyon big?>>\n<<What is the Seine?>>"
+    answer, questions = feed_all(FollowupQuestionParser(), [text[:split], text[split:]])
+    assert answer == "Paris [a.pdf] 1 < 2."
+    assert questions == ["Is Lyon big?", "What is the Seine?"]
+
+
+def test_followupparser_one_character_deltas():
+    text = "Answer with a > sign.<<First?>> <<Second?>>"
+    answer, questions = feed_all(FollowupQuestionParser(), list(text))
+    assert answer == "Answer with a > sign."
+    assert questions == ["First?", "Second?"]
+
+
+def test_followupparser_emits_questions_when_closed():
+    parser = FollowupQuestionParser()
+    assert parser.feed("Answer<") == ("Answer", [])
+    assert parser.feed("<First?>") == ("", [])
+    assert parser.feed(">\n<<Sec") == ("", ["First?"])
+    assert parser.feed("ond?>>") == ("", ["Second?"])
+    assert parser.questions == ["First?", "Second?"]
+
+
+def test_followupparser_trailing_marker_and_unclosed_question():
+    parser = FollowupQuestionParser()
+    assert parser.feed("Ends with <") == ("Ends with ", [])
+    assert parser.close() == "<"
+
+    parser = FollowupQuestionParser()
+    assert feed_all(parser, ["Answer<<Never closed"]) == ("Answer", [])
+
+
+def test_followupparser_drops_long_questions():
+    parser = FollowupQuestionParser(max_question_length=10)
+    answer, questions = feed_all(parser, ["Answer<<", "a" * 8, "a" * 8, ">><<Short?>>"])
+    assert answer == "Answer"
+    assert questions == ["Short?"]
+    assert parser.question_parts == []
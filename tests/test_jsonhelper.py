@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pytest
+
+from approaches.approach import ThoughtStep
+from core.jsonhelper import JSONSerializer, OrjsonSerializer, create_serializer
+
+serializers = [JSONSerializer(), OrjsonSerializer()]
+
+
+@pytest.mark.parametrize("serializer", serializers, ids=lambda serializer: serializer.name)
+def test_serializer_dataclasses(serializer):
+    payload = {
+        "context": {
+            "thoughts": [ThoughtStep("Search query", "capital of France", {"filter": None, "scores": np.array([1.5])})],
+            "data_points": ["Benefit_Options-2.pdf: I ❤️ 🐍"],
+        }
+    }
+    data = serializer.dumps(payload)
+    assert isinstance(data, bytes)
+    assert "I ❤️ 🐍".encode() in data
+    assert json.loads(data) == {
+        "context": {
+            "thoughts": [
+                {
+                    "title": "Search query",
+                    "description": "capital of France",
+                    "props": {"filter": None, "scores": [1.5]},
+                }
+            ],
+            "data_points": ["Benefit_Options-2.pdf: I ❤️ 🐍"],
+        }
+    }
+    assert serializer.loads(data) == json.loads(data)
+
+
+@pytest.mark.parametrize("serializer", serializers, ids=lambda serializer: serializer.name)
+def test_serializer_sort_keys(serializer):
+    assert serializer.dumps({"b": 1, "a": {"d": 2, "c": 3}}) == b'{"b":1,"a":{"d":2,"c":3}}'
+    assert serializer.dumps({"b": 1, "a": {"d": 2, "c": 3}}, sort_keys=True) == b'{"a":{"c":3,"d":2},"b":1}'
+
+
+@pytest.mark.parametrize("serializer", serializers, ids=lambda serializer: serializer.name)
+def test_serializer_unsupported_type(serializer):
+    with pytest.raises(TypeError):
+        serializer.dumps({"a": object()})
+
+
+@pytest.mark.asyncio
+async def test_serializer_dumps_async():
+    serializer = create_serializer()
+    assert await serializer.dumps_async({"a": [1, 2]}) == serializer.dumps({"a": [1, 2]})
+
+
+def test_create_serializer():
+    assert create_serializer().name == "orjson"
+    assert create_serializer("json").name == "json"
+    with pytest.raises(ValueError, match="Unknown JSON serializer"):
+        create_serializer("yaml")
@@ -1,4 +1,4 @@
-from core.messagebuilder import MessageBuilder
+from core.messagebuilder import MessageBuilder, normalize_text
 
 
 def test_messagebuilder():
@@ -47,3 +47,57 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_append_history():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    history = [
+        {"role": "user", "content": "a\u0301"},
+        {"role": "assistant", "content": "First answer"},
+        {"role": "user", "content": "Second question"},
+        {"role": "assistant", "content": "Second answer"},
+    ]
+    token_count = builder.append_history(history, max_tokens=1000, max_messages=3)
+    assert builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "assistant", "content": "First answer"},
+        {"role": "user", "content": "Second question"},
+        {"role": "assistant", "content": "Second answer"},
+    ]
+    assert token_count == sum(builder.count_tokens_for_messages(builder.messages[1:]))
+
+
+def test_messagebuilder_append_history_token_limit():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    history = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "Fine"},
+    ]
+    newest_token_count = builder.count_tokens_for_message(history[-1])
+    assert builder.append_history(history, max_tokens=newest_token_count) == newest_token_count
+    assert builder.messages[1:] == [{"role": "assistant", "content": "Fine"}]
+
+
+def test_normalize_text():
+    assert normalize_text("a\u0301") == "\u00e1"
+    text = "already normalized"
+    assert normalize_text(text) is text
+
+
+def test_messagebuilder_append_history_counts_in_groups():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.history_batch_size = 2
+    groups = []
+    count_tokens_for_messages = builder.count_tokens_for_messages
+
+    def counting(messages):
+        groups.append([message["content"] for message in messages])
+        return count_tokens_for_messages(messages)
+
+    builder.count_tokens_for_messages = counting
+    history = [{"role": "user", "content": f"Question {i}"} for i in range(5)]
+    three_newest = sum(count_tokens_for_messages(history[2:]))
+    assert builder.append_history(history, max_tokens=three_newest) == three_newest
+    assert [message["content"] for message in builder.messages[1:]] == ["Question 2", "Question 3", "Question 4"]
+    # The oldest message is never tokenized, since the limit is reached in the group before it
+    assert groups == [["Question 4", "Question 3"], ["Question 2", "Question 1"]]
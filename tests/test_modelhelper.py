@@ -1,9 +1,16 @@
+import os
+
 import pytest
 
 from core.modelhelper import (
+    TOKEN_COUNTS,
+    encoding_file_path,
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
+    preload_encodings,
 )
 
 
@@ -43,6 +50,41 @@ def test_num_tokens_from_messages_gpt4():
     assert num_tokens_from_messages(message, model) == 9
 
 
+def test_num_tokens_from_messages_batch():
+    messages = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "I am fine, thank you."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    TOKEN_COUNTS.clear()
+    counts = num_tokens_from_messages_batch(messages, "gpt-35-turbo")
+    assert counts == [num_tokens_from_messages(message, "gpt-35-turbo") for message in messages]
+    assert counts[0] == 9
+
+    # Each distinct string is only encoded once, later counts come from the cache
+    assert len(TOKEN_COUNTS) == 4
+    hits = TOKEN_COUNTS.stats.hits
+    assert num_tokens_from_messages_batch(messages, "gpt-35-turbo") == counts
+    assert TOKEN_COUNTS.stats.hits == hits + 6
+
+
+def test_get_encoding_is_reused():
+    assert get_encoding("gpt-35-turbo") is get_encoding("gpt-3.5-turbo")
+
+
+def test_encoding_file_path():
+    # tiktoken caches each file under the SHA-1 of its URL
+    assert encoding_file_path("cache", "cl100k_base") == os.path.join(
+        "cache", "9b5ad71b2ce5302211f9c61530b329a4922fc6a4"
+    )
+
+
+def test_preload_encodings_missing_files(tmp_path):
+    open(encoding_file_path(str(tmp_path), "cl100k_base"), "w").close()
+    with pytest.raises(FileNotFoundError, match="o200k_base"):
+        preload_encodings(["gpt-35-turbo", "gpt-4o-mini"], str(tmp_path))
+
+
 def test_get_oai_chatmodel_tiktok_mapped():
     assert get_oai_chatmodel_tiktok("gpt-35-turbo") == "gpt-3.5-turbo"
     assert get_oai_chatmodel_tiktok("gpt-35-turbo-16k") == "gpt-3.5-turbo-16k"
@@ -0,0 +1,29 @@
+import pytest
+
+from core.rewriteskip import RewriteSkipClassifier
+
+
+@pytest.mark.parametrize(
+    "question, has_history, expected",
+    [
+        ("How do I enter orders for continuous tube feeding?", False, True),
+        ("OnBase deficiencies", False, True),
+        ("How do I enter orders for continuous tube feeding?", True, False),
+        ("How do I cancel it?", False, False),
+        ("What about those orders?", False, False),
+        ("¿Cómo ingreso una orden de alimentación por sonda?", False, False),
+        ("How do I enter orders for continuous tube feeding in the remote client on a weekend shift?", False, False),
+        ("", False, False),
+        ("???", False, False),
+    ],
+)
+def test_can_skip(question, has_history, expected):
+    assert RewriteSkipClassifier().can_skip(question, has_history) is expected
+
+
+def test_can_skip_configured():
+    classifier = RewriteSkipClassifier(max_words=3, anaphora=frozenset({"orders"}))
+    assert classifier.can_skip("Cancel it now", has_history=False)
+    assert not classifier.can_skip("Cancel orders", has_history=False)
+    assert not classifier.can_skip("How do I cancel it", has_history=False)
+    assert classifier.stats.as_dict() == {"skipped": 1, "rewritten": 2, "skip_ratio": 1 / 3}
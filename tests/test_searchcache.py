@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from azure.search.documents.models import RawVectorQuery
+
+from approaches.approach import Approach, Document
+from core.searchcache import SearchCache
+
+from .mocks import MockAsyncSearchResultsIterator, MockCaption
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class MockSearchClient:
+    def __init__(self):
+        self.calls = 0
+
+    async def search(self, *args, **kwargs):
+        self.calls += 1
+        return MockAsyncSearchResultsIterator(kwargs.get("search_text"), kwargs.get("vector_queries"))
+
+
+def create_approach(search_cache):
+    return Approach(
+        search_client=MockSearchClient(),
+        openai_client=None,
+        auth_helper=None,
+        query_language="en-us",
+        query_speller="lexicon",
+        embedding_deployment="embeddings",
+        embedding_model="text-embedding-ada-002",
+        openai_host="azure",
+        search_cache=search_cache,
+    )
+
+
+def test_document_record_roundtrip():
+    document = Document(
+        id="1",
+        content="content",
+        embedding=[0.5, -0.25],
+        image_embedding=None,
+        category=None,
+        sourcepage="page-1.pdf",
+        sourcefile="page.pdf",
+        oids=["OID_X"],
+        groups=[],
+        captions=[MockCaption("caption")],
+    )
+    record = document.to_record()
+    assert isinstance(record[2], np.ndarray) and record[2].dtype == np.float32
+    assert Document.from_record(record) == document
+
+
+def test_searchcache_key_includes_vectors_and_options():
+    cache = SearchCache(index_name="index")
+    vectors = [RawVectorQuery(vector=[0.1, 0.2], k=50, fields="embedding")]
+    key = cache.make_key(3, "query", None, vectors, True, False)
+    assert key == cache.make_key(
+        3, "query", None, [RawVectorQuery(vector=[0.1, 0.2], k=50, fields="embedding")], True, False
+    )
+    assert key != cache.make_key(
+        3, "query", None, [RawVectorQuery(vector=[0.1, 0.3], k=50, fields="embedding")], True, False
+    )
+    assert key != cache.make_key(3, "query", None, vectors, True, True)
+    assert key != cache.make_key(5, "query", None, vectors, True, False)
+    assert key != SearchCache(index_name="other").make_key(3, "query", None, vectors, True, False)
+
+
+@pytest.mark.asyncio
+async def test_search_uses_cache():
+    approach = create_approach(SearchCache(index_name="index"))
+    first = await approach.search(3, "whistleblower", "category ne 'HR'", [], True, True)
+    second = await approach.search(3, "whistleblower", "category ne 'HR'", [], True, True)
+    assert approach.search_client.calls == 1
+    assert first == second
+    assert second[0].captions[0].text == "Caption: A whistleblower policy."
+
+    await approach.search(3, "whistleblower", None, [], True, True)
+    assert approach.search_client.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_searchcache_cleared_when_index_changes():
+    clock = FakeClock()
+    index_version = {"document_count": 1}
+
+    async def get_index_version():
+        return index_version["document_count"]
+
+    cache = SearchCache(index_name="index", get_index_version=get_index_version, check_interval=60, clock=clock)
+    approach = create_approach(cache)
+    await approach.search(3, "whistleblower", None, [], False, False)
+    await approach.search(3, "whistleblower", None, [], False, False)
+    assert approach.search_client.calls == 1
+
+    # Changes are only noticed after the check interval
+    index_version["document_count"] = 2
+    await approach.search(3, "whistleblower", None, [], False, False)
+    assert approach.search_client.calls == 1
+    clock.now = 60
+    await approach.search(3, "whistleblower", None, [], False, False)
+    assert approach.search_client.calls == 2
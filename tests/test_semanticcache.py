@@ -0,0 +1,157 @@
+import json
+
+import pytest
+
+import app
+from core.semanticcache import SemanticCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_semanticcache_lookup_similar():
+    cache = SemanticCache(threshold=0.9)
+    partition = SemanticCache.partition_id("filter")
+    cache.store(partition, [1.0, 0.0, 0.0], {"content": "first"})
+    cache.store(partition, [0.0, 1.0, 0.0], {"content": "second"})
+
+    payload, similarity = cache.lookup(partition, [0.1, 0.99, 0.0])
+    assert payload == {"content": "second"}
+    assert similarity > 0.99
+    assert cache.lookup(partition, [0.7, 0.7, 0.0]) is None
+    assert cache.stats.hits == 1 and cache.stats.misses == 1
+
+
+def test_semanticcache_partitions_are_isolated():
+    cache = SemanticCache(threshold=0.9)
+    cache.store(SemanticCache.partition_id("filter-a"), [1.0, 0.0], {"content": "a"})
+    assert cache.lookup(SemanticCache.partition_id("filter-b"), [1.0, 0.0]) is None
+    assert cache.lookup(SemanticCache.partition_id("filter-a"), [1.0, 0.0])[0] == {"content": "a"}
+
+
+def test_semanticcache_evicts_least_recently_used():
+    clock = FakeClock()
+    cache = SemanticCache(threshold=0.9, max_entries=2, clock=clock)
+    cache.store(1, [1.0, 0.0, 0.0], {"content": "a"})
+    clock.now = 1
+    cache.store(1, [0.0, 1.0, 0.0], {"content": "b"})
+    clock.now = 2
+    assert cache.lookup(1, [1.0, 0.0, 0.0]) is not None
+    clock.now = 3
+    cache.store(1, [0.0, 0.0, 1.0], {"content": "c"})
+    assert len(cache) == 2
+    assert cache.lookup(1, [0.0, 1.0, 0.0]) is None
+    assert cache.lookup(1, [1.0, 0.0, 0.0])[0] == {"content": "a"}
+    assert cache.stats.evictions == 1
+
+
+def test_semanticcache_max_bytes():
+    cache = SemanticCache(threshold=0.9, max_bytes=100)
+    cache.store(1, [1.0, 0.0], {"content": "a" * 40})
+    cache.store(1, [0.0, 1.0], {"content": "b" * 40})
+    assert len(cache) == 1
+    assert cache.total_bytes <= 100
+    cache.store(1, [1.0, 1.0], {"content": "c" * 200})
+    assert len(cache) == 1
+
+
+def test_semanticcache_ttl():
+    clock = FakeClock()
+    cache = SemanticCache(threshold=0.9, ttl=10, clock=clock)
+    cache.store(1, [1.0, 0.0], {"content": "a"})
+    cache.store(1, [0.0, 1.0], {"content": "b"})
+    clock.now = 5
+    cache.store(1, [1.0, 1.0], {"content": "c"})
+    clock.now = 10
+    assert cache.lookup(1, [1.0, 0.0]) is None
+    assert len(cache) == 1
+    assert cache.lookup(1, [1.0, 1.0])[0] == {"content": "c"}
+    assert cache.stats.expirations == 2
+
+
+@pytest.mark.asyncio
+async def test_ask_semantic_cache_hit(client):
+    client.app.config[app.CONFIG_ASK_APPROACH].semantic_cache = SemanticCache()
+    request = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"retrieval_mode": "hybrid"}},
+    }
+    first = await client.post("/ask", json=request)
+    assert first.status_code == 200
+    first_result = await first.get_json()
+    assert first_result["choices"][0]["context"]["thoughts"][0]["title"] != "Semantic cache hit"
+
+    # The mocked embeddings are the same for every question, so a paraphrase is a hit
+    request["messages"][0]["content"] = "Which city is the capital of France?"
+    second = await client.post("/ask", json=request)
+    assert second.status_code == 200
+    second_result = await second.get_json()
+    assert second_result["choices"][0]["context"]["thoughts"][0]["title"] == "Semantic cache hit"
+    assert second_result["choices"][0]["message"]["content"] == first_result["choices"][0]["message"]["content"]
+    assert second_result["choices"][0]["context"]["data_points"] == first_result["choices"][0]["context"]["data_points"]
+
+    # A different filter is a different partition
+    request["context"]["overrides"]["include_category"] = "HR"
+    third = await client.post("/ask", json=request)
+    third_result = await third.get_json()
+    assert third_result["choices"][0]["context"]["thoughts"][0]["title"] != "Semantic cache hit"
+
+
+@pytest.mark.asyncio
+async def test_ask_semantic_cache_miss_embeds_once(client):
+    approach = client.app.config[app.CONFIG_ASK_APPROACH]
+    approach.semantic_cache = SemanticCache()
+    embedded = []
+    compute_text_embedding = approach.compute_text_embedding
+
+    async def counting_compute_text_embedding(q):
+        embedded.append(q)
+        return await compute_text_embedding(q)
+
+    approach.compute_text_embedding = counting_compute_text_embedding
+    response = await client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "hybrid"}},
+        },
+    )
+    assert response.status_code == 200
+    # The embedding computed for the cache lookup is reused for the search
+    assert embedded == ["What is the capital of France?"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_semantic_cache_replay(client):
+    approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    approach.semantic_cache = SemanticCache()
+    overrides = {"retrieval_mode": "text", "suggest_followup_questions": True}
+    partition, query_vector = await approach.get_semantic_cache_key("What is the capital of France?", overrides, {})
+    approach.store_semantic_cache(
+        partition,
+        query_vector,
+        "What is the capital of France?",
+        "The capital of France is Paris. [Benefit_Options-2.pdf].",
+        {"data_points": {"text": ["Benefit_Options-2.pdf: Paris"]}, "followup_questions": ["What about Spain?"]},
+    )
+
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "stream": True,
+            "context": {"overrides": overrides},
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    events = [json.loads(line) for line in (await response.get_data()).decode().splitlines()]
+    assert events[0]["choices"][0]["context"]["data_points"] == {"text": ["Benefit_Options-2.pdf: Paris"]}
+    assert events[0]["choices"][0]["context"]["thoughts"][0]["title"] == "Semantic cache hit"
+    assert events[1]["choices"][0]["delta"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    assert events[2]["choices"][0]["context"] == {"followup_questions": ["What about Spain?"]}
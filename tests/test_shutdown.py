@@ -0,0 +1,23 @@
+import pytest
+
+from core.shutdown import close_all
+
+
+@pytest.mark.asyncio
+async def test_close_all_closes_every_client(caplog):
+    closed = []
+
+    class Client:
+        def __init__(self, name, fail=False):
+            self.name = name
+            self.fail = fail
+
+        async def close(self):
+            if self.fail:
+                raise RuntimeError("connection reset")
+            closed.append(self.name)
+
+    await close_all(Client("search"), None, Client("blob", fail=True), Client("openai"))
+    assert closed == ["search", "openai"]
+    assert "Unable to close Client: connection reset" in caplog.text
+
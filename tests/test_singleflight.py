@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+from core.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_run_shares_computation():
+    single_flight = SingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    async def compute():
+        calls.append(True)
+        await release.wait()
+        return {"answer": "Paris"}
+
+    waiters = [asyncio.ensure_future(single_flight.run("key", compute)) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*waiters)
+    assert calls == [True]
+    assert results == [{"answer": "Paris"}] * 3
+    # Every waiter gets its own copy
+    results[0]["answer"] = "Lyon"
+    assert results[1]["answer"] == "Paris"
+    assert single_flight.stats.as_dict() == {"started": 1, "shared": 2}
+    assert single_flight.flights == {}
+
+    # The result isn't kept once the computation is done
+    await single_flight.run("key", compute)
+    assert calls == [True, True]
+
+
+@pytest.mark.asyncio
+async def test_run_shares_errors():
+    single_flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0)
+        raise ZeroDivisionError("something bad happened")
+
+    results = await asyncio.gather(
+        single_flight.run("key", compute), single_flight.run("key", compute), return_exceptions=True
+    )
+    assert [type(result) for result in results] == [ZeroDivisionError, ZeroDivisionError]
+    assert single_flight.stats.started == 1
+
+
+@pytest.mark.asyncio
+async def test_run_cancels_when_all_waiters_leave():
+    single_flight = SingleFlight()
+    cancelled = []
+
+    async def compute():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    first = asyncio.ensure_future(single_flight.run("key", compute))
+    second = asyncio.ensure_future(single_flight.run("key", compute))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    assert cancelled == []
+    second.cancel()
+    await asyncio.gather(first, second, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+async def test_stream_fans_out_to_subscribers():
+    single_flight = SingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    async def compute():
+        calls.append(True)
+
+        async def events():
+            yield {"delta": "The capital"}
+            await release.wait()
+            yield {"delta": " is Paris."}
+
+        return events()
+
+    first = single_flight.stream("key", compute)
+    assert await first.__anext__() == {"delta": "The capital"}
+    # A late subscriber gets the events that were already sent
+    second = single_flight.stream("key", compute)
+    assert await second.__anext__() == {"delta": "The capital"}
+    release.set()
+    assert [event async for event in first] == [{"delta": " is Paris."}]
+    assert [event async for event in second] == [{"delta": " is Paris."}]
+    assert calls == [True]
+    assert single_flight.stats.as_dict() == {"started": 1, "shared": 1}
+    assert single_flight.stream_flights == {}
+
+
+@pytest.mark.asyncio
+async def test_stream_closes_upstream_when_all_subscribers_leave():
+    single_flight = SingleFlight()
+    closed = []
+
+    async def compute():
+        async def events():
+            try:
+                yield {"delta": "The capital"}
+                await asyncio.sleep(10)
+                yield {"delta": " is Paris."}
+            finally:
+                closed.append(True)
+
+        return events()
+
+    first = single_flight.stream("key", compute)
+    second = single_flight.stream("key", compute)
+    await first.__anext__()
+    await second.__anext__()
+    await first.aclose()
+    assert closed == []
+    await second.aclose()
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_stream_error_reaches_every_subscriber():
+    single_flight = SingleFlight()
+
+    async def compute():
+        async def events():
+            yield {"delta": "The capital"}
+            raise ZeroDivisionError("something bad happened")
+
+        return events()
+
+    for subscriber in (single_flight.stream("key", compute), single_flight.stream("key", compute)):
+        with pytest.raises(ZeroDivisionError):
+            async for _ in subscriber:
+                pass
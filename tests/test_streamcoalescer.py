@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import app
+from core.streamcoalescer import StreamCoalescer, is_content_delta
+
+
+def delta(content):
+    return {
+        "choices": [{"delta": {"content": content}, "finish_reason": None, "index": 0}],
+        "object": "chat.completion.chunk",
+    }
+
+
+async def generate(events, delay=0.0):
+    for event in events:
+        await asyncio.sleep(delay)
+        yield event
+
+
+def contents(events):
+    return [event["choices"][0]["delta"].get("content") for event in events]
+
+
+def test_is_content_delta():
+    assert is_content_delta(delta("Paris"))
+    context_event = {"choices": [{"delta": {"role": "assistant"}, "context": {"data_points": []}, "index": 0}]}
+    assert not is_content_delta(context_event)
+    finish_event = {"choices": [{"delta": {"content": ""}, "finish_reason": "stop", "index": 0}]}
+    assert not is_content_delta(finish_event)
+    assert not is_content_delta({"choices": []})
+
+
+@pytest.mark.asyncio
+async def test_coalesce_merges_deltas_and_sends_first_immediately():
+    context_event = {"choices": [{"delta": {"role": "assistant"}, "context": {"data_points": []}, "index": 0}]}
+    finish_event = {"choices": [{"delta": {"content": ""}, "finish_reason": "stop", "index": 0}]}
+    events = [context_event] + [delta(word) for word in ["The", " capital", " is", " Paris", "."]] + [finish_event]
+    coalescer = StreamCoalescer(window=60)
+    result = [event async for event in coalescer.coalesce(generate(events))]
+    assert result[0] is context_event
+    assert contents(result[1:]) == ["The", " capital is Paris.", ""]
+    assert result[-1] is finish_event
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_on_max_chars():
+    coalescer = StreamCoalescer(window=60, max_chars=4)
+    result = [event async for event in coalescer.coalesce(generate([delta("a"), delta("bb"), delta("cc"), delta("d")]))]
+    assert contents(result) == ["a", "bbcc", "d"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_when_window_elapses():
+    async def slow_events():
+        yield delta("first")
+        yield delta(" second")
+        # The pending frame is sent while the model is still thinking
+        await asyncio.sleep(0.2)
+        yield delta(" third")
+
+    coalescer = StreamCoalescer(window=0.01)
+    result = []
+    async for event in coalescer.coalesce(slow_events()):
+        result.append((event, asyncio.get_running_loop().time()))
+    assert contents([event for event, _ in result]) == ["first", " second", " third"]
+    assert result[2][1] - result[1][1] > 0.1
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_coalesced(client):
+    client.app.config[app.CONFIG_STREAM_COALESCER] = StreamCoalescer(window=60)
+    response = await client.post(
+        "/chat",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text"}},
+        },
+    )
+    assert response.status_code == 200
+    lines = (await response.get_data()).decode().splitlines()
+    assert "The capital of France is Paris." in "".join(lines)
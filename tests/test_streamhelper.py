@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from core.streamhelper import StreamStats, close_stream, track_stream
+
+
+class MockResponse:
+    def __init__(self):
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+
+class MockOpenAIStream:
+    def __init__(self):
+        self.response = MockResponse()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_close_stream():
+    stream = MockOpenAIStream()
+    await close_stream(stream)
+    assert stream.response.closed
+
+    finished = []
+
+    async def gen():
+        try:
+            yield 1
+            yield 2
+        finally:
+            finished.append(True)
+
+    events = gen()
+    assert await events.__anext__() == 1
+    await close_stream(events)
+    assert finished == [True]
+
+
+@pytest.mark.asyncio
+async def test_track_stream_counts():
+    async def gen(fail=False):
+        yield {"a": 1}
+        if fail:
+            raise ValueError("upstream error")
+
+    stats = StreamStats()
+    assert [event async for event in track_stream(gen(), stats)] == [{"a": 1}]
+    with pytest.raises(ValueError):
+        [event async for event in track_stream(gen(fail=True), stats)]
+    events = track_stream(gen(), stats)
+    await events.__anext__()
+    await events.aclose()
+    assert stats.as_dict() == {"completed": 1, "cancelled": 1, "failed": 1}
+
+
+@pytest.mark.asyncio
+async def test_track_stream_cancelled_closes_upstream():
+    upstream = MockOpenAIStream()
+    stats = StreamStats()
+
+    async def consume():
+        async for _ in track_stream(upstream, stats):
+            pass
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert stats.cancelled == 1
+    assert upstream.response.closed